@@ -1,1738 +1,4496 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import sqlite3
-import os
-import datetime
-import sys
-import csv
-from pathlib import Path
-import subprocess
-import platform
-import tempfile
-
-# --- SCHEDA CONVERTITORE PDF (CODICE ESISTENTE) ---
-class ConverterPanel(ttk.Frame):
-    def __init__(self, parent):
-        super().__init__(parent)
-        if getattr(sys, 'frozen', False):
-            base_path = Path(sys.executable).parent
-        else:
-            base_path = Path(__file__).parent.resolve()
-        
-        self.work_dir = str(base_path.parent / "NP_STAMPE")
-        try:
-            if not os.path.exists(self.work_dir):
-                os.makedirs(self.work_dir, exist_ok=True)
-        except:
-            self.work_dir = os.getcwd()
-
-        self.setup_ui()
-
-    def setup_ui(self):
-        main_frame = ttk.Frame(self, padding="10")
-        main_frame.pack(fill="both", expand=True)
-
-        dir_frame = ttk.LabelFrame(main_frame, text="Cartella di lavoro HTML", padding="5")
-        dir_frame.pack(fill="x", pady=5)
-        self.dir_label = ttk.Label(dir_frame, text=self.work_dir, relief="sunken", anchor="w")
-        self.dir_label.pack(side="left", fill="x", expand=True, padx=(0, 5))
-        ttk.Button(dir_frame, text="Cambia...", command=self.select_directory).pack(side="right")
-
-        files_frame = ttk.LabelFrame(main_frame, text="File HTML disponibili per conversione", padding="5")
-        files_frame.pack(fill="both", expand=True, pady=5)
-        scrollbar = ttk.Scrollbar(files_frame)
-        scrollbar.pack(side="right", fill="y")
-        self.files_listbox = tk.Listbox(files_frame, selectmode="multiple", yscrollcommand=scrollbar.set, height=10)
-        self.files_listbox.pack(side="left", fill="both", expand=True)
-        scrollbar.config(command=self.files_listbox.yview)
-
-        btn_f = ttk.Frame(main_frame)
-        btn_f.pack(pady=5)
-        ttk.Button(btn_f, text="Seleziona tutti", command=lambda: self.files_listbox.selection_set(0, "end")).pack(side="left", padx=2)
-        ttk.Button(btn_f, text="Deseleziona", command=lambda: self.files_listbox.selection_clear(0, "end")).pack(side="left", padx=2)
-        ttk.Button(btn_f, text="Aggiorna lista", command=self.refresh_file_list).pack(side="left", padx=2)
-
-        opt_f = ttk.LabelFrame(main_frame, text="Opzioni PDF", padding="5")
-        opt_f.pack(fill="x", pady=5)
-        self.mode = tk.StringVar(value="single")
-        ttk.Radiobutton(opt_f, text="PDF separati (A4)", variable=self.mode, value="single").pack(anchor="w")
-        ttk.Radiobutton(opt_f, text="Unisci in unico PDF", variable=self.mode, value="merged").pack(anchor="w")
-        
-        merge_n = ttk.Frame(opt_f)
-        merge_n.pack(fill="x")
-        ttk.Label(merge_n, text="Nome file unito:").pack(side="left", padx=5)
-        self.merged_name = ttk.Entry(merge_n)
-        self.merged_name.insert(0, "Progetto_Completo.pdf")
-        self.merged_name.pack(side="left", fill="x", expand=True)
-
-        self.btn_conv = ttk.Button(main_frame, text="AVVIA CONVERSIONE PDF", command=self.convert_to_pdf)
-        self.btn_conv.pack(pady=10, ipady=5)
-
-        self.status = ttk.Label(main_frame, text="Pronto", relief="sunken", anchor="w")
-        self.status.pack(fill="x")
-        self.prog = ttk.Progressbar(main_frame, mode='determinate')
-        self.prog.pack(fill="x", pady=5)
-        
-        self.refresh_file_list()
-
-    def select_directory(self):
-        d = filedialog.askdirectory(initialdir=self.work_dir)
-        if d:
-            self.work_dir = d
-            self.dir_label.config(text=d)
-            self.refresh_file_list()
-
-    def refresh_file_list(self):
-        self.files_listbox.delete(0, "end")
-        if os.path.exists(self.work_dir):
-            files = sorted([f for f in os.listdir(self.work_dir) if f.lower().endswith('.html')])
-            for f in files: self.files_listbox.insert("end", f)
-
-    def get_chrome_path(self):
-        sys_p = platform.system()
-        if sys_p == "Darwin":
-            ps = ["/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/Applications/Microsoft Edge.app/Contents/MacOS/Microsoft Edge"]
-        elif sys_p == "Windows":
-            ps = ["C:\\Program Files (x86)\\Microsoft\\Edge\\Application\\msedge.exe", "C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe", os.path.expanduser("~\\AppData\\Local\\Microsoft\\Edge\\Application\\msedge.exe")]
-        else:
-            ps = ["google-chrome", "microsoft-edge", "chromium"]
-        for p in ps:
-            if os.path.exists(p) if os.path.isabs(p) else True: return p
-        return None
-
-    def convert_to_pdf(self):
-        sel = self.files_listbox.curselection()
-        if not sel:
-            messagebox.showwarning("Attenzione", "Seleziona almeno un file HTML")
-            return
-        
-        c_path = self.get_chrome_path()
-        if not c_path:
-            messagebox.showerror("Errore", "Chrome o Edge non trovati. Installa un browser basato su Chromium.")
-            return
-
-        files = [self.files_listbox.get(i) for i in sel]
-        mode = self.mode.get()
-        self.prog['maximum'] = len(files)
-        temp_pdfs = []
-
-        try:
-            for i, f in enumerate(files):
-                h_p = os.path.abspath(os.path.join(self.work_dir, f))
-                if mode == "single":
-                    pdf_p = h_p.replace('.html', '.pdf')
-                else:
-                    t_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                    pdf_p = t_pdf.name
-                    t_pdf.close()
-                    temp_pdfs.append(pdf_p)
-
-                self.status.config(text=f"Conversione {i+1}/{len(files)}...")
-                self.update_idletasks()
-                
-                f_url = f"file:///{h_p.replace(os.sep, '/')}" if platform.system() == "Windows" else f"file://{h_p}"
-                cmd = [c_path, "--headless", "--disable-gpu", "--no-pdf-header-footer", "--print-to-pdf=" + pdf_p, f_url]
-                subprocess.run(cmd, check=True, timeout=30)
-                self.prog['value'] = i + 1
-
-            if mode == "merged":
-                try:
-                    from pypdf import PdfWriter, PdfReader
-                except ImportError:
-                     messagebox.showerror("Errore", "Libreria 'pypdf' mancante.\nInstalla con: pip install pypdf")
-                     return
-
-                out_n = self.merged_name.get()
-                if not out_n.endswith('.pdf'): out_n += ".pdf"
-                out_p = os.path.join(self.work_dir, out_n)
-                writer = PdfWriter()
-                for p in temp_pdfs:
-                    r = PdfReader(p)
-                    for page in r.pages: writer.add_page(page)
-                with open(out_p, "wb") as o: writer.write(o)
-                for p in temp_pdfs: os.unlink(p)
-                messagebox.showinfo("Successo", f"PDF Unito creato: {out_n}")
-            else:
-                messagebox.showinfo("Successo", "Conversione completata.")
-        except Exception as e:
-            messagebox.showerror("Errore", str(e))
-        finally:
-            self.status.config(text="Pronto")
-            self.prog['value'] = 0
-
-
-# --- FUNZIONI DI UTILITÀ DEL PROGRAMMA PRINCIPALE ---
-def format_currency(value):
-    if value is None: value = 0.0
-    return f"€ {value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-
-def safe_float_convert(value_str):
-    if not value_str: return 0.0
-    try:
-        clean = str(value_str).replace('€', '').strip()
-        if '.' in clean and ',' in clean:
-            clean = clean.replace('.', '').replace(',', '.')
-        elif ',' in clean:
-            clean = clean.replace(',', '.')
-        return float(clean)
-    except ValueError:
-        return 0.0
-
-# --- GESTIONE DATABASE ---
-class Database:
-    def __init__(self, db_name="np_zero.db"):
-        self.db_name = db_name
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
-        self.migrate_categories() # MIGRAZIONE AUTOMATICA ALL'AVVIO
-        self.populate_defaults()
-
-    def create_tables(self):
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS unita_misura (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codice TEXT UNIQUE,
-                nome TEXT,
-                descrizione TEXT
-            )
-        """)
-        
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS progetti (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codice TEXT,
-                titolo TEXT,
-                cup TEXT,
-                committente TEXT
-            )
-        """)
-
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS nuovi_prezzi (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                progetto_id INTEGER,
-                codice TEXT, 
-                descrizione TEXT,
-                unita_misura TEXT, 
-                perc_spese_generali REAL DEFAULT 17.0,
-                perc_sicurezza REAL DEFAULT 5.0,
-                perc_utili REAL DEFAULT 10.0,
-                prezzo_finale REAL DEFAULT 0.0,
-                FOREIGN KEY(progetto_id) REFERENCES progetti(id) ON DELETE CASCADE
-            )
-        """)
-
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS voci_costo (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                np_id INTEGER,
-                ordine INTEGER,
-                categoria TEXT, 
-                descrizione TEXT,
-                um TEXT,
-                quantita REAL,
-                prezzo_unitario REAL,
-                FOREIGN KEY(np_id) REFERENCES nuovi_prezzi(id) ON DELETE CASCADE
-            )
-        """)
-        self.conn.commit()
-    
-    # --- NUOVA FUNZIONE DI MIGRAZIONE ---
-    def migrate_categories(self):
-        """Converte le vecchie categorie nel nuovo standard Regionale Campania"""
-        try:
-            # Materiali -> Prodotti
-            self.cursor.execute("UPDATE voci_costo SET categoria='Prodotti' WHERE categoria='Materiali'")
-            # Mezzi e Noli -> Attrezzature
-            self.cursor.execute("UPDATE voci_costo SET categoria='Attrezzature' WHERE categoria='Mezzi e Noli'")
-            self.conn.commit()
-        except Exception as e:
-            print(f"Errore migrazione categorie: {e}")
-
-    def populate_defaults(self):
-        self.cursor.execute("SELECT count(*) FROM unita_misura")
-        if self.cursor.fetchone()[0] == 0:
-            defaults = [
-                    ("cad.", "Cadauno", "Sanitari, infissi..."),
-                    ("corpo", "A corpo", "Opere indivisibili"),
-                    ("h", "Ora", "Manodopera..."),
-                    ("kg", "Chilogrammo", "Acciaio..."),
-                    ("m", "Metro lineare", "Tubazioni, cavi..."),
-                    ("mc", "Metro cubo", "Getti in cls, scavi..."),
-                    ("mq", "Metro quadrato", "Pavimenti, intonaci..."),
-            ]
-            self.cursor.executemany("INSERT INTO unita_misura (codice, nome, descrizione) VALUES (?, ?, ?)", defaults)
-            self.conn.commit()
-
-    def select_specific(self, table, columns, where_clause="", params=()):
-        cols_str = ", ".join(columns)
-        query = f"SELECT id, {cols_str} FROM {table} {where_clause}"
-        self.cursor.execute(query, params)
-        return self.cursor.fetchall()
-
-    def fetch_all(self, table, where_clause="", params=()):
-        query = f"SELECT * FROM {table} {where_clause}"
-        self.cursor.execute(query, params)
-        return self.cursor.fetchall()
-    
-    def fetch_one(self, table, where_clause="", params=()):
-        query = f"SELECT * FROM {table} {where_clause}"
-        self.cursor.execute(query, params)
-        return self.cursor.fetchone()
-
-    def get_max_order(self, np_id):
-        query = "SELECT MAX(ordine) FROM voci_costo WHERE np_id=?"
-        self.cursor.execute(query, (np_id,))
-        val = self.cursor.fetchone()[0]
-        return val if val is not None else 0
-
-    def insert(self, table, data):
-        columns = ', '.join(data.keys())
-        placeholders = ', '.join(['?'] * len(data))
-        values = list(data.values())
-        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
-        self.cursor.execute(query, values)
-        self.conn.commit()
-        return self.cursor.lastrowid 
-
-    def delete(self, table, record_id):
-        self.cursor.execute(f"DELETE FROM {table} WHERE id=?", (record_id,))
-        self.conn.commit()
-
-    def update(self, table, record_id, data):
-        set_clause = ', '.join([f"{k}=?" for k in data.keys()])
-        values = list(data.values()) + [record_id]
-        query = f"UPDATE {table} SET {set_clause} WHERE id=?"
-        self.cursor.execute(query, values)
-        self.conn.commit()
-
-# --- FINESTRA DI IMPORTAZIONE ---
-class ImportDialog(tk.Toplevel):
-    def __init__(self, parent, db, current_project_id, on_import_callback):
-        super().__init__(parent)
-        self.title("Importa NP da altro progetto")
-        self.geometry("600x400")
-        self.db = db
-        self.current_project_id = current_project_id
-        self.on_import_callback = on_import_callback
-        
-        ttk.Label(self, text="1. Seleziona Progetto di Origine:", font=("Arial", 10, "bold")).pack(pady=5)
-        
-        self.combo_proj = ttk.Combobox(self, state="readonly", width=50)
-        self.combo_proj.pack(pady=5)
-        self.combo_proj.bind("<<ComboboxSelected>>", self.load_nps)
-        
-        ttk.Label(self, text="2. Seleziona NP da Copiare:", font=("Arial", 10, "bold")).pack(pady=5)
-        
-        cols = ("codice", "desc")
-        self.tree = ttk.Treeview(self, columns=cols, show="headings", height=10)
-        self.tree.heading("codice", text="Codice")
-        self.tree.heading("desc", text="Descrizione")
-        self.tree.column("codice", width=100)
-        self.tree.column("desc", width=400)
-        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
-        
-        btn_import = ttk.Button(self, text="IMPORTA SELEZIONATO", command=self.do_import)
-        btn_import.pack(pady=10, fill="x", padx=20)
-        
-        self.load_projects()
-
-    def load_projects(self):
-        projs = self.db.fetch_all("progetti")
-        self.proj_map = {}
-        values = []
-        for p in projs:
-            if p[0] != self.current_project_id:
-                label = f"{p[1]} - {p[2]}"
-                values.append(label)
-                self.proj_map[label] = p[0]
-        self.combo_proj['values'] = values
-
-    def load_nps(self, event):
-        for row in self.tree.get_children(): self.tree.delete(row)
-        selected_label = self.combo_proj.get()
-        if not selected_label: return
-        
-        pid = self.proj_map[selected_label]
-        nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (pid,))
-        for np in nps:
-            self.tree.insert("", "end", iid=np[0], values=(np[2], np[3]))
-
-    def do_import(self):
-        sel = self.tree.selection()
-        if not sel:
-            messagebox.showwarning("Attenzione", "Seleziona un NP dalla lista")
-            return
-        
-        source_np_id = sel[0]
-        self.on_import_callback(source_np_id)
-        self.destroy()
-
-# --- CLASSE PER FILTRO STORICO ---
-class HistoryDialog(tk.Toplevel):
-    def __init__(self, parent, db, project_id, callback):
-        super().__init__(parent)
-        self.title("Cerca voce da storico progetto")
-        self.geometry("700x500")
-        self.db = db
-        self.project_id = project_id
-        self.callback = callback
-
-        ttk.Label(self, text="Seleziona una voce utilizzata in altri NP di questo progetto:", font=("Arial", 10, "bold")).pack(pady=10)
-        
-        # Search box
-        search_frame = ttk.Frame(self)
-        search_frame.pack(fill="x", padx=10, pady=5)
-        ttk.Label(search_frame, text="Filtra:").pack(side="left")
-        self.search_var = tk.StringVar()
-        self.search_var.trace("w", self.filter_list)
-        ttk.Entry(search_frame, textvariable=self.search_var).pack(side="left", fill="x", expand=True, padx=5)
-
-        # Treeview
-        cols = ("cat", "desc", "um", "pu")
-        self.tree = ttk.Treeview(self, columns=cols, show="headings")
-        self.tree.heading("cat", text="Categoria")
-        self.tree.heading("desc", text="Descrizione")
-        self.tree.heading("um", text="UM")
-        self.tree.heading("pu", text="Prezzo Unitario")
-        
-        self.tree.column("cat", width=100)
-        self.tree.column("desc", width=350)
-        self.tree.column("um", width=50)
-        self.tree.column("pu", width=80, anchor="e")
-        
-        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
-        
-        self.tree.bind("<Double-1>", self.on_double_click)
-
-        btn_sel = ttk.Button(self, text="Usa Selezionato", command=self.use_selected)
-        btn_sel.pack(pady=10)
-
-        self.all_items = []
-        self.load_data()
-
-    def load_data(self):
-        # Query DISTINCT con TRIM per pulire gli spazi ed eliminare i duplicati "sporchi"
-        query = """
-            SELECT DISTINCT TRIM(v.categoria), TRIM(v.descrizione), TRIM(v.um), v.prezzo_unitario
-            FROM voci_costo v
-            JOIN nuovi_prezzi n ON v.np_id = n.id
-            WHERE n.progetto_id = ?
-            ORDER BY 1, 2
-        """
-        rows = self.db.cursor.execute(query, (self.project_id,)).fetchall()
-        self.all_items = rows
-        self.update_tree(rows)
-
-    def filter_list(self, *args):
-        search_term = self.search_var.get().lower()
-        filtered = [item for item in self.all_items if search_term in item[1].lower() or search_term in item[0].lower()]
-        self.update_tree(filtered)
-
-    def update_tree(self, items):
-        for row in self.tree.get_children(): self.tree.delete(row)
-        for item in items:
-            pu_fmt = f"€ {item[3]:.3f}".replace(".", ",")
-            self.tree.insert("", "end", values=(item[0], item[1], item[2], pu_fmt), tags=(item,))
-
-    def use_selected(self):
-        sel = self.tree.selection()
-        if not sel: return
-        vals = self.tree.item(sel[0])['values']
-        cat = vals[0]
-        desc = vals[1]
-        um = vals[2]
-        
-        pu_str = vals[3].replace("€", "").strip().replace(".", "").replace(",", ".")
-        pu = float(pu_str)
-
-        self.callback(cat, desc, um, pu)
-        self.destroy()
-
-    def on_double_click(self, event):
-        self.use_selected()
-
-# --- PANNELLO CRUD (GESTIONE LAYOUT MULTIPLI) ---
-class CrudPanel(ttk.Frame):
-    def __init__(self, parent, db, table_name, fields, callbacks=None):
-        super().__init__(parent)
-        self.db = db
-        self.table_name = table_name
-        self.fields = fields 
-        self.callbacks = callbacks or {}
-        self.entries = {}
-        self.buttons = {}
-
-        self.frame_top = ttk.LabelFrame(self, text="Dati Inserimento", padding=10)
-        self.frame_top.pack(side="top", fill="x", padx=10, pady=5)
-        
-        if self.table_name == "nuovi_prezzi":
-            self.setup_custom_np_ui()
-        elif self.table_name == "progetti":
-            self.setup_custom_progetti_ui()
-        else:
-            self.setup_generic_ui()
-
-        self.frame_mid = ttk.Frame(self)
-        self.frame_mid.pack(side="top", fill="both", expand=True, padx=10, pady=5)
-
-        cols = [f[0] for f in self.fields]
-        self.tree = ttk.Treeview(self.frame_mid, columns=cols, show="headings")
-        
-        for field, label, width in self.fields:
-            align = "w"
-            if field == "prezzo_finale": align = "e"
-            self.tree.heading(field, text=label, 
-                              command=lambda c=field: self.sort_column(c, False))
-            self.tree.column(field, width=width, anchor=align)
-        
-        self.tree.pack(side="left", fill="both", expand=True)
-        
-        sb = ttk.Scrollbar(self.frame_mid, orient="vertical", command=self.tree.yview)
-        sb.pack(side="left", fill="y")
-        self.tree.configure(yscroll=sb.set)
-
-        self.frame_btns = ttk.Frame(self.frame_mid)
-        self.frame_btns.pack(side="right", fill="y", padx=5)
-
-        self.buttons['add'] = ttk.Button(self.frame_btns, text="Nuovo", command=self.add_record)
-        self.buttons['add'].pack(fill="x", pady=2)
-        self.buttons['upd'] = ttk.Button(self.frame_btns, text="Modifica", command=self.update_record)
-        self.buttons['upd'].pack(fill="x", pady=2)
-        self.buttons['del'] = ttk.Button(self.frame_btns, text="Cancella", command=self.delete_record)
-        self.buttons['del'].pack(fill="x", pady=2)
-        self.buttons['dup'] = ttk.Button(self.frame_btns, text="Duplica", command=self.duplicate_record)
-        self.buttons['dup'].pack(fill="x", pady=2)
-        self.buttons['imp'] = ttk.Button(self.frame_btns, text="Importa da...", command=lambda: print("Implementare Wrapper")) 
-        self.buttons['imp'].pack(fill="x", pady=2)
-        
-        ttk.Separator(self.frame_btns, orient="horizontal").pack(fill="x", pady=5)
-        self.buttons['clr'] = ttk.Button(self.frame_btns, text="Pulisci", command=self.clear_fields)
-        self.buttons['clr'].pack(fill="x", pady=10)
-
-        self.tree.bind("<<TreeviewSelect>>", self.on_select)
-        self.tree.bind("<Double-1>", self.on_double_click)
-        
-        self.refresh_data()
-
-    def setup_generic_ui(self):
-        for i, (field_name, label_text, width) in enumerate(self.fields):
-            if field_name == "prezzo_finale": continue
-            container = ttk.Frame(self.frame_top)
-            container.pack(side="left", padx=5, fill="y")
-            ttk.Label(container, text=label_text, font=("Arial", 9, "bold")).pack(side="top", anchor="w")
-            entry = ttk.Entry(container, width=width // 8) 
-            entry.pack(side="top", fill="x")
-            self.entries[field_name] = entry
-
-    def setup_custom_progetti_ui(self):
-        row1 = ttk.Frame(self.frame_top)
-        row1.pack(side="top", fill="x", pady=2)
-
-        def add_field(parent, key, label, width_factor):
-            f = ttk.Frame(parent)
-            f.pack(side="left", padx=(0, 15), fill="x", expand=False)
-            ttk.Label(f, text=label, font=("Arial", 9, "bold")).pack(anchor="w")
-            e = ttk.Entry(f, width=width_factor)
-            e.pack(fill="x")
-            self.entries[key] = e
-
-        add_field(row1, 'codice', 'Codice', 15)
-        add_field(row1, 'cup', 'CUP', 15)
-        
-        f_comm = ttk.Frame(row1)
-        f_comm.pack(side="left", padx=0, fill="x", expand=True)
-        ttk.Label(f_comm, text="Committente", font=("Arial", 9, "bold")).pack(anchor="w")
-        self.entries['committente'] = ttk.Entry(f_comm)
-        self.entries['committente'].pack(fill="x")
-
-        row2 = ttk.Frame(self.frame_top)
-        row2.pack(side="top", fill="x", pady=5)
-        
-        ttk.Label(row2, text="Titolo Intervento", font=("Arial", 9, "bold")).pack(anchor="w")
-        self.entries['titolo'] = ttk.Entry(row2)
-        self.entries['titolo'].pack(fill="x")
-
-    def setup_custom_np_ui(self):
-        row1 = ttk.Frame(self.frame_top)
-        row1.pack(side="top", fill="x", pady=2)
-        
-        f_cod = ttk.Frame(row1)
-        f_cod.pack(side="left", padx=(0, 20))
-        ttk.Label(f_cod, text="Codice NP", font=("Arial", 9, "bold")).pack(anchor="w")
-        self.entries['codice'] = ttk.Entry(f_cod, width=15)
-        self.entries['codice'].pack(fill="x")
-
-        f_um = ttk.Frame(row1)
-        f_um.pack(side="left")
-        ttk.Label(f_um, text="Unità di Misura", font=("Arial", 9, "bold")).pack(anchor="w")
-        self.entries['unita_misura'] = ttk.Combobox(f_um, width=15, postcommand=self.populate_um_combo)
-        self.entries['unita_misura'].pack(fill="x")
-
-        row2 = ttk.Frame(self.frame_top)
-        row2.pack(side="top", fill="x", pady=5)
-        
-        ttk.Label(row2, text="Descrizione NP", font=("Arial", 9, "bold")).pack(anchor="w")
-        
-        txt_frame = ttk.Frame(row2)
-        txt_frame.pack(fill="x", expand=True)
-        
-        self.entries['descrizione'] = tk.Text(txt_frame, height=4, font=("Arial", 9))
-        self.entries['descrizione'].pack(side="left", fill="x", expand=True)
-        
-        sb = ttk.Scrollbar(txt_frame, orient="vertical", command=self.entries['descrizione'].yview)
-        sb.pack(side="right", fill="y")
-        self.entries['descrizione'].config(yscrollcommand=sb.set)
-
-    def populate_um_combo(self):
-        if 'unita_misura' in self.entries and isinstance(self.entries['unita_misura'], ttk.Combobox):
-            ums = self.db.fetch_all("unita_misura")
-            values = [u[1] for u in ums]
-            self.entries['unita_misura']['values'] = values
-
-    def sort_column(self, col, reverse):
-        l = [(self.tree.set(k, col), k) for k in self.tree.get_children('')]
-        def sort_key(t):
-            val = t[0]
-            if not val: return ""
-            try:
-                clean = str(val).replace('€', '').strip()
-                if '.' in clean and ',' in clean: clean = clean.replace('.', '').replace(',', '.')
-                elif ',' in clean: clean = clean.replace(',', '.')
-                return float(clean)
-            except ValueError:
-                return str(val).lower()
-        l.sort(key=sort_key, reverse=reverse)
-        for index, (val, k) in enumerate(l):
-            self.tree.move(k, '', index)
-        self.tree.heading(col, command=lambda: self.sort_column(col, not reverse))
-
-    def get_data_from_ui(self):
-        data = {}
-        for field, _, _ in self.fields:
-            if field in self.entries:
-                widget = self.entries[field]
-                if isinstance(widget, tk.Text):
-                    val = widget.get("1.0", "end-1c").strip()
-                else:
-                    val = widget.get().strip()
-                data[field] = val
-        return data
-
-    def clear_fields(self):
-        for widget in self.entries.values():
-            if isinstance(widget, tk.Text):
-                widget.delete("1.0", tk.END)
-            else:
-                widget.delete(0, tk.END)
-
-    def refresh_data(self, condition="", params=()):
-        for row in self.tree.get_children(): self.tree.delete(row)
-        target_columns = [f[0] for f in self.fields]
-        rows = self.db.select_specific(self.table_name, target_columns, condition, params)
-        for r in rows:
-            vals = list(r[1:])
-            for idx, f in enumerate(self.fields):
-                if f[0] == "prezzo_finale" and idx < len(vals):
-                     vals[idx] = format_currency(vals[idx] or 0.0)
-            self.tree.insert("", "end", iid=r[0], values=vals)
-
-    def add_record(self):
-        try:
-            data = self.get_data_from_ui()
-            if not any(data.values()): return
-            self.db.insert(self.table_name, data)
-            self.refresh_data() 
-            self.clear_fields()
-        except Exception as e:
-            messagebox.showerror("Errore", str(e))
-
-    def update_record(self):
-        selected = self.tree.selection()
-        if not selected: return
-        try:
-            data = self.get_data_from_ui()
-            self.db.update(self.table_name, selected[0], data)
-            self.refresh_data() 
-        except Exception as e:
-            messagebox.showerror("Errore", str(e))
-
-    def delete_record(self):
-        selected = self.tree.selection()
-        if not selected: return
-        if messagebox.askyesno("Conferma", "Cancellare record?"):
-            self.db.delete(self.table_name, selected[0])
-            self.refresh_data() 
-            self.clear_fields()
-
-    def duplicate_record(self):
-        selected = self.tree.selection()
-        if not selected: return
-        data = self.get_data_from_ui()
-        if 'codice' in data: data['codice'] += "_cp"
-        if 'titolo' in data: data['titolo'] += " (Copia)"
-        try:
-            self.db.insert(self.table_name, data)
-            self.refresh_data() 
-        except Exception as e:
-            messagebox.showerror("Errore", str(e))
-
-    def on_select(self, event):
-        selected = self.tree.selection()
-        if not selected: return
-        item = self.tree.item(selected[0])
-        values = item['values']
-        self.clear_fields()
-        
-        col_idx = 0
-        for field, _, _ in self.fields:
-            if field in self.entries and col_idx < len(values):
-                widget = self.entries[field]
-                val = values[col_idx]
-                
-                if isinstance(widget, tk.Text):
-                    widget.insert("1.0", str(val))
-                elif isinstance(widget, ttk.Combobox):
-                     widget.set(str(val))
-                else:
-                    widget.insert(0, str(val))
-            col_idx += 1
-            
-        if 'on_select' in self.callbacks:
-            self.callbacks['on_select'](selected[0])
-            
-    def on_double_click(self, event):
-        selected = self.tree.selection()
-        if not selected: return
-        if 'on_double_click' in self.callbacks:
-            self.callbacks['on_double_click'](selected[0])
-
-# --- SCHEDA STAMPE (HTML) ---
-class PrintPanel(ttk.Frame):
-    def __init__(self, parent, db):
-        super().__init__(parent)
-        self.db = db
-        self.current_np_id = None
-        self.print_proj_map = {}
-
-        self.lbl_title = ttk.Label(self, text="Stampa Singola NP (HTML)", font=("Arial", 14, "bold"))
-        self.lbl_title.pack(pady=(20, 5))
-        
-        self.info_lbl = ttk.Label(self, text="Seleziona un NP nella Scheda 2 per abilitare la stampa singola.", font=("Arial", 10))
-        self.info_lbl.pack(pady=5)
-        
-        self.btn_print = ttk.Button(self, text="GENERA STAMPA NP SELEZIONATO", command=self.generate_html, width=40)
-        self.btn_print.pack(pady=5, ipady=5)
-
-        ttk.Separator(self, orient="horizontal").pack(fill="x", padx=50, pady=20)
-
-        self.lbl_batch = ttk.Label(self, text="Esportazione Massiva per Intervento", font=("Arial", 14, "bold"))
-        self.lbl_batch.pack(pady=5)
-        
-        ttk.Label(self, text="Seleziona un progetto per generare stampe o esportare in Excel:").pack(pady=5)
-        
-        self.combo_stampa_progetti = ttk.Combobox(self, state="readonly", width=60, postcommand=self.load_projects_for_print)
-        self.combo_stampa_progetti.pack(pady=5)
-        
-        # Frame per affiancare i due pulsanti massivi (HTML e EXCEL)
-        btn_frame = ttk.Frame(self)
-        btn_frame.pack(pady=10)
-        
-        self.btn_print_all = ttk.Button(btn_frame, text="GENERA TUTTI GLI HTML", command=self.generate_batch_html, width=30)
-        self.btn_print_all.pack(side="left", padx=10, ipady=5)
-
-        self.btn_export_excel = ttk.Button(btn_frame, text="ESPORTA PROGETTO IN EXCEL", command=self.generate_excel_export, width=30)
-        self.btn_export_excel.pack(side="left", padx=10, ipady=5)
-
-        self.lbl_status = ttk.Label(self, text="", foreground="green", font=("Arial", 9, "italic"))
-        self.lbl_status.pack(pady=20)
-
-    def set_current_np(self, np_id):
-        self.current_np_id = np_id
-        if np_id:
-            np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,))
-            self.info_lbl.config(text=f"NP Selezionato: {np[2]} - {np[3]}")
-        else:
-            self.info_lbl.config(text="Nessun NP selezionato nella Scheda 2.")
-
-    def load_projects_for_print(self):
-        projs = self.db.fetch_all("progetti")
-        values = []
-        self.print_proj_map = {}
-        for p in projs:
-            label = f"{p[1]} - {p[2]}"
-            values.append(label)
-            self.print_proj_map[label] = p[0]
-        self.combo_stampa_progetti['values'] = values
-
-    def generate_batch_html(self):
-        selected_label = self.combo_stampa_progetti.get()
-        if not selected_label:
-            messagebox.showwarning("Attenzione", "Seleziona un progetto dal menu.")
-            return
-        
-        proj_id = self.print_proj_map[selected_label]
-        nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (proj_id,))
-        
-        if not nps:
-            messagebox.showinfo("Info", "Nessun NP associato a questo progetto.")
-            return
-
-        if messagebox.askyesno("Conferma", f"Verranno generati {len(nps)} file HTML. Continuare?"):
-            original_np_id = self.current_np_id
-            count = 0
-            for np in nps:
-                self.current_np_id = np[0]
-                self.generate_html()
-                count += 1
-            self.current_np_id = original_np_id
-            self.lbl_status.config(text=f"Operazione completata: {count} stampe generate.")
-            messagebox.showinfo("Successo", f"Generati {count} file nella cartella NP_STAMPE.")
-
-    def generate_html(self):
-        if not hasattr(self, 'current_np_id') or not self.current_np_id:
-            messagebox.showerror("Errore", "Nessun NP selezionato.")
-            return
-
-        np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (self.current_np_id,))
-        proj = self.db.fetch_one("progetti", "WHERE id=?", (np[1],))
-        items = self.db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (self.current_np_id,))
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_NP_{np[2]}.html"
-        
-        if getattr(sys, 'frozen', False):
-            current_path = Path(sys.executable).parent
-        else:
-            current_path = Path(__file__).parent.resolve()
-        
-        target_dir_path = current_path.parent / "NP_STAMPE"
-        target_dir_path.mkdir(parents=True, exist_ok=True)
-        full_path = str(target_dir_path / filename)
-
-        css = """
-        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; padding: 10px; color: #333; max-width: 900px; margin: auto; }
-        h1 { color: #0055aa; border-bottom: 2px solid #0055aa; padding-bottom: 10px; font-size: 24px; }
-        h2 { background-color: #f2f2f2; padding: 5px; margin-top: 30px; border-left: 5px solid #0055aa; font-size: 18px; }
-        .header-box { background: #eef; padding: 10px; border-radius: 5px; margin-bottom: 20px; border: 1px solid #ccd; }
-        table { width: 100%; border-collapse: collapse; margin-bottom: 20px; font-size: 14px; }
-        th, td { border: 1px solid #ddd; padding: 3px; text-align: left; }
-        th { background-color: #0055aa; color: white; text-transform: uppercase; font-size: 12px; }
-        .num { text-align: right; }
-        .footer { font-size: 0.8em; color: #777; margin-top: 40px; text-align: center; border-top: 1px solid #ddd; padding-top: 10px; }
-        .small-note { font-size: 0.85em; color: #666; margin-top: 2px; display: block; }
-        """
-
-        html = f"""
-        <!DOCTYPE html>
-        <html lang="it">
-        <head>
-            <meta charset="UTF-8">
-            <title>Analisi Prezzo {np[2]}</title>
-            <style>{css}</style>
-        </head>
-        <body>
-            <h1>ANALISI NUOVO PREZZO: {np[2]}</h1>
-            <div class="header-box">
-                <table style="width: 100%; border-collapse: collapse; border: none;">
-                    <tr>
-                        <td colspan="2" style="border: none; padding: 2px 0;">
-                            <strong>Descrizione:</strong> {np[3]}
-                        </td>
-                    </tr>
-                    <tr><td colspan="2" style="border: none;"></td></tr>
-                    <tr style="font-size: 1.1em;">
-                        <td style="border: none; text-align: left; padding: 0; width: 50%;">
-                            <strong>Unità di Misura: {np[4]}</strong>
-                        </td>
-                        <td style="border: none; text-align: right; padding: 0; width: 50%;">
-                            <strong>Prezzo d'applicazione: {format_currency(np[8])}</strong>
-                        </td>
-                    </tr>
-                </table>
-            </div>
-            <h2>Dettaglio Voci Costitutive</h2>
-            <table>
-                <thead>
-                    <tr>
-                        <th width="5%">N.</th>
-                        <th>Descrizione</th>
-                        <th width="5%">U.M.</th>
-                        <th width="10%">Quantità</th>
-                        <th width="15%">P. Unitario</th>
-                        <th width="15%">Totale</th>
-                    </tr>
-                </thead>
-                <tbody>
-        """
-        
-        current_cat = ""
-        tot_a = 0.0
-        tot_manodopera = 0.0
-
-        for item in items:
-            cat, desc, um, q, pu = item[3], item[4], item[5], item[6], item[7]
-            tot = q * pu
-            tot_a += tot
-            
-            if "Manodopera" in cat:
-                tot_manodopera += tot
-
-            if cat != current_cat:
-                html += f"""<tr><td colspan="6" style="background-color:#e0e0e0; font-weight:bold; color:#333; padding-left: 10px;">{cat.upper()}</td></tr>"""
-                current_cat = cat
-
-            html += f"""
-                <tr>
-                    <td></td>
-                    <td>{desc}</td>
-                    <td>{um}</td>
-                    <td class="num">{q:.3f}</td>
-                    <td class="num">€ {pu:.3f}</td>
-                    <td class="num">€ {tot:.2f}</td>
-                </tr>
-            """
-
-        sg_val = tot_a * (np[5]/100)
-        sic_val = sg_val * (np[6]/100)
-        utili_val = (tot_a + sg_val) * (np[7]/100)
-        perc_man = (tot_manodopera / np[8] * 100) if np[8] > 0 else 0
-        perc_sic = (sic_val / np[8] * 100) if np[8] > 0 else 0
-
-        html += f"""
-                </tbody>
-            </table>
-
-            <h2>Riepilogo economico</h2>
-            <table style="width: 100%; border: 2px solid #ddd;">
-                <tr>
-                    <td>(A) Sommano</td>
-                    <td class="num">{format_currency(tot_a)}</td>
-                </tr>
-                <tr>
-                    <td style="white-space: nowrap;">
-                        (B) Spese Generali = {np[5]}% di A <span class="small-note" style="display: inline !important;"> - compresi oneri di sicurezza afferenti all'impresa per euro {format_currency(sic_val)} = {np[6]}% di B</span>
-                    </td>
-                    <td class="num">{format_currency(sg_val)}</td>
-                </tr>
-                <tr>
-                    <td>(C) Utile d'Impresa = {np[7]}% di (A + B)</td>
-                    <td class="num">{format_currency(utili_val)}</td>
-                </tr>
-                <tr style="background-color: #dbeeff;">
-                    <td style="font-weight: bold;">(D) TOTALE (A + B + C)</td>
-                    <td class="num" style="font-weight: bold;">{format_currency(np[8])}</td>
-                </tr>
-            </table>
-
-            <h2>Riepilogo incidenze</h2>
-            <table style="width: 100%; border: 1px solid #ddd;">
-                <tr>
-                    <td>Incidenza Manodopera sul totale</td>
-                    <td class="num"> {perc_man:.2f}%</td>
-                    <td class="num">{format_currency(tot_manodopera)}</td>
-                </tr>
-                <tr>
-                    <td>Incidenza Oneri di Sicurezza sul totale</td>
-                    <td class="num">{perc_sic:.2f}%</td>
-                    <td class="num">{format_currency(sic_val)}</td>
-                </tr>
-            </table>
-
-            <div class="footer">Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}</div>
-        </body>
-        </html>
-        """
-
-        with open(full_path, "w", encoding="utf-8") as f:
-            f.write(html)
-        
-        self.lbl_status.config(text=f"Stampa salvata in:\n{full_path}")
-        try:
-            if os.name == 'nt': os.startfile(full_path)
-            else: os.system(f"open '{full_path}'")
-        except:
-            pass
-
-# --- AGGIUNGI QUESTO NUOVO METODO ALLA FINE DELLA CLASSE PrintPanel ---
-    def generate_excel_export(self):
-        selected_label = self.combo_stampa_progetti.get()
-        if not selected_label:
-            messagebox.showwarning("Attenzione", "Seleziona un progetto dal menu.")
-            return
-        
-        proj_id = self.print_proj_map[selected_label]
-        proj = self.db.fetch_one("progetti", "WHERE id=?", (proj_id,))
-        nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (proj_id,))
-        
-        if not nps:
-            messagebox.showinfo("Info", "Nessun NP associato a questo progetto.")
-            return
-
-        try:
-            import openpyxl
-            from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-        except ImportError:
-            messagebox.showerror("Errore", "Libreria 'openpyxl' mancante.\nAssicurati di averla installata.")
-            return
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        # Puliamo il nome del progetto da caratteri non validi per il nome file
-        safe_proj_name = "".join([c for c in proj[2] if c.isalnum() or c in (' ', '_')]).rstrip()
-        filename = f"{safe_proj_name}_{timestamp}.xlsx"
-        
-        if getattr(sys, 'frozen', False):
-            current_path = Path(sys.executable).parent
-        else:
-            current_path = Path(__file__).parent.resolve()
-        
-        target_dir_path = current_path.parent / "NP_EXPORT"
-        target_dir_path.mkdir(parents=True, exist_ok=True)
-        full_path = str(target_dir_path / filename)
-
-        wb = openpyxl.Workbook()
-        wb.remove(wb.active) # Rimuove il foglio di default vuoto
-
-        # Definizione Stili Excel
-        header_font = Font(bold=True, size=14, color="0055AA")
-        bold_font = Font(bold=True)
-        white_bold_font = Font(bold=True, color="FFFFFF")
-        fill_blue = PatternFill(start_color="0055AA", end_color="0055AA", fill_type="solid")
-        fill_light_grey = PatternFill(start_color="F2F2F2", end_color="F2F2F2", fill_type="solid")
-        fill_grey = PatternFill(start_color="E0E0E0", end_color="E0E0E0", fill_type="solid")
-        border_thin = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        align_center = Alignment(horizontal="center", vertical="center")
-        align_right = Alignment(horizontal="right", vertical="center")
-
-        for np in nps:
-            # Crea un nome foglio valido per Excel (max 31 caratteri e senza simboli strani)
-            sheet_name = str(np[2])[:31] 
-            for char in ['*', ':', '?', '/', '\\', '[', ']']:
-                sheet_name = sheet_name.replace(char, '')
-            ws = wb.create_sheet(title=sheet_name)
-
-            # Dimensioni colonne
-            ws.column_dimensions['A'].width = 5
-            ws.column_dimensions['B'].width = 50
-            ws.column_dimensions['C'].width = 8
-            ws.column_dimensions['D'].width = 12
-            ws.column_dimensions['E'].width = 15
-            ws.column_dimensions['F'].width = 15
-
-            # Intestazione NP
-            ws.merge_cells('A1:F1')
-            ws['A1'] = f"ANALISI NUOVO PREZZO: {np[2]}"
-            ws['A1'].font = header_font
-            
-            ws.merge_cells('A3:F3')
-            ws['A3'] = f"Descrizione: {np[3]}"
-            ws['A3'].font = bold_font
-            ws['A3'].alignment = Alignment(wrap_text=True, vertical="center")
-            ws.row_dimensions[3].height = 40
-
-            ws.merge_cells('A5:C5')
-            ws['A5'] = f"Unità di Misura: {np[4]}"
-            ws['A5'].font = bold_font
-
-            ws.merge_cells('D5:F5')
-            ws['D5'] = f"Prezzo d'applicazione: {format_currency(np[8])}"
-            ws['D5'].font = bold_font
-            ws['D5'].alignment = align_right
-
-            # Intestazioni Tabella Voci di Costo
-            row_num = 7
-            headers = ["N.", "Descrizione", "U.M.", "Quantità", "P. Unitario", "Totale"]
-            for col_num, header in enumerate(headers, 1):
-                cell = ws.cell(row=row_num, column=col_num, value=header)
-                cell.font = white_bold_font
-                cell.fill = fill_blue
-                cell.alignment = align_center
-                cell.border = border_thin
-
-            row_num += 1
-            
-            items = self.db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (np[0],))
-            current_cat = ""
-            tot_a = 0.0
-            tot_manodopera = 0.0
-
-            for item in items:
-                cat, desc, um, q, pu = item[3], item[4], item[5], item[6], item[7]
-                tot = q * pu
-                tot_a += tot
-                
-                if "Manodopera" in cat:
-                    tot_manodopera += tot
-
-                if cat != current_cat:
-                    ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
-                    cell = ws.cell(row=row_num, column=1, value=cat.upper())
-                    cell.font = bold_font
-                    cell.fill = fill_grey
-                    cell.border = border_thin
-                    for c in range(2, 7):
-                        ws.cell(row=row_num, column=c).border = border_thin
-                    row_num += 1
-                    current_cat = cat
-
-                # Scrittura Riga Voce
-                ws.cell(row=row_num, column=1, value="").border = border_thin
-                ws.cell(row=row_num, column=2, value=desc).border = border_thin
-                
-                c_um = ws.cell(row=row_num, column=3, value=um)
-                c_um.alignment = align_center
-                c_um.border = border_thin
-                
-                c_q = ws.cell(row=row_num, column=4, value=q)
-                c_q.number_format = '#,##0.000'
-                c_q.border = border_thin
-                
-                c_pu = ws.cell(row=row_num, column=5, value=pu)
-                c_pu.number_format = '€ #,##0.000'
-                c_pu.border = border_thin
-                
-                c_tot = ws.cell(row=row_num, column=6, value=tot)
-                c_tot.number_format = '€ #,##0.00'
-                c_tot.border = border_thin
-                
-                row_num += 1
-
-            # Riepilogo Economico
-            row_num += 2
-            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
-            cell = ws.cell(row=row_num, column=1, value="Riepilogo economico")
-            cell.font = bold_font
-            cell.fill = fill_light_grey
-            row_num += 1
-
-            sg_val = tot_a * (np[5]/100)
-            sic_val = sg_val * (np[6]/100)
-            utili_val = (tot_a + sg_val) * (np[7]/100)
-            
-            perc_man = (tot_manodopera / np[8] * 100) if np[8] > 0 else 0
-            perc_sic = (sic_val / np[8] * 100) if np[8] > 0 else 0
-
-            def add_summary_row(r_idx, test_left, val_right, bold=False):
-                ws.merge_cells(start_row=r_idx, start_column=1, end_row=r_idx, end_column=5)
-                c_l = ws.cell(row=r_idx, column=1, value=test_left)
-                c_r = ws.cell(row=r_idx, column=6, value=val_right)
-                c_r.number_format = '€ #,##0.00'
-                if bold:
-                    c_l.font = bold_font
-                    c_r.font = bold_font
-                return r_idx + 1
-
-            row_num = add_summary_row(row_num, "(A) Sommano", tot_a)
-            row_num = add_summary_row(row_num, f"(B) Spese Generali = {np[5]}% di A (compresi oneri sicurezza € {sic_val:.2f} = {np[6]}% di B)", sg_val)
-            row_num = add_summary_row(row_num, f"(C) Utile d'Impresa = {np[7]}% di (A + B)", utili_val)
-            row_num = add_summary_row(row_num, "(D) TOTALE (A + B + C)", np[8], bold=True)
-
-            row_num += 1
-            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
-            cell = ws.cell(row=row_num, column=1, value="Riepilogo incidenze")
-            cell.font = bold_font
-            cell.fill = fill_light_grey
-            row_num += 1
-
-            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=4)
-            ws.cell(row=row_num, column=1, value="Incidenza Manodopera sul totale")
-            ws.cell(row=row_num, column=5, value=f"{perc_man:.2f}%").alignment = align_right
-            c_m = ws.cell(row=row_num, column=6, value=tot_manodopera)
-            c_m.number_format = '€ #,##0.00'
-            row_num += 1
-
-            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=4)
-            ws.cell(row=row_num, column=1, value="Incidenza Oneri di Sicurezza sul totale")
-            ws.cell(row=row_num, column=5, value=f"{perc_sic:.2f}%").alignment = align_right
-            c_s = ws.cell(row=row_num, column=6, value=sic_val)
-            c_s.number_format = '€ #,##0.00'
-
-        wb.save(full_path)
-        self.lbl_status.config(text=f"Export Excel completato:\n{full_path}")
-        messagebox.showinfo("Successo", f"File Excel generato con successo nella cartella:\nNP_EXPORT")
-        
-        # Apri la cartella al termine dell'operazione
-        try:
-            if os.name == 'nt': os.startfile(target_dir_path)
-            else: os.system(f"open '{target_dir_path}'")
-        except:
-            pass
-
-# --- APP PRINCIPALE ---
-class NPApp(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("Gestione Nuovi Prezzi (NP)")
-        self.geometry("1100x800")
-        
-        self.db = Database()
-        
-        self.notebook = ttk.Notebook(self)
-        self.notebook.pack(fill="both", expand=True)
-        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_change)
-
-        # TAB 1: PROGETTI
-        self.tab_progetti = CrudPanel(
-            self.notebook, self.db, "progetti", 
-            [("codice", "Codice", 100), ("titolo", "Titolo Intervento", 300), ("cup", "CUP", 100), ("committente", "Committente", 200)],
-            callbacks={'on_select': self.on_project_select, 'on_double_click': self.goto_tab_np}
-        )
-        self.notebook.add(self.tab_progetti, text="1. Progetti")
-
-        # TAB 2: ELENCO NP
-        self.frame_tab2 = ttk.Frame(self.notebook) 
-        self.notebook.add(self.frame_tab2, text="2. Elenco NP")
-        
-        self.lbl_project_title = ttk.Label(self.frame_tab2, text="Nessun Progetto Selezionato", font=("Arial", 12, "bold"), foreground="#444", padding=10)
-        self.lbl_project_title.pack(side="top", fill="x")
-
-        self.current_project_id = None
-        fields_np = [
-            ("codice", "Codice NP", 100), 
-            ("descrizione", "Descrizione NP", 400), 
-            ("unita_misura", "Unità di Misura", 100),
-            ("prezzo_finale", "Prezzo Finale", 120)
-        ]
-        
-        self.tab_np = CrudPanel(
-            self.frame_tab2, self.db, "nuovi_prezzi",
-            fields_np,
-            callbacks={'on_select': self.on_np_select, 'on_double_click': self.goto_tab_details}
-        )
-        self.tab_np.pack(fill="both", expand=True)
-        
-        def add_np_wrapper():
-            if not self.current_project_id:
-                messagebox.showwarning("Attenzione", "Seleziona prima un Progetto dalla Scheda 1")
-                return
-            data = self.tab_np.get_data_from_ui()
-            data['progetto_id'] = self.current_project_id
-            data['perc_spese_generali'] = 17.0
-            data['perc_sicurezza'] = 5.0
-            data['perc_utili'] = 10.0
-            data['prezzo_finale'] = 0.0
-            try:
-                self.db.insert("nuovi_prezzi", data)
-                self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
-                self.tab_np.clear_fields()
-            except Exception as e:
-                messagebox.showerror("Errore", str(e))
-        
-        def duplicate_np_deep_wrapper():
-            self._copy_np_logic(is_import=False)
-
-        def import_np_wrapper():
-            if not self.current_project_id:
-                messagebox.showwarning("Attenzione", "Seleziona prima un Progetto di destinazione")
-                return
-            ImportDialog(self, self.db, self.current_project_id, self._import_np_callback)
-
-        def update_np_wrapper():
-            self.tab_np.__class__.update_record(self.tab_np)
-            if self.current_project_id: self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
-
-        def delete_np_wrapper():
-            self.tab_np.__class__.delete_record(self.tab_np)
-            if self.current_project_id: self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
-
-        self.tab_np.buttons['add'].config(command=add_np_wrapper)
-        self.tab_np.buttons['upd'].config(command=update_np_wrapper)
-        self.tab_np.buttons['del'].config(command=delete_np_wrapper)
-        self.tab_np.buttons['dup'].config(command=duplicate_np_deep_wrapper)
-        self.tab_np.buttons['imp'].config(command=import_np_wrapper)
-
-        # TAB 3: MODIFICA NP
-        self.frame_det_np = ttk.Frame(self.notebook)
-        self.notebook.add(self.frame_det_np, text="3. Modifica NP")
-        self.setup_details_tab()
-
-        # TAB 4: AMMINISTRAZIONE
-        self.tab_admin = CrudPanel(
-            self.notebook, self.db, "unita_misura",
-            [("codice", "Codice", 80), ("nome", "Unità", 150), ("descrizione", "Utilizzo", 400)]
-        )
-        self.notebook.add(self.tab_admin, text="4. Unità di Misura")
-        
-        # --- FUNZIONI EXPORT/IMPORT CSV (TAB 4) ---
-        def export_um_csv():
-            path = filedialog.asksaveasfilename(
-                title="Esporta Unità di Misura",
-                defaultextension=".csv",
-                filetypes=[("File CSV", "*.csv")]
-            )
-            if not path: return
-            try:
-                rows = self.db.fetch_all("unita_misura")
-                with open(path, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f, delimiter=';')
-                    writer.writerow(["CODICE", "NOME", "DESCRIZIONE"])
-                    for r in rows:
-                        writer.writerow([r[1], r[2], r[3]])
-                messagebox.showinfo("Export", "Esportazione CSV completata con successo!")
-            except Exception as e:
-                messagebox.showerror("Errore Export", str(e))
-
-        def import_um_csv():
-            path = filedialog.askopenfilename(
-                title="Importa Unità di Misura",
-                filetypes=[("File CSV", "*.csv")]
-            )
-            if not path: return
-            try:
-                count = 0
-                with open(path, newline='', encoding='utf-8') as f:
-                    sample = f.read(1024)
-                    f.seek(0)
-                    sniffer = csv.Sniffer()
-                    try:
-                        dialect = sniffer.sniff(sample, delimiters=";,")
-                    except:
-                        dialect = 'excel' 
-
-                    reader = csv.reader(f, dialect)
-                    try:
-                        header = next(reader)
-                    except StopIteration:
-                        return 
-
-                    for row in reader:
-                        if len(row) < 2: continue 
-                        cod = row[0].strip()
-                        nom = row[1].strip()
-                        des = row[2].strip() if len(row) > 2 else ""
-                        existing = self.db.fetch_one("unita_misura", "WHERE codice=?", (cod,))
-                        if not existing:
-                            self.db.insert("unita_misura", {'codice': cod, 'nome': nom, 'descrizione': des})
-                            count += 1
-                
-                self.tab_admin.refresh_data()
-                messagebox.showinfo("Import", f"Importazione completata.\nInseriti {count} nuovi record.")
-            except Exception as e:
-                messagebox.showerror("Errore Import", f"Errore lettura CSV:\n{str(e)}\n\nAssicurati che il formato sia: Codice;Nome;Descrizione")
-
-        ttk.Separator(self.tab_admin.frame_btns, orient="horizontal").pack(fill="x", pady=5)
-        btn_exp = ttk.Button(self.tab_admin.frame_btns, text="Esporta CSV", command=export_um_csv)
-        btn_exp.pack(fill="x", pady=2)
-        btn_imp = ttk.Button(self.tab_admin.frame_btns, text="Importa CSV", command=import_um_csv)
-        btn_imp.pack(fill="x", pady=2)
-
-        # TAB 5: STAMPE
-        self.tab_print = PrintPanel(self.notebook, self.db)
-        self.notebook.add(self.tab_print, text="5. Stampe")
-
-        # --- TAB 6: CONVERTITORE PDF ---
-        self.tab_converter = ConverterPanel(self.notebook)
-        self.notebook.add(self.tab_converter, text="6. Convertitore PDF")
-
-    # --- LOGICA DI COPIA ---
-    def _import_np_callback(self, source_np_id):
-        self._copy_np_logic(is_import=True, source_id_override=source_np_id)
-
-    def _copy_np_logic(self, is_import=False, source_id_override=None):
-        if not self.current_project_id: return
-        
-        if is_import:
-            source_id = source_id_override
-        else:
-            selected = self.tab_np.tree.selection()
-            if not selected: return
-            source_id = selected[0]
-            
-        src_rec = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (source_id,))
-        
-        data = {
-            'progetto_id': self.current_project_id,
-            'codice': src_rec[2] + ("_imp" if is_import else "_cp"),
-            'descrizione': src_rec[3] + (" (Import)" if is_import else " (Copia)"),
-            'unita_misura': src_rec[4],
-            'perc_spese_generali': src_rec[5],
-            'perc_sicurezza': src_rec[6],
-            'perc_utili': src_rec[7],
-            'prezzo_finale': src_rec[8]
-        }
-
-        try:
-            new_np_id = self.db.insert("nuovi_prezzi", data)
-            items = self.db.fetch_all("voci_costo", "WHERE np_id=?", (source_id,))
-            for item in items:
-                new_item_data = {
-                    'np_id': new_np_id,
-                    'ordine': item[2],
-                    'categoria': item[3],
-                    'descrizione': item[4],
-                    'um': item[5],
-                    'quantita': item[6],
-                    'prezzo_unitario': item[7]
-                }
-                self.db.insert("voci_costo", new_item_data)
-            
-            if self.notebook.index("current") == 1:
-                self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
-            messagebox.showinfo("Successo", "NP copiato con successo!")
-        except Exception as e:
-            messagebox.showerror("Errore Copia", str(e))
-
-    # --- EVENT HANDLERS ---
-    def on_tab_change(self, event):
-        idx = self.notebook.index("current")
-        if idx == 1 and self.current_project_id:
-            self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
-        elif idx == 4:
-            current_np = self.current_np_id if hasattr(self, 'current_np_id') else None
-            self.tab_print.set_current_np(current_np)
-        elif idx == 5: 
-            self.tab_converter.refresh_file_list()
-
-    def on_project_select(self, project_id):
-        self.current_project_id = project_id
-        proj = self.db.fetch_one("progetti", "WHERE id=?", (project_id,))
-        if proj:
-            self.lbl_project_title.config(text=f"Progetto Attivo: {proj[2]} (Cod: {proj[1]})")
-        
-        self.tab_np.refresh_data("WHERE progetto_id=?", (project_id,))
-        self.current_np_id = None
-        self.clear_details_view()
-
-    def goto_tab_np(self, project_id):
-        self.on_project_select(project_id)
-        self.notebook.select(self.frame_tab2)
-
-    def on_np_select(self, np_id):
-        self.current_np_id = np_id
-        self.refresh_details_tree()
-
-    def goto_tab_details(self, np_id):
-        self.on_np_select(np_id)
-        self.notebook.select(self.frame_det_np)
-
-    # --- LOGICA TAB 3 ---
-    def setup_details_tab(self):
-        self.lbl_np_details = ttk.Label(self.frame_det_np, text="Nessun NP Selezionato", font=("Arial", 12, "bold"), foreground="#0055aa", padding=10)
-        self.lbl_np_details.pack(side="top", fill="x")
-
-        # Input Frame
-        self.det_input_frame = ttk.LabelFrame(self.frame_det_np, text="Voce di Costo", padding=10)
-        self.det_input_frame.pack(side="top", fill="x", padx=10, pady=5)
-
-        # --- RIGA 1: Intestazioni ---
-        ttk.Label(self.det_input_frame, text="N. Ordine", font=("Arial", 9, "bold")).grid(row=0, column=0, sticky="w", padx=5)
-        ttk.Label(self.det_input_frame, text="Categoria", font=("Arial", 9, "bold")).grid(row=0, column=1, sticky="w", padx=5)
-        ttk.Label(self.det_input_frame, text="Descrizione", font=("Arial", 9, "bold")).grid(row=0, column=2, sticky="w", padx=5)
-
-        # --- RIGA 2: Input Parte Alta ---
-        # Ordine
-        self.entry_order = ttk.Entry(self.det_input_frame, width=8)
-        self.entry_order.grid(row=1, column=0, sticky="nw", padx=5, pady=(0, 10))
-
-        # Categoria (MODIFICATA: Solo Manodopera, Prodotti, Attrezzature)
-        self.combo_cat = ttk.Combobox(self.det_input_frame, values=["Manodopera", "Prodotti", "Attrezzature"], state="readonly", width=18)
-        self.combo_cat.grid(row=1, column=1, sticky="nw", padx=5, pady=(0, 10))
-        self.combo_cat.current(0)
-
-        # Descrizione (Frame Contenitore per Text + Scrollbar)
-        desc_frame = ttk.Frame(self.det_input_frame)
-        desc_frame.grid(row=1, column=2, sticky="ew", padx=5, pady=(0, 10))
-        
-        self.txt_desc = tk.Text(desc_frame, height=2, width=30, font=("Arial", 9))
-        self.txt_desc.pack(side="left", fill="both", expand=True)
-        
-        sb_desc = ttk.Scrollbar(desc_frame, orient="vertical", command=self.txt_desc.yview)
-        sb_desc.pack(side="right", fill="y")
-        self.txt_desc.config(yscrollcommand=sb_desc.set)
-        
-        self.det_input_frame.columnconfigure(2, weight=1)
-
-        # --- RIGA 3: Intestazioni Parte Bassa ---
-        ttk.Label(self.det_input_frame, text="UM", font=("Arial", 9, "bold")).grid(row=2, column=0, sticky="w", padx=5)
-        ttk.Label(self.det_input_frame, text="Quantità", font=("Arial", 9, "bold")).grid(row=2, column=1, sticky="w", padx=5)
-        ttk.Label(self.det_input_frame, text="Prezzo Unitario", font=("Arial", 9, "bold")).grid(row=2, column=2, sticky="w", padx=5)
-
-        # --- RIGA 4: Input Parte Bassa ---
-        self.combo_um = ttk.Combobox(self.det_input_frame, width=12, postcommand=self.populate_um_combo) 
-        self.combo_um.grid(row=3, column=0, sticky="w", padx=5, pady=(0, 5))
-
-        self.entry_q = ttk.Entry(self.det_input_frame, width=12)
-        self.entry_q.grid(row=3, column=1, sticky="w", padx=5, pady=(0, 5))
-
-        self.entry_pu = ttk.Entry(self.det_input_frame, width=12)
-        self.entry_pu.grid(row=3, column=2, sticky="w", padx=5, pady=(0, 5))
-
-        # Content Frame
-        content_frame = ttk.Frame(self.frame_det_np)
-        content_frame.pack(side="top", fill="both", expand=True, padx=10, pady=5)
-
-        cols = ("ordine", "cat", "desc", "um", "q", "pu", "totale")
-        self.tree_det = ttk.Treeview(content_frame, columns=cols, show="headings")
-        headers = ["N.", "Categoria", "Descrizione", "UM", "Q", "PU", "Totale"]
-        widths = [40, 100, 300, 50, 80, 80, 100]
-        
-        # Setup Ordinamento Tab 3
-        for c, h, w in zip(cols, headers, widths):
-            align = "w"
-            if c in ("ordine", "q", "pu", "totale"): align = "e"
-            self.tree_det.heading(c, text=h, command=lambda _c=c: self.sort_det_column(_c, False))
-            self.tree_det.column(c, width=w, anchor=align)
-        
-        self.tree_det.pack(side="left", fill="both", expand=True)
-        sb = ttk.Scrollbar(content_frame, orient="vertical", command=self.tree_det.yview)
-        sb.pack(side="left", fill="y")
-        self.tree_det.configure(yscroll=sb.set)
-
-        btn_frame = ttk.Frame(content_frame)
-        btn_frame.pack(side="right", fill="y", padx=5)
-        ttk.Button(btn_frame, text="Aggiungi", command=self.add_cost_item).pack(fill="x", pady=2)
-        ttk.Button(btn_frame, text="Aggiorna", command=self.update_cost_item).pack(fill="x", pady=2)
-        ttk.Button(btn_frame, text="Elimina", command=self.delete_cost_item).pack(fill="x", pady=2)
-        ttk.Button(btn_frame, text="Pulisci", command=self.clear_details_inputs).pack(fill="x", pady=10)
-        
-        # --- PULSANTE NUOVO: CERCA DA STORICO ---
-        ttk.Separator(btn_frame, orient="horizontal").pack(fill="x", pady=5)
-        ttk.Button(btn_frame, text="Cerca da Storico", command=self.open_history_dialog).pack(fill="x", pady=2)
-
-        self.tree_det.bind("<<TreeviewSelect>>", self.on_det_select)
-
-        # RIEPILOGO ECONOMICO
-        self.frame_summary = ttk.LabelFrame(self.frame_det_np, text="Riepilogo Economico", padding=15)
-        self.frame_summary.pack(side="bottom", fill="x", padx=10, pady=10)
-        
-        self.frame_summary.columnconfigure(0, weight=0)
-        self.frame_summary.columnconfigure(1, weight=0) 
-        self.frame_summary.columnconfigure(2, weight=0)
-        self.frame_summary.columnconfigure(3, weight=1)
-
-        ttk.Label(self.frame_summary, text="(A) Totale Voci Elementari:", font=("Arial", 10)).grid(row=0, column=0, columnspan=3, sticky="e", padx=5, pady=2)
-        self.lbl_sum_a = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 10))
-        self.lbl_sum_a.grid(row=0, column=3, sticky="e", padx=5, pady=2)
-
-        ttk.Label(self.frame_summary, text="Spese Generali:", font=("Arial", 10)).grid(row=1, column=0, sticky="e", padx=5, pady=2)
-        self.entry_perc_spese = ttk.Entry(self.frame_summary, width=6, justify="right")
-        self.entry_perc_spese.grid(row=1, column=1, sticky="w", pady=2)
-        self.entry_perc_spese.bind("<Return>", lambda e: self.recalculate_totals())
-        self.entry_perc_spese.bind("<FocusOut>", lambda e: self.recalculate_totals())
-        ttk.Label(self.frame_summary, text="%").grid(row=1, column=2, sticky="w")
-        self.lbl_sum_b = ttk.Label(self.frame_summary, text="€ 0.00 (B)", font=("Arial", 10))
-        self.lbl_sum_b.grid(row=1, column=3, sticky="e", padx=5, pady=2)
-
-        ttk.Label(self.frame_summary, text="↳ di cui Sicurezza (inclusa):", font=("Arial", 9), foreground="#555").grid(row=2, column=0, sticky="e", padx=5, pady=0)
-        self.entry_perc_sicurezza = ttk.Entry(self.frame_summary, width=6, justify="right")
-        self.entry_perc_sicurezza.grid(row=2, column=1, sticky="w", pady=0)
-        self.entry_perc_sicurezza.bind("<Return>", lambda e: self.recalculate_totals())
-        self.entry_perc_sicurezza.bind("<FocusOut>", lambda e: self.recalculate_totals())
-        ttk.Label(self.frame_summary, text="%", foreground="#555").grid(row=2, column=2, sticky="w")
-        self.lbl_val_sicurezza = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 9), foreground="#555")
-        self.lbl_val_sicurezza.grid(row=2, column=3, sticky="e", padx=5, pady=0)
-
-        ttk.Label(self.frame_summary, text="Utili d'Impresa:", font=("Arial", 10)).grid(row=3, column=0, sticky="e", padx=5, pady=2)
-        self.entry_perc_utili = ttk.Entry(self.frame_summary, width=6, justify="right")
-        self.entry_perc_utili.grid(row=3, column=1, sticky="w", pady=2)
-        self.entry_perc_utili.bind("<Return>", lambda e: self.recalculate_totals())
-        self.entry_perc_utili.bind("<FocusOut>", lambda e: self.recalculate_totals())
-        ttk.Label(self.frame_summary, text="%").grid(row=3, column=2, sticky="w")
-        self.lbl_sum_c = ttk.Label(self.frame_summary, text="€ 0.00 (C)", font=("Arial", 10))
-        self.lbl_sum_c.grid(row=3, column=3, sticky="e", padx=5, pady=2)
-
-        ttk.Separator(self.frame_summary, orient="horizontal").grid(row=4, column=0, columnspan=4, sticky="ew", pady=10)
-
-        ttk.Label(self.frame_summary, text="TOTALE COMPLESSIVO NP:", font=("Arial", 12, "bold")).grid(row=5, column=0, columnspan=3, sticky="e", padx=5)
-        self.lbl_total_final = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 13, "bold"), foreground="#0055aa")
-        self.lbl_total_final.grid(row=5, column=3, sticky="e", padx=5)
-
-        self.lbl_incidences = ttk.Label(self.frame_summary, text="", font=("Arial", 8), foreground="#777")
-        self.lbl_incidences.grid(row=6, column=0, columnspan=4, sticky="w", pady=(5,0))
-
-    def sort_det_column(self, col, reverse):
-        # Ordinamento Tab 3 con rilevamento tipo dato
-        l = [(self.tree_det.set(k, col), k) for k in self.tree_det.get_children('')]
-        
-        def det_sort_key(t):
-            val = t[0]
-            if not val: return ""
-            try:
-                # Gestione numeri formattati es. "1.000,00" o "100"
-                clean = str(val).replace('€', '').strip()
-                if '.' in clean and ',' in clean: clean = clean.replace('.', '').replace(',', '.')
-                elif ',' in clean: clean = clean.replace(',', '.')
-                return float(clean)
-            except ValueError:
-                return str(val).lower()
-
-        l.sort(key=det_sort_key, reverse=reverse)
-        for index, (val, k) in enumerate(l):
-            self.tree_det.move(k, '', index)
-        self.tree_det.heading(col, command=lambda: self.sort_det_column(col, not reverse))
-
-    def populate_um_combo(self):
-        ums = self.db.fetch_all("unita_misura")
-        values = [u[1] for u in ums]
-        self.combo_um['values'] = values
-
-    def clear_details_inputs(self):
-        self.entry_order.delete(0, tk.END)
-        # Svuota il widget Text
-        self.txt_desc.delete("1.0", tk.END)
-        self.entry_q.delete(0, tk.END)
-        self.entry_pu.delete(0, tk.END)
-        self.combo_cat.current(0)
-        self.combo_um.set('')
-        if self.current_np_id:
-            max_ord = self.db.get_max_order(self.current_np_id)
-            self.entry_order.insert(0, str(max_ord + 1))
-
-    def clear_details_view(self):
-        for row in self.tree_det.get_children(): self.tree_det.delete(row)
-        self.lbl_sum_a.config(text="€ 0.00")
-        self.lbl_sum_b.config(text="€ 0.00")
-        self.lbl_sum_c.config(text="€ 0.00")
-        self.lbl_val_sicurezza.config(text="€ 0.00")
-        self.lbl_total_final.config(text="€ 0.00")
-        self.lbl_incidences.config(text="")
-        self.lbl_np_details.config(text="Nessun NP Selezionato")
-        self.clear_details_inputs()
-
-    def refresh_details_tree(self):
-        for row in self.tree_det.get_children(): self.tree_det.delete(row)
-        if not hasattr(self, 'current_np_id') or not self.current_np_id: return
-        
-        np_rec = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (self.current_np_id,))
-        if np_rec:
-            self.lbl_np_details.config(text=f"NP Attivo: {np_rec[2]} - {np_rec[3]}")
-            val_spese = np_rec[5] if np_rec[5] is not None else 17.0
-            val_sicurezza = np_rec[6] if np_rec[6] is not None else 5.0
-            val_utili = np_rec[7] if np_rec[7] is not None else 10.0
-            self.entry_perc_spese.delete(0, tk.END); self.entry_perc_spese.insert(0, str(val_spese))
-            self.entry_perc_sicurezza.delete(0, tk.END); self.entry_perc_sicurezza.insert(0, str(val_sicurezza))
-            self.entry_perc_utili.delete(0, tk.END); self.entry_perc_utili.insert(0, str(val_utili))
-
-        items = self.db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY ordine ASC", (self.current_np_id,))
-        self.total_a = 0.0
-        self.total_manodopera_base = 0.0
-        max_ord = 0
-
-        for item in items:
-            ord_val, cat, desc, um, q, pu = item[2], item[3], item[4], item[5], item[6], item[7]
-            if ord_val > max_ord: max_ord = ord_val
-            tot = round(q * pu, 2)
-            self.total_a += tot
-            if "Manodopera" in cat: self.total_manodopera_base += tot
-            q_fmt = f"{q:.3f}".replace('.', ',')
-            pu_fmt = f"{pu:.3f}".replace('.', ',')
-            tot_fmt = f"{tot:.2f}".replace('.', ',')
-            self.tree_det.insert("", "end", iid=item[0], values=(ord_val, cat, desc, um, q_fmt, pu_fmt, tot_fmt))
-            
-        self.entry_order.delete(0, tk.END)
-        self.entry_order.insert(0, str(max_ord + 1))
-        self.recalculate_totals()
-
-    def recalculate_totals(self):
-        if not self.current_np_id: return
-        try:
-            p_spese = safe_float_convert(self.entry_perc_spese.get())
-            p_sicurezza = safe_float_convert(self.entry_perc_sicurezza.get())
-            p_utili = safe_float_convert(self.entry_perc_utili.get())
-        except: return
-
-        val_a = self.total_a
-        val_b = round(val_a * (p_spese / 100.0), 2)
-        val_c = round((val_a + val_b) * (p_utili / 100.0), 2)
-        val_total = val_a + val_b + val_c
-        val_sicurezza = round(val_b * (p_sicurezza / 100.0), 2)
-        
-        perc_sic_tot = (val_sicurezza / val_total * 100) if val_total > 0 else 0
-        perc_man_tot = (self.total_manodopera_base / val_total * 100) if val_total > 0 else 0
-
-        self.lbl_sum_a.config(text=format_currency(val_a))
-        self.lbl_sum_b.config(text=format_currency(val_b))
-        self.lbl_val_sicurezza.config(text=f"({format_currency(val_sicurezza)})")
-        self.lbl_sum_c.config(text=format_currency(val_c))
-        self.lbl_total_final.config(text=format_currency(val_total))
-        self.lbl_incidences.config(text=f"INFO: Incidenza Manodopera sul totale: {perc_man_tot:.2f}% | Incidenza Sicurezza sul totale: {perc_sic_tot:.2f}%")
-
-        data = {'perc_spese_generali': p_spese, 'perc_sicurezza': p_sicurezza, 'perc_utili': p_utili, 'prezzo_finale': val_total}
-        self.db.update("nuovi_prezzi", self.current_np_id, data)
-
-    def on_det_select(self, event):
-        selected = self.tree_det.selection()
-        if not selected: return
-        vals = self.tree_det.item(selected[0])['values']
-        self.entry_order.delete(0, tk.END); self.entry_order.insert(0, vals[0])
-        self.combo_cat.set(vals[1])
-        
-        # Gestione Text widget
-        self.txt_desc.delete("1.0", tk.END)
-        self.txt_desc.insert("1.0", vals[2])
-        
-        self.combo_um.set(vals[3])
-        q_val = safe_float_convert(vals[4])
-        pu_val = safe_float_convert(vals[5])
-        self.entry_q.delete(0, tk.END); 
-        self.entry_q.insert(0, f"{q_val:.3f}".replace('.', ','))
-        self.entry_pu.delete(0, tk.END); 
-        self.entry_pu.insert(0, f"{pu_val:.3f}".replace('.', ','))
-
-    # --- FUNZIONI PER POPOLAMENTO DA STORICO ---
-    def open_history_dialog(self):
-        if not self.current_project_id:
-            messagebox.showwarning("Attenzione", "Nessun progetto selezionato.")
-            return
-        HistoryDialog(self, self.db, self.current_project_id, self.import_from_history_wrapper)
-
-    def import_from_history_wrapper(self, cat, desc, um, pu):
-        # Popola i campi della UI
-        self.combo_cat.set(cat)
-        
-        self.txt_desc.delete("1.0", tk.END)
-        self.txt_desc.insert("1.0", desc)
-        
-        self.combo_um.set(um)
-        
-        self.entry_pu.delete(0, tk.END)
-        self.entry_pu.insert(0, f"{pu:.3f}".replace('.', ','))
-        
-        # Pulisci quantità perché è specifica del nuovo inserimento
-        self.entry_q.delete(0, tk.END)
-
-    def add_cost_item(self):
-        if not hasattr(self, 'current_np_id') or not self.current_np_id:
-            messagebox.showwarning("Attenzione", "Seleziona NP")
-            return
-        try:
-            q = safe_float_convert(self.entry_q.get())
-            pu = safe_float_convert(self.entry_pu.get())
-            ord_val = int(float(self.entry_order.get()))
-        except ValueError as e:
-            messagebox.showerror("Errore", str(e)); return
-        
-        # Recupero testo dal widget Text
-        desc_val = self.txt_desc.get("1.0", "end-1c")
-        
-        data = {'np_id': self.current_np_id, 'ordine': ord_val, 'categoria': self.combo_cat.get(), 'descrizione': desc_val, 'um': self.combo_um.get(), 'quantita': q, 'prezzo_unitario': pu}
-        self.db.insert("voci_costo", data)
-        self.refresh_details_tree()
-
-    def update_cost_item(self):
-        selected = self.tree_det.selection()
-        if not selected: return
-        try:
-            q = safe_float_convert(self.entry_q.get())
-            pu = safe_float_convert(self.entry_pu.get())
-            ord_val = int(float(self.entry_order.get()))
-            
-            # Recupero testo dal widget Text
-            desc_val = self.txt_desc.get("1.0", "end-1c")
-            
-            data = {'ordine': ord_val, 'categoria': self.combo_cat.get(), 'descrizione': desc_val, 'um': self.combo_um.get(), 'quantita': q, 'prezzo_unitario': pu}
-            self.db.update("voci_costo", selected[0], data)
-            self.refresh_details_tree()
-        except ValueError as e:
-            messagebox.showerror("Errore", str(e))
-
-    def delete_cost_item(self):
-        selected = self.tree_det.selection()
-        if not selected: return
-        self.db.delete("voci_costo", selected[0])
-        self.refresh_details_tree()
-
-if __name__ == "__main__":
-    app = NPApp()
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import sqlite3
+import os
+import datetime
+import sys
+import csv
+from pathlib import Path
+import subprocess
+import platform
+import tempfile
+import re
+import json
+import base64
+import time
+import random
+import importlib.util
+import threading
+import logging
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from collections import namedtuple
+
+from np_engine import (MIL, CENT, PB, parse_decimal, to_mil, from_mil, from_cent, format_perc,
+                       parse_perc, sql_div_round, np_price_components, compute_np_summary, NPRunningTotals)
+
+# --- SCHEDA CONVERTITORE PDF (CODICE ESISTENTE) ---
+class ConverterPanel(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        if getattr(sys, 'frozen', False):
+            base_path = Path(sys.executable).parent
+        else:
+            base_path = Path(__file__).parent.resolve()
+        
+        self.work_dir = str(base_path.parent / "NP_STAMPE")
+        try:
+            if not os.path.exists(self.work_dir):
+                os.makedirs(self.work_dir, exist_ok=True)
+        except:
+            self.work_dir = os.getcwd()
+        self._dir_state = None
+
+        self.setup_ui()
+
+    def setup_ui(self):
+        main_frame = ttk.Frame(self, padding="10")
+        main_frame.pack(fill="both", expand=True)
+
+        dir_frame = ttk.LabelFrame(main_frame, text="Cartella di lavoro HTML", padding="5")
+        dir_frame.pack(fill="x", pady=5)
+        self.dir_label = ttk.Label(dir_frame, text=self.work_dir, relief="sunken", anchor="w")
+        self.dir_label.pack(side="left", fill="x", expand=True, padx=(0, 5))
+        ttk.Button(dir_frame, text="Cambia...", command=self.select_directory).pack(side="right")
+
+        files_frame = ttk.LabelFrame(main_frame, text="File HTML disponibili per conversione", padding="5")
+        files_frame.pack(fill="both", expand=True, pady=5)
+        scrollbar = ttk.Scrollbar(files_frame)
+        scrollbar.pack(side="right", fill="y")
+        self.files_listbox = tk.Listbox(files_frame, selectmode="multiple", yscrollcommand=scrollbar.set, height=10)
+        self.files_listbox.pack(side="left", fill="both", expand=True)
+        scrollbar.config(command=self.files_listbox.yview)
+
+        btn_f = ttk.Frame(main_frame)
+        btn_f.pack(pady=5)
+        ttk.Button(btn_f, text="Seleziona tutti", command=lambda: self.files_listbox.selection_set(0, "end")).pack(side="left", padx=2)
+        ttk.Button(btn_f, text="Deseleziona", command=lambda: self.files_listbox.selection_clear(0, "end")).pack(side="left", padx=2)
+        ttk.Button(btn_f, text="Aggiorna lista", command=self.refresh_file_list).pack(side="left", padx=2)
+
+        opt_f = ttk.LabelFrame(main_frame, text="Opzioni PDF", padding="5")
+        opt_f.pack(fill="x", pady=5)
+        self.mode = tk.StringVar(value="single")
+        ttk.Radiobutton(opt_f, text="PDF separati (A4)", variable=self.mode, value="single").pack(anchor="w")
+        ttk.Radiobutton(opt_f, text="Unisci in unico PDF", variable=self.mode, value="merged").pack(anchor="w")
+        
+        merge_n = ttk.Frame(opt_f)
+        merge_n.pack(fill="x")
+        ttk.Label(merge_n, text="Nome file unito:").pack(side="left", padx=5)
+        self.merged_name = ttk.Entry(merge_n)
+        self.merged_name.insert(0, "Progetto_Completo.pdf")
+        self.merged_name.pack(side="left", fill="x", expand=True)
+
+        self.btn_conv = ttk.Button(main_frame, text="AVVIA CONVERSIONE PDF", command=self.convert_to_pdf)
+        self.btn_conv.pack(pady=10, ipady=5)
+
+        self.status = ttk.Label(main_frame, text="Pronto", relief="sunken", anchor="w")
+        self.status.pack(fill="x")
+        self.prog = ttk.Progressbar(main_frame, mode='determinate')
+        self.prog.pack(fill="x", pady=5)
+        
+        self.refresh_file_list()
+
+    def select_directory(self):
+        d = filedialog.askdirectory(initialdir=self.work_dir)
+        if d:
+            self.work_dir = d
+            self.dir_label.config(text=d)
+            self.refresh_file_list()
+
+    def _directory_state(self):
+        # La data di modifica della cartella cambia quando vi si crea, cancella o rinomina un file
+        try:
+            return (self.work_dir, os.stat(self.work_dir).st_mtime_ns)
+        except OSError:
+            return (self.work_dir, None)
+
+    def refresh_file_list(self):
+        self.files_listbox.delete(0, "end")
+        self._dir_state = self._directory_state()
+        if os.path.exists(self.work_dir):
+            files = sorted([f for f in os.listdir(self.work_dir) if f.lower().endswith('.html')])
+            for f in files: self.files_listbox.insert("end", f)
+
+    def refresh_if_changed(self):
+        """Rilegge la cartella solo se il suo contenuto è cambiato dall'ultima lettura"""
+        if self._directory_state() != self._dir_state:
+            self.refresh_file_list()
+
+    def get_chrome_path(self):
+        sys_p = platform.system()
+        if sys_p == "Darwin":
+            ps = ["/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/Applications/Microsoft Edge.app/Contents/MacOS/Microsoft Edge"]
+        elif sys_p == "Windows":
+            ps = ["C:\\Program Files (x86)\\Microsoft\\Edge\\Application\\msedge.exe", "C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe", os.path.expanduser("~\\AppData\\Local\\Microsoft\\Edge\\Application\\msedge.exe")]
+        else:
+            ps = ["google-chrome", "microsoft-edge", "chromium"]
+        for p in ps:
+            if os.path.exists(p) if os.path.isabs(p) else True: return p
+        return None
+
+    def convert_to_pdf(self):
+        sel = self.files_listbox.curselection()
+        if not sel:
+            messagebox.showwarning("Attenzione", "Seleziona almeno un file HTML")
+            return
+        
+        c_path = self.get_chrome_path()
+        if not c_path:
+            messagebox.showerror("Errore", "Chrome o Edge non trovati. Installa un browser basato su Chromium.")
+            return
+
+        files = [self.files_listbox.get(i) for i in sel]
+        mode = self.mode.get()
+        self.prog['maximum'] = len(files)
+        temp_pdfs = []
+
+        try:
+            for i, f in enumerate(files):
+                h_p = os.path.abspath(os.path.join(self.work_dir, f))
+                if mode == "single":
+                    pdf_p = h_p.replace('.html', '.pdf')
+                else:
+                    t_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+                    pdf_p = t_pdf.name
+                    t_pdf.close()
+                    temp_pdfs.append(pdf_p)
+
+                self.status.config(text=f"Conversione {i+1}/{len(files)}...")
+                self.update_idletasks()
+                
+                f_url = f"file:///{h_p.replace(os.sep, '/')}" if platform.system() == "Windows" else f"file://{h_p}"
+                cmd = [c_path, "--headless", "--disable-gpu", "--no-pdf-header-footer", "--print-to-pdf=" + pdf_p, f_url]
+                subprocess.run(cmd, check=True, timeout=30)
+                self.prog['value'] = i + 1
+
+            if mode == "merged":
+                try:
+                    from pypdf import PdfWriter, PdfReader
+                except ImportError:
+                     messagebox.showerror("Errore", "Libreria 'pypdf' mancante.\nInstalla con: pip install pypdf")
+                     return
+
+                out_n = self.merged_name.get()
+                if not out_n.endswith('.pdf'): out_n += ".pdf"
+                out_p = os.path.join(self.work_dir, out_n)
+                writer = PdfWriter()
+                for p in temp_pdfs:
+                    r = PdfReader(p)
+                    for page in r.pages: writer.add_page(page)
+                with open(out_p, "wb") as o: writer.write(o)
+                for p in temp_pdfs: os.unlink(p)
+                messagebox.showinfo("Successo", f"PDF Unito creato: {out_n}")
+            else:
+                messagebox.showinfo("Successo", "Conversione completata.")
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+        finally:
+            self.status.config(text="Pronto")
+            self.prog['value'] = 0
+
+
+# --- FUNZIONI DI UTILITÀ DEL PROGRAMMA PRINCIPALE ---
+def format_currency(value):
+    if value is None: value = 0.0
+    return f"€ {value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+# --- MIGRAZIONI SCHEMA (PRAGMA user_version) ---
+# Ogni migrazione viene eseguita una sola volta, in ordine, e il numero raggiunto
+# viene salvato in PRAGMA user_version. I passi restano idempotenti per poter
+# adottare anche i database creati dalle versioni precedenti (user_version = 0
+# ma tabelle già presenti). Un passo può essere una stringa SQL o una funzione
+# che riceve il cursore.
+DEFAULT_UNITA_MISURA = [
+    ("cad.", "Cadauno", "Sanitari, infissi..."),
+    ("corpo", "A corpo", "Opere indivisibili"),
+    ("h", "Ora", "Manodopera..."),
+    ("kg", "Chilogrammo", "Acciaio..."),
+    ("m", "Metro lineare", "Tubazioni, cavi..."),
+    ("mc", "Metro cubo", "Getti in cls, scavi..."),
+    ("mq", "Metro quadrato", "Pavimenti, intonaci..."),
+]
+
+def _add_column(table, column, definition):
+    """Passo di migrazione idempotente per ALTER TABLE ADD COLUMN"""
+    def step(cursor):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+def _create_fts_index(cursor):
+    """Indice full-text delle voci di costo per "Cerca da Storico" (se SQLite include FTS5)"""
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS voci_costo_fts USING fts5(
+                descrizione, categoria,
+                content='voci_costo', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError:
+        return  # FTS5 non disponibile: la ricerca ripiega su LIKE
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_fts_ai AFTER INSERT ON voci_costo BEGIN
+            INSERT INTO voci_costo_fts(rowid, descrizione, categoria) VALUES (NEW.id, NEW.descrizione, NEW.categoria);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_fts_ad AFTER DELETE ON voci_costo BEGIN
+            INSERT INTO voci_costo_fts(voci_costo_fts, rowid, descrizione, categoria) VALUES ('delete', OLD.id, OLD.descrizione, OLD.categoria);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_fts_au AFTER UPDATE OF descrizione, categoria ON voci_costo BEGIN
+            INSERT INTO voci_costo_fts(voci_costo_fts, rowid, descrizione, categoria) VALUES ('delete', OLD.id, OLD.descrizione, OLD.categoria);
+            INSERT INTO voci_costo_fts(rowid, descrizione, categoria) VALUES (NEW.id, NEW.descrizione, NEW.categoria);
+        END
+    """)
+    cursor.execute("INSERT INTO voci_costo_fts(voci_costo_fts) VALUES ('rebuild')")
+
+def _populate_default_um(cursor):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM unita_misura)")
+    if not cursor.fetchone()[0]:
+        cursor.executemany("INSERT INTO unita_misura (codice, nome, descrizione) VALUES (?, ?, ?)", DEFAULT_UNITA_MISURA)
+
+# Ricalcolo degli aggregati di un NP dalle sue voci (usa l'indice su np_id).
+# Le voci sono arrotondate al centesimo come nel riepilogo della Tab 3.
+# Schema v7 (colonne REAL), sostituito dalla versione in virgola fissa della v9.
+NP_AGGREGATES_UPDATE = """
+    UPDATE nuovi_prezzi SET (totale_a, totale_manodopera, num_voci) = (
+        SELECT COALESCE(SUM(ROUND(v.quantita * v.prezzo_unitario, 2)), 0.0),
+               COALESCE(SUM(CASE WHEN instr(v.categoria, 'Manodopera') > 0
+                                 THEN ROUND(v.quantita * v.prezzo_unitario, 2) ELSE 0.0 END), 0.0),
+               COUNT(*)
+        FROM voci_costo v WHERE v.np_id = nuovi_prezzi.id
+    )
+"""
+
+# D = A + B + C con B = SG% di A e C = Utili% di (A + B), arrotondati come in recalculate_totals
+NP_PREZZO_FINALE_EXPR = """
+    COALESCE(NEW.totale_a, 0.0)
+    + ROUND(COALESCE(NEW.totale_a, 0.0) * COALESCE(NEW.perc_spese_generali, 17.0) / 100.0, 2)
+    + ROUND((COALESCE(NEW.totale_a, 0.0)
+             + ROUND(COALESCE(NEW.totale_a, 0.0) * COALESCE(NEW.perc_spese_generali, 17.0) / 100.0, 2))
+            * COALESCE(NEW.perc_utili, 10.0) / 100.0, 2)
+"""
+
+# --- SCHEMA IN VIRGOLA FISSA (v9) ---
+SECONDARY_INDEXES = [
+    # Dettaglio NP (Tab 3), MAX(ordine) e copia delle voci
+    "CREATE INDEX IF NOT EXISTS idx_voci_costo_np_ordine ON voci_costo(np_id, ordine)",
+    # Stampe HTML ed export Excel: ORDER BY categoria, ordine senza ordinamento temporaneo
+    "CREATE INDEX IF NOT EXISTS idx_voci_costo_np_categoria ON voci_costo(np_id, categoria, ordine)",
+    # Elenco NP del progetto (Tab 2) e join dello storico (indice coprente per n.id)
+    "CREATE INDEX IF NOT EXISTS idx_nuovi_prezzi_progetto ON nuovi_prezzi(progetto_id, codice)",
+]
+
+# D = A + B + C, stessa formula di np_price_components
+_NP_B_CENT_EXPR = sql_div_round("NEW.totale_a_cent * NEW.perc_spese_generali_pb", 100 * PB)
+_NP_C_CENT_EXPR = sql_div_round(f"(NEW.totale_a_cent + {_NP_B_CENT_EXPR}) * NEW.perc_utili_pb", 100 * PB)
+NP_PREZZO_FINALE_CENT_EXPR = f"(NEW.totale_a_cent + {_NP_B_CENT_EXPR} + {_NP_C_CENT_EXPR})"
+
+# Ricalcolo completo (e quindi esatto) degli aggregati interi di tutti gli NP
+NP_AGGREGATES_CENT_UPDATE = """
+    UPDATE nuovi_prezzi SET (totale_a_cent, totale_manodopera_cent, num_voci) = (
+        SELECT COALESCE(SUM(v.importo_cent), 0),
+               COALESCE(SUM(CASE WHEN instr(v.categoria, 'Manodopera') > 0 THEN v.importo_cent ELSE 0 END), 0),
+               COUNT(*)
+        FROM voci_costo v WHERE v.np_id = nuovi_prezzi.id
+    )
+"""
+
+# Ricalcolo di tutti gli NP di un progetto in un solo passaggio raggruppato.
+# GROUP BY codice, id segue l'indice idx_nuovi_prezzi_progetto: nessun ordinamento temporaneo.
+PROJECT_RECOMPUTE_QUERY = """
+    SELECT n.id, n.codice, n.perc_spese_generali_pb, n.perc_sicurezza_pb, n.perc_utili_pb,
+           n.totale_a_cent, n.totale_manodopera_cent, n.num_voci, n.prezzo_finale_cent,
+           COALESCE(SUM(v.importo_cent), 0) AS calc_a_cent,
+           COALESCE(SUM(CASE WHEN instr(v.categoria, 'Manodopera') > 0 THEN v.importo_cent ELSE 0 END), 0) AS calc_manodopera_cent,
+           COUNT(v.id) AS calc_num_voci
+    FROM nuovi_prezzi n LEFT JOIN voci_costo v ON v.np_id = n.id
+    WHERE n.progetto_id = ?
+    GROUP BY n.codice, n.id
+"""
+ProjectNPTotals = namedtuple("ProjectNPTotals", (
+    "id", "codice", "totale_a_cent", "spese_generali_cent", "sicurezza_cent", "utili_cent",
+    "totale_cent", "manodopera_cent", "num_voci", "prezzo_salvato_cent", "deriva",
+))
+
+# Con interi la manutenzione per differenza è esatta: ogni scrittura tocca una sola riga NP
+FIXED_POINT_TRIGGERS = [
+    """
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_ai AFTER INSERT ON voci_costo BEGIN
+            UPDATE nuovi_prezzi SET
+                totale_a_cent = totale_a_cent + NEW.importo_cent,
+                totale_manodopera_cent = totale_manodopera_cent
+                    + CASE WHEN instr(NEW.categoria, 'Manodopera') > 0 THEN NEW.importo_cent ELSE 0 END,
+                num_voci = num_voci + 1
+            WHERE id = NEW.np_id;
+        END
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_au
+        AFTER UPDATE OF np_id, categoria, quantita_mil, prezzo_unitario_mil ON voci_costo BEGIN
+            UPDATE nuovi_prezzi SET
+                totale_a_cent = totale_a_cent - OLD.importo_cent,
+                totale_manodopera_cent = totale_manodopera_cent
+                    - CASE WHEN instr(OLD.categoria, 'Manodopera') > 0 THEN OLD.importo_cent ELSE 0 END,
+                num_voci = num_voci - 1
+            WHERE id = OLD.np_id;
+            UPDATE nuovi_prezzi SET
+                totale_a_cent = totale_a_cent + NEW.importo_cent,
+                totale_manodopera_cent = totale_manodopera_cent
+                    + CASE WHEN instr(NEW.categoria, 'Manodopera') > 0 THEN NEW.importo_cent ELSE 0 END,
+                num_voci = num_voci + 1
+            WHERE id = NEW.np_id;
+        END
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS trg_voci_costo_ad AFTER DELETE ON voci_costo BEGIN
+            UPDATE nuovi_prezzi SET
+                totale_a_cent = totale_a_cent - OLD.importo_cent,
+                totale_manodopera_cent = totale_manodopera_cent
+                    - CASE WHEN instr(OLD.categoria, 'Manodopera') > 0 THEN OLD.importo_cent ELSE 0 END,
+                num_voci = num_voci - 1
+            WHERE id = OLD.np_id;
+        END
+    """,
+    f"""
+        CREATE TRIGGER IF NOT EXISTS trg_nuovi_prezzi_ai AFTER INSERT ON nuovi_prezzi BEGIN
+            UPDATE nuovi_prezzi SET prezzo_finale_cent = {NP_PREZZO_FINALE_CENT_EXPR} WHERE id = NEW.id;
+        END
+    """,
+    f"""
+        CREATE TRIGGER IF NOT EXISTS trg_nuovi_prezzi_au
+        AFTER UPDATE OF totale_a_cent, perc_spese_generali_pb, perc_utili_pb ON nuovi_prezzi BEGIN
+            UPDATE nuovi_prezzi SET prezzo_finale_cent = {NP_PREZZO_FINALE_CENT_EXPR} WHERE id = NEW.id;
+        END
+    """,
+]
+
+def _migrate_fixed_point(cursor):
+    """Ricostruisce nuovi_prezzi e voci_costo con colonne intere.
+
+    I nomi delle colonne cambiano di proposito (quantita -> quantita_mil, ...): una
+    versione precedente aperta sullo stesso file condiviso fallisce subito invece di
+    leggere 1500 millesimi come 1500 unità.
+    """
+    cursor.execute("""
+        CREATE TABLE nuovi_prezzi_v9 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            progetto_id INTEGER,
+            codice TEXT,
+            descrizione TEXT,
+            unita_misura TEXT,
+            perc_spese_generali_pb INTEGER NOT NULL DEFAULT 1700,
+            perc_sicurezza_pb INTEGER NOT NULL DEFAULT 500,
+            perc_utili_pb INTEGER NOT NULL DEFAULT 1000,
+            prezzo_finale_cent INTEGER NOT NULL DEFAULT 0,
+            totale_a_cent INTEGER NOT NULL DEFAULT 0,
+            totale_manodopera_cent INTEGER NOT NULL DEFAULT 0,
+            num_voci INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(progetto_id) REFERENCES progetti(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO nuovi_prezzi_v9 (id, progetto_id, codice, descrizione, unita_misura,
+                                     perc_spese_generali_pb, perc_sicurezza_pb, perc_utili_pb)
+        SELECT id, progetto_id, codice, descrizione, unita_misura,
+               CAST(ROUND(COALESCE(perc_spese_generali, 17.0) * 100) AS INTEGER),
+               CAST(ROUND(COALESCE(perc_sicurezza, 5.0) * 100) AS INTEGER),
+               CAST(ROUND(COALESCE(perc_utili, 10.0) * 100) AS INTEGER)
+        FROM nuovi_prezzi
+    """)
+    amount = sql_div_round("quantita_mil * prezzo_unitario_mil", MIL * MIL // CENT)
+    cursor.execute(f"""
+        CREATE TABLE voci_costo_v9 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            np_id INTEGER,
+            ordine INTEGER,
+            categoria TEXT,
+            descrizione TEXT,
+            um TEXT,
+            quantita_mil INTEGER NOT NULL DEFAULT 0,
+            prezzo_unitario_mil INTEGER NOT NULL DEFAULT 0,
+            importo_cent INTEGER GENERATED ALWAYS AS {amount} STORED,
+            FOREIGN KEY(np_id) REFERENCES nuovi_prezzi(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO voci_costo_v9 (id, np_id, ordine, categoria, descrizione, um, quantita_mil, prezzo_unitario_mil)
+        SELECT id, np_id, ordine, categoria, descrizione, um,
+               CAST(ROUND(COALESCE(quantita, 0) * 1000) AS INTEGER),
+               CAST(ROUND(COALESCE(prezzo_unitario, 0) * 1000) AS INTEGER)
+        FROM voci_costo
+    """)
+    # Le tabelle eliminate portano con sé indici e trigger, ricreati sotto
+    cursor.execute("DROP TABLE voci_costo")
+    cursor.execute("DROP TABLE nuovi_prezzi")
+    cursor.execute("ALTER TABLE nuovi_prezzi_v9 RENAME TO nuovi_prezzi")
+    cursor.execute("ALTER TABLE voci_costo_v9 RENAME TO voci_costo")
+    for statement in SECONDARY_INDEXES + FIXED_POINT_TRIGGERS:
+        cursor.execute(statement)
+    cursor.execute(NP_AGGREGATES_CENT_UPDATE)
+    # Gli id delle voci sono invariati: basta ricollegare i trigger e ricostruire l'indice
+    _create_fts_index(cursor)
+
+# Tabelle modificate dagli utenti: ogni UPDATE incrementa row_version
+# (i trigger dei totali no, così l'aggiunta di voci non invalida le percentuali)
+VERSIONED_TABLES = ("unita_misura", "progetti", "nuovi_prezzi", "voci_costo")
+
+# Elenchi paginati (Tab 1 e 2): un indice per ogni colonna ordinabile, così ogni
+# pagina è una ricerca sull'indice (colonna, id) invece di un ordinamento completo
+LISTING_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_nuovi_prezzi_progetto_descrizione ON nuovi_prezzi(progetto_id, descrizione)",
+    "CREATE INDEX IF NOT EXISTS idx_nuovi_prezzi_progetto_um ON nuovi_prezzi(progetto_id, unita_misura)",
+    "CREATE INDEX IF NOT EXISTS idx_nuovi_prezzi_progetto_prezzo ON nuovi_prezzi(progetto_id, prezzo_finale_cent)",
+    "CREATE INDEX IF NOT EXISTS idx_progetti_codice ON progetti(codice)",
+    "CREATE INDEX IF NOT EXISTS idx_progetti_titolo ON progetti(titolo)",
+    "CREATE INDEX IF NOT EXISTS idx_progetti_cup ON progetti(cup)",
+    "CREATE INDEX IF NOT EXISTS idx_progetti_committente ON progetti(committente)",
+]
+
+SCHEMA_MIGRATIONS = [
+    (1, "Schema base", [
+        """
+            CREATE TABLE IF NOT EXISTS unita_misura (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codice TEXT UNIQUE,
+                nome TEXT,
+                descrizione TEXT
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS progetti (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codice TEXT,
+                titolo TEXT,
+                cup TEXT,
+                committente TEXT
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS nuovi_prezzi (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                progetto_id INTEGER,
+                codice TEXT, 
+                descrizione TEXT,
+                unita_misura TEXT, 
+                perc_spese_generali REAL DEFAULT 17.0,
+                perc_sicurezza REAL DEFAULT 5.0,
+                perc_utili REAL DEFAULT 10.0,
+                prezzo_finale REAL DEFAULT 0.0,
+                FOREIGN KEY(progetto_id) REFERENCES progetti(id) ON DELETE CASCADE
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS voci_costo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                np_id INTEGER,
+                ordine INTEGER,
+                categoria TEXT, 
+                descrizione TEXT,
+                um TEXT,
+                quantita REAL,
+                prezzo_unitario REAL,
+                FOREIGN KEY(np_id) REFERENCES nuovi_prezzi(id) ON DELETE CASCADE
+            )
+        """,
+    ]),
+    # Converte le vecchie categorie nel nuovo standard Regionale Campania
+    (2, "Categorie standard Regionale Campania", [
+        "UPDATE voci_costo SET categoria='Prodotti' WHERE categoria='Materiali'",
+        "UPDATE voci_costo SET categoria='Attrezzature' WHERE categoria='Mezzi e Noli'",
+    ]),
+    (3, "Unità di misura predefinite", [
+        _populate_default_um,
+    ]),
+    # Indici sui percorsi di accesso usati da GUI ed esportazioni.
+    # unita_misura(codice) è già coperto dall'indice implicito del vincolo UNIQUE.
+    (4, "Indici secondari", SECONDARY_INDEXES),
+    # Impostazioni legate al singolo file di database (es. profilo di connessione)
+    (5, "Impostazioni del database", [
+        """
+            CREATE TABLE IF NOT EXISTS impostazioni (
+                chiave TEXT PRIMARY KEY,
+                valore TEXT
+            )
+        """,
+    ]),
+    # Pulizia una tantum degli orfani lasciati quando le foreign key non erano attive
+    (6, "Rimozione record orfani", [
+        "DELETE FROM nuovi_prezzi WHERE NOT EXISTS (SELECT 1 FROM progetti p WHERE p.id = nuovi_prezzi.progetto_id)",
+        "DELETE FROM voci_costo WHERE NOT EXISTS (SELECT 1 FROM nuovi_prezzi n WHERE n.id = voci_costo.np_id)",
+    ]),
+    # Aggregati per NP mantenuti dai trigger: elenchi, stampe e totali leggono una sola riga
+    # invece di sommare tutte le voci, e prezzo_finale non resta mai disallineato.
+    (7, "Aggregati NP mantenuti da trigger", [
+        _add_column("nuovi_prezzi", "totale_a", "REAL DEFAULT 0.0"),
+        _add_column("nuovi_prezzi", "totale_manodopera", "REAL DEFAULT 0.0"),
+        _add_column("nuovi_prezzi", "num_voci", "INTEGER DEFAULT 0"),
+        f"""
+            CREATE TRIGGER IF NOT EXISTS trg_voci_costo_ai AFTER INSERT ON voci_costo BEGIN
+                {NP_AGGREGATES_UPDATE} WHERE id = NEW.np_id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER IF NOT EXISTS trg_voci_costo_au
+            AFTER UPDATE OF np_id, categoria, quantita, prezzo_unitario ON voci_costo BEGIN
+                {NP_AGGREGATES_UPDATE} WHERE id IN (OLD.np_id, NEW.np_id);
+            END
+        """,
+        f"""
+            CREATE TRIGGER IF NOT EXISTS trg_voci_costo_ad AFTER DELETE ON voci_costo BEGIN
+                {NP_AGGREGATES_UPDATE} WHERE id = OLD.np_id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER IF NOT EXISTS trg_nuovi_prezzi_ai AFTER INSERT ON nuovi_prezzi BEGIN
+                UPDATE nuovi_prezzi SET prezzo_finale = {NP_PREZZO_FINALE_EXPR} WHERE id = NEW.id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER IF NOT EXISTS trg_nuovi_prezzi_au
+            AFTER UPDATE OF totale_a, perc_spese_generali, perc_utili ON nuovi_prezzi BEGIN
+                UPDATE nuovi_prezzi SET prezzo_finale = {NP_PREZZO_FINALE_EXPR} WHERE id = NEW.id;
+            END
+        """,
+        # Allineamento iniziale di tutti gli NP esistenti
+        NP_AGGREGATES_UPDATE,
+    ]),
+    (8, "Indice full-text voci di costo", [
+        _create_fts_index,
+    ]),
+    (9, "Importi in virgola fissa", [
+        _migrate_fixed_point,
+    ]),
+    (10, "Indici per gli elenchi paginati", LISTING_INDEXES),
+    # Versione di riga per il controllo ottimistico delle modifiche concorrenti
+    (11, "Versioni di riga", [
+        _add_column(table, "row_version", "INTEGER NOT NULL DEFAULT 0") for table in VERSIONED_TABLES
+    ]),
+    # Progetti archiviati: nome del file di archivio (NULL = progetto in linea)
+    (12, "Archivio progetti", [
+        _add_column("progetti", "archivio", "TEXT"),
+    ]),
+    # Voci che richiamano un altro NP (sottoanalisi): cancellato l'NP, la voce resta
+    # con l'ultimo prezzo e diventa una voce normale
+    (13, "NP composti", [
+        _add_column("voci_costo", "np_rif_id", "INTEGER REFERENCES nuovi_prezzi(id) ON DELETE SET NULL"),
+        "CREATE INDEX IF NOT EXISTS idx_voci_costo_np_rif ON voci_costo(np_rif_id) WHERE np_rif_id IS NOT NULL",
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# Controlli di integrità: righe figlie il cui padre non esiste più.
+# L'ordine conta: gli NP rimossi rendono orfane le loro voci.
+ORPHAN_CHECKS = [
+    ("nuovi_prezzi", "NOT EXISTS (SELECT 1 FROM progetti p WHERE p.id = nuovi_prezzi.progetto_id)"),
+    ("voci_costo", "NOT EXISTS (SELECT 1 FROM nuovi_prezzi n WHERE n.id = voci_costo.np_id)"),
+]
+
+# Rilevamento modifiche: tabelle cambiate indirettamente da una scrittura
+# (totali degli NP aggiornati dai trigger, cancellazioni in cascata)
+CHANGE_DEPENDENCIES = {
+    "progetti": ("nuovi_prezzi", "voci_costo"),
+    "nuovi_prezzi": ("voci_costo",),
+    "voci_costo": ("nuovi_prezzi",),
+}
+
+# Tabelle piccole e lette spesso (combo, elenchi progetti): tenute in memoria
+# e rilette solo quando cambia il loro change_token
+REFERENCE_TABLES = ("unita_misura", "progetti")
+
+# --- RICERCA DA STORICO ---
+HISTORY_SEARCH_LIMIT = 200
+
+# Voci distinte del progetto, senza filtro testuale
+HISTORY_QUERY = """
+    SELECT DISTINCT TRIM(v.categoria) AS categoria, TRIM(v.descrizione) AS descrizione,
+           TRIM(v.um) AS um, v.prezzo_unitario_mil
+    FROM voci_costo v
+    JOIN nuovi_prezzi n ON v.np_id = n.id
+    WHERE n.progetto_id = ?
+    ORDER BY 1, 2
+    LIMIT ?
+"""
+
+# Ricerca full-text: prefissi e più parole (AND), ordinata per pertinenza bm25
+HISTORY_FTS_QUERY = """
+    SELECT cat AS categoria, descr AS descrizione, um, pu AS prezzo_unitario_mil FROM (
+        SELECT TRIM(v.categoria) AS cat, TRIM(v.descrizione) AS descr, TRIM(v.um) AS um,
+               v.prezzo_unitario_mil AS pu, f.rank AS rank
+        FROM voci_costo_fts f
+        JOIN voci_costo v ON v.id = f.rowid
+        JOIN nuovi_prezzi n ON n.id = v.np_id
+        WHERE voci_costo_fts MATCH ? AND n.progetto_id = ?
+    )
+    GROUP BY cat, descr, um, pu
+    ORDER BY MIN(rank), descr
+    LIMIT ?
+"""
+
+def fts_match_expression(text):
+    """"calce arm" -> '"calce"* "arm"*' (ogni parola come prefisso, tutte richieste)"""
+    return " ".join(f'"{token}"*' for token in re.findall(r"\w+", text))
+
+# --- PAGINAZIONE KEYSET ---
+# Le pagine ripartono dall'ultima chiave (colonna di ordinamento, id) vista invece
+# che da un OFFSET: il costo di ogni pagina resta costante anche con migliaia di NP.
+LISTING_PAGE_SIZE = 200
+
+def encode_page_token(direction, value, row_id):
+    """Token opaco per la pagina successiva ("next") o precedente ("prev")"""
+    payload = json.dumps([direction, value, row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+def decode_page_token(token):
+    try:
+        direction, value, row_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Token di pagina non valido")
+    if direction not in ("next", "prev"):
+        raise ValueError("Token di pagina non valido")
+    return direction, value, row_id
+
+def _keyset_segments(column, ascending, key):
+    """Condizioni (sql, parametri) per le righe che seguono key nell'ordinamento.
+    In SQLite i NULL vengono prima in ASC e dopo in DESC; il confronto su row value
+    li esclude, quindi vanno percorsi come tratto a parte. Ogni tratto resta una
+    ricerca su intervallo dell'indice."""
+    if key is None:
+        return [("1", [])]
+    value, last_id = key
+    if column == "id":
+        return [("id > ?" if ascending else "id < ?", [last_id])]
+    if ascending:
+        if value is None:
+            return [(f"{column} IS NULL AND id > ?", [last_id]), (f"{column} IS NOT NULL", [])]
+        return [(f"({column}, id) > (?, ?)", [value, last_id])]
+    if value is None:
+        return [(f"{column} IS NULL AND id < ?", [last_id])]
+    return [(f"({column}, id) < (?, ?)", [value, last_id]), (f"{column} IS NULL", [])]
+
+# --- PROFILI DI CONNESSIONE ---
+# PRAGMA applicati all'apertura. "locale" usa il journal WAL: le letture (Tab 2,
+# storico) non restano bloccate dietro le scritture. Sulle cartelle di rete (SMB)
+# WAL non funziona perché richiede memoria condivisa tra i processi, quindi
+# "rete" resta sul journal tradizionale e disattiva mmap.
+CONNECTION_PROFILES = {
+    "locale": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,       # 64 MB
+        "mmap_size": 268435456,     # 256 MB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,       # ms di attesa su un lock prima di SQLITE_BUSY
+    },
+    "rete": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -16384,       # 16 MB
+        "mmap_size": 0,
+        "temp_store": "MEMORY",
+        "busy_timeout": 15000,      # i lock su SMB sono più lenti da rilasciare
+    },
+}
+
+# Ritentativi su SQLITE_BUSY oltre il busy_timeout, con attesa esponenziale e
+# casuale: due utenti che si bloccano a vicenda non ritentano nello stesso istante
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05     # secondi, raddoppiati a ogni tentativo
+
+def busy_delay(attempt):
+    return BUSY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+def is_busy_error(error):
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (5, 6)    # SQLITE_BUSY, SQLITE_LOCKED
+    text = str(error).lower()
+    return "locked" in text or "busy" in text
+
+class ConflictError(Exception):
+    """Il record è stato modificato o cancellato da un altro utente dopo la lettura"""
+    def __init__(self, table, record_ids, deleted=False):
+        self.table = table
+        self.record_ids = list(record_ids)
+        self.deleted = deleted
+        what = "cancellato" if deleted else "modificato"
+        super().__init__(f"Il record è stato {what} da un altro utente dopo che lo avevi aperto.\n"
+                         "I dati sono stati ricaricati: ripeti la modifica.")
+
+NETWORK_FILESYSTEMS = ("cifs", "smbfs", "smb3", "nfs", "nfs4", "afpfs", "9p")
+
+def detect_connection_profile(db_name):
+    """Sceglie il profilo in base al percorso: "rete" per UNC, unità di rete e mount remoti"""
+    if db_name == ":memory:": return "locale"
+    path = os.path.abspath(db_name)
+    if path.startswith("\\\\") or path.startswith("//"): return "rete"
+    if os.name == 'nt':
+        try:
+            import ctypes
+            drive = os.path.splitdrive(path)[0] + "\\"
+            if ctypes.windll.kernel32.GetDriveTypeW(drive) == 4: return "rete"  # DRIVE_REMOTE
+        except Exception:
+            pass
+    elif os.path.exists("/proc/mounts"):
+        try:
+            best, fstype = "", ""
+            with open("/proc/mounts", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) < 3: continue
+                    mount = parts[1]
+                    if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+                        best, fstype = mount, parts[2]
+            if fstype in NETWORK_FILESYSTEMS: return "rete"
+        except OSError:
+            pass
+    return "locale"
+
+SYNCHRONOUS_LEVELS = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+TEMP_STORE_MODES = {0: "DEFAULT", 1: "FILE", 2: "MEMORY"}
+
+# --- RECORD TIPIZZATI ---
+# Colonne esplicite per tabella: niente SELECT *, e i chiamanti accedono per nome
+# (np.codice, voce.importo_cent) invece che per posizione.
+TABLE_COLUMNS = {
+    "unita_misura": ("id", "codice", "nome", "descrizione", "row_version"),
+    "progetti": ("id", "codice", "titolo", "cup", "committente", "archivio", "row_version"),
+    "nuovi_prezzi": ("id", "progetto_id", "codice", "descrizione", "unita_misura",
+                     "perc_spese_generali_pb", "perc_sicurezza_pb", "perc_utili_pb",
+                     "prezzo_finale_cent", "totale_a_cent", "totale_manodopera_cent", "num_voci",
+                     "row_version"),
+    "voci_costo": ("id", "np_id", "ordine", "categoria", "descrizione", "um",
+                   "quantita_mil", "prezzo_unitario_mil", "importo_cent", "np_rif_id", "row_version"),
+    "impostazioni": ("chiave", "valore"),
+}
+
+UnitaMisura = namedtuple("UnitaMisura", TABLE_COLUMNS["unita_misura"])
+Progetto = namedtuple("Progetto", TABLE_COLUMNS["progetti"])
+NuovoPrezzo = namedtuple("NuovoPrezzo", TABLE_COLUMNS["nuovi_prezzi"])
+VoceCosto = namedtuple("VoceCosto", TABLE_COLUMNS["voci_costo"])
+Impostazione = namedtuple("Impostazione", TABLE_COLUMNS["impostazioni"])
+
+# Classi per insieme di colonne: le righe complete ricevono la classe della tabella,
+# le selezioni parziali una namedtuple creata (una sola volta) per quella forma
+_RECORD_CLASSES = {cls._fields: cls for cls in (UnitaMisura, Progetto, NuovoPrezzo, VoceCosto, Impostazione)}
+# Condivise da tutte le connessioni: le nuove forme si registrano sotto lock
+_RECORD_CLASSES_LOCK = threading.Lock()
+
+def _record_class(description):
+    names = tuple(d[0] for d in description)
+    cls = _RECORD_CLASSES.get(names)
+    if cls is None:
+        with _RECORD_CLASSES_LOCK:
+            cls = _RECORD_CLASSES.get(names)
+            if cls is None:
+                cls = _RECORD_CLASSES[names] = namedtuple("Riga", names, rename=True)
+    return cls
+
+def make_record_factory():
+    """row_factory per una connessione: righe come namedtuple (nessun __dict__ per riga).
+    description resta lo stesso oggetto per tutte le righe di una query: basta confrontare
+    l'identità per non ricalcolare la classe riga per riga. L'ultima classe usata è
+    propria della connessione, che un solo thread alla volta adopera."""
+    last = [None, None]
+
+    def record_factory(cursor, row):
+        description = cursor.description
+        if last[0] is not description:
+            last[:] = description, _record_class(description)
+        return last[1]._make(row)
+    return record_factory
+
+# --- BACKUP ONLINE ---
+# Copia con l'API di backup di SQLite: BACKUP_PAGES pagine per passo e una pausa
+# tra i passi, così gli altri utenti (e la UI) possono scrivere durante la copia.
+# Le copie finiscono in NP_BACKUP accanto al file e vengono verificate con quick_check.
+BACKUP_DIR_NAME = "NP_BACKUP"
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.05
+BACKUP_KEEP = 10
+BACKUP_PARTIAL_SUFFIX = ".parziale"
+
+def backup_dir_for(db_name):
+    return os.path.join(os.path.dirname(os.path.abspath(db_name)), BACKUP_DIR_NAME)
+
+def list_backups(db_name):
+    """Copie esistenti del file, dalla più recente: lista di (percorso, data, byte)"""
+    folder = backup_dir_for(db_name)
+    stem = Path(db_name).stem
+    if not os.path.isdir(folder): return []
+    found = []
+    for name in os.listdir(folder):
+        if name.startswith(stem + "_") and name.endswith(".db"):
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            found.append((path, datetime.datetime.fromtimestamp(st.st_mtime), st.st_size))
+    found.sort(key=lambda b: b[0], reverse=True)
+    return found
+
+def verify_backup(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchall()
+    finally:
+        conn.close()
+    if result != [("ok",)]:
+        raise sqlite3.DatabaseError(f"Copia non valida ({os.path.basename(path)}): {result[0][0]}")
+
+def backup_database(db_name, keep=BACKUP_KEEP, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP, progress=None, label=""):
+    """Crea una nuova copia verificata e applica la conservazione. Usa connessioni
+    proprie: può girare in un thread separato."""
+    folder = backup_dir_for(db_name)
+    os.makedirs(folder, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    final = os.path.join(folder, f"{Path(db_name).stem}_{stamp}{label}.db")
+    partial = final + BACKUP_PARTIAL_SUFFIX
+    src = sqlite3.connect(db_name)
+    dst = sqlite3.connect(partial)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep, progress=progress)
+    finally:
+        dst.close()
+        src.close()
+    try:
+        verify_backup(partial)
+    except sqlite3.DatabaseError:
+        os.remove(partial)
+        raise
+    os.replace(partial, final)
+
+    # Conservazione: le copie più vecchie oltre "keep" e gli avanzi di copie interrotte
+    for path, _, _ in list_backups(db_name)[keep:]:
+        os.remove(path)
+    for name in os.listdir(folder):
+        if name.endswith(BACKUP_PARTIAL_SUFFIX) and os.path.join(folder, name) != partial:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+    return final
+
+# --- MANUTENZIONE ---
+# Statistiche per il pianificatore (PRAGMA optimize / ANALYZE) e recupero dello spazio
+# lasciato dalle cancellazioni con incremental_vacuum, a piccoli passi mentre l'app
+# è inattiva e, entro un tempo massimo, alla chiusura.
+AUTO_VACUUM_MODES = {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}
+MAINTENANCE_VACUUM_PAGES = 128          # pagine liberate per passo
+MAINTENANCE_ANALYSIS_LIMIT = 1000       # righe campionate per indice da ANALYZE
+MAINTENANCE_SHUTDOWN_BUDGET = 2.0       # secondi concessi alla manutenzione in chiusura
+
+# --- ARCHIVIO PROGETTI ---
+# I progetti chiusi passano in un file SQLite per progetto (NP_ARCHIVIO accanto al
+# database): nel file principale resta solo la riga di progetti, con il nome del file
+# in "archivio". NP e voci archiviati si leggono su richiesta con ATTACH DATABASE.
+ARCHIVE_DIR_NAME = "NP_ARCHIVIO"
+# Nome temporaneo del file di un progetto in cancellazione, fino al commit
+ARCHIVE_DELETE_SUFFIX = ".eliminazione"
+# Indici del file di archivio per le letture di importazione e storico
+# (CREATE TABLE ... AS SELECT non conserva la chiave primaria)
+ARCHIVE_INDEXES = [
+    "CREATE UNIQUE INDEX {schema}.idx_nuovi_prezzi_id ON nuovi_prezzi(id)",
+    "CREATE INDEX {schema}.idx_nuovi_prezzi_progetto ON nuovi_prezzi(progetto_id, codice)",
+    "CREATE INDEX {schema}.idx_voci_costo_np_ordine ON voci_costo(np_id, ordine)",
+]
+
+# Firma del contenuto di un progetto (righe, versioni, id) per NP e voci: se coincide
+# tra file principale e archivio, nessuno ha modificato il progetto durante la copia
+ARCHIVE_SIGNATURE_QUERY = """
+    SELECT (SELECT COUNT(*) || ':' || TOTAL(row_version) || ':' || TOTAL(id)
+            FROM {schema}.nuovi_prezzi WHERE progetto_id = :progetto),
+           (SELECT COUNT(*) || ':' || TOTAL(v.row_version) || ':' || TOTAL(v.id)
+            FROM {schema}.voci_costo v JOIN {schema}.nuovi_prezzi n ON n.id = v.np_id
+            WHERE n.progetto_id = :progetto)
+"""
+
+# Aggregati degli NP mantenuti dai trigger delle voci: al rientro in linea ripartono
+# da zero e si ricompongono con l'inserimento delle voci
+NP_AGGREGATE_COLUMNS = ("prezzo_finale_cent", "totale_a_cent", "totale_manodopera_cent", "num_voci")
+
+def archive_dir_for(db_name):
+    return os.path.join(os.path.dirname(os.path.abspath(db_name)), ARCHIVE_DIR_NAME)
+
+def archive_file_name(project):
+    """progetto_<id>_<codice>.db: l'id rende il nome univoco, il codice lo rende leggibile"""
+    code = re.sub(r"[^\w-]+", "_", project.codice or "").strip("_")[:40]
+    return f"progetto_{project.id}_{code}.db" if code else f"progetto_{project.id}.db"
+
+# --- NP COMPOSTI (SOTTOANALISI) ---
+# Una voce può richiamare un altro NP dello stesso progetto (np_rif_id): il suo prezzo
+# unitario è il prezzo finale di quell'NP. Gli archi voce.np_id -> voce.np_rif_id formano
+# un grafo aciclico; quando un NP cambia prezzo si aggiornano, in ordine topologico e in
+# una sola transazione, solo gli NP che lo contengono direttamente o indirettamente.
+NP_REF_PRICE_MIL = MIL // CENT      # da centesimi del prezzo finale a millesimi del prezzo unitario
+
+# Voci di un NP allineate al prezzo finale degli NP che richiamano (solo quelle cambiate)
+NP_REF_ITEMS_UPDATE = f"""
+    UPDATE voci_costo SET
+        prezzo_unitario_mil = (SELECT n.prezzo_finale_cent * {NP_REF_PRICE_MIL} FROM nuovi_prezzi n WHERE n.id = voci_costo.np_rif_id),
+        row_version = row_version + 1
+    WHERE np_id = ? AND np_rif_id IS NOT NULL
+      AND prezzo_unitario_mil IS NOT (SELECT n.prezzo_finale_cent * {NP_REF_PRICE_MIL} FROM nuovi_prezzi n WHERE n.id = voci_costo.np_rif_id)
+"""
+
+def topological_order(nodes, edges):
+    """edges: coppie (richiamato, contenitore). Restituisce i nodi con ogni NP dopo
+    quelli che richiama; ValueError se il grafo contiene un ciclo."""
+    indegree = dict.fromkeys(nodes, 0)
+    parents = {node: [] for node in nodes}
+    for child, parent in edges:
+        parents[child].append(parent)
+        indegree[parent] += 1
+    ready = sorted(node for node, degree in indegree.items() if degree == 0)
+    order = []
+    while ready:
+        node = ready.pop()
+        order.append(node)
+        for parent in parents[node]:
+            indegree[parent] -= 1
+            if indegree[parent] == 0: ready.append(parent)
+    if len(order) < len(indegree):
+        raise ValueError("Riferimenti circolari tra NP: " + ", ".join(str(n) for n in sorted(set(indegree) - set(order))))
+    return order
+
+# --- STRUMENTAZIONE QUERY ---
+# Tempi per forma di istruzione (SQL con i parametri come segnaposto) e registro
+# JSONL delle query lente con il loro piano di esecuzione. Quando è disattivata il
+# costo per query è un solo controllo "profiler is None".
+SLOW_QUERY_MS = 100
+SLOW_LOG_MAX_BYTES = 1024 * 1024
+SLOW_LOG_BACKUPS = 3
+PROFILE_SAMPLES = 1000
+
+class QueryStats:
+    __slots__ = ("count", "rows", "total", "max", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, elapsed, rows):
+        # Campione circolare: i percentili restano su un numero limitato di misure
+        if len(self.samples) < PROFILE_SAMPLES:
+            self.samples.append(elapsed)
+        else:
+            self.samples[self.count % PROFILE_SAMPLES] = elapsed
+        self.count += 1
+        self.rows += rows
+        self.total += elapsed
+        if elapsed > self.max: self.max = elapsed
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+class QueryProfiler:
+    def __init__(self, slow_ms=SLOW_QUERY_MS, log_path=None):
+        self.slow_ms = slow_ms
+        self.log_path = log_path
+        self.stats = {}
+        self._shapes = {}
+        self._lock = threading.Lock()
+        self.logger = None
+        if log_path:
+            self.logger = logging.getLogger(f"np_zero.query_lente.{id(self)}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(RotatingFileHandler(log_path, maxBytes=SLOW_LOG_MAX_BYTES,
+                                                       backupCount=SLOW_LOG_BACKUPS, encoding="utf-8", delay=True))
+
+    def shape(self, query):
+        shape = self._shapes.get(query)
+        if shape is None:
+            shape = self._shapes[query] = " ".join(query.split())
+        return shape
+
+    def record(self, conn, query, params, elapsed, rows):
+        shape = self.shape(query)
+        with self._lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = QueryStats()
+            stats.add(elapsed, rows)
+        if self.logger and elapsed * 1000 >= self.slow_ms:
+            self.log_slow(conn, shape, query, params, elapsed, rows)
+
+    def log_slow(self, conn, shape, query, params, elapsed, rows):
+        try:
+            # Cursore separato: quello del chiamante conserva risultati e lastrowid
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+        except (sqlite3.Error, ValueError):
+            plan = []
+        self.logger.info(json.dumps({
+            "quando": datetime.datetime.now().isoformat(timespec="seconds"),
+            "ms": round(elapsed * 1000, 2),
+            "sql": shape,
+            "parametri": params,
+            "righe": rows,
+            "piano": plan,
+        }, ensure_ascii=False, default=str))
+
+    def summary(self):
+        """Forme di query ordinate per tempo totale (millisecondi)"""
+        with self._lock:
+            stats = list(self.stats.items())
+        result = [{
+            "sql": shape,
+            "n": st.count,
+            "p50": st.percentile(0.50) * 1000,
+            "p95": st.percentile(0.95) * 1000,
+            "max": st.max * 1000,
+            "totale": st.total * 1000,
+            "righe": st.rows,
+        } for shape, st in stats]
+        result.sort(key=lambda r: r["totale"], reverse=True)
+        return result
+
+    def close(self):
+        if self.logger:
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+                handler.close()
+
+# --- CONNESSIONI PER I THREAD DI LAVORO ---
+# La connessione principale appartiene al thread Tk. Ogni lavoro in background
+# prende in prestito una connessione dal pool (al massimo WORKER_POOL_SIZE insieme);
+# quelle di sola lettura sono aperte con l'URI mode=ro.
+WORKER_POOL_SIZE = 4
+WORKER_ACQUIRE_TIMEOUT = 30
+
+class ConnectionPool:
+    def __init__(self, db_name, size=WORKER_POOL_SIZE):
+        self.db_name = db_name
+        self.pragmas = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = {True: [], False: []}
+        self._lock = threading.Lock()
+        # Connessioni in prestito ai lavori in corso; con _suspended non se ne concedono altre
+        self._in_use = 0
+        self._suspended = False
+
+    def _connect(self, readonly):
+        if self.db_name == ":memory:":
+            raise sqlite3.OperationalError("Il database in memoria non è condivisibile tra thread")
+        uri = Path(os.path.abspath(self.db_name)).as_uri() + ("?mode=ro" if readonly else "?mode=rw")
+        # La connessione passa da un thread all'altro, ma è usata da uno solo alla volta
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+        conn.row_factory = make_record_factory()
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma}={value}").fetchall()
+        if not readonly: conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self, readonly=True):
+        if not self._slots.acquire(timeout=WORKER_ACQUIRE_TIMEOUT):
+            raise sqlite3.OperationalError("Troppi lavori in background: nessuna connessione libera")
+        try:
+            with self._lock:
+                if self._suspended:
+                    raise sqlite3.OperationalError("Database in manutenzione (ripristino o VACUUM): riprovare al termine")
+                idle = self._idle[readonly]
+                conn = idle.pop() if idle else None
+                self._in_use += 1
+            try:
+                return conn or self._connect(readonly)
+            except BaseException:
+                with self._lock: self._in_use -= 1
+                raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, readonly=True):
+        if conn.in_transaction: conn.rollback()
+        with self._lock:
+            self._idle[readonly].append(conn)
+            self._in_use -= 1
+        self._slots.release()
+
+    def in_use(self):
+        with self._lock:
+            return self._in_use
+
+    @contextmanager
+    def exclusive(self):
+        """Chiude tutte le connessioni del pool e non ne concede altre fino alla fine del
+        blocco. Rifiuta se un lavoro in background ne sta usando una: close() chiude
+        solo quelle libere."""
+        with self._lock:
+            if self._in_use:
+                raise sqlite3.OperationalError(f"Lavori in background in corso ({self._in_use}): riprovare al termine")
+            self._suspended = True
+            for conns in self._idle.values():
+                for conn in conns: conn.close()
+                conns.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._suspended = False
+
+    def configure(self, pragmas):
+        """PRAGMA di connessione del profilo attivo (journal_mode escluso: è del file)"""
+        self.pragmas = {k: v for k, v in pragmas.items() if k != "journal_mode"}
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns: conn.close()
+                conns.clear()
+
+    def close(self):
+        self.configure(self.pragmas)
+
+# --- GESTIONE DATABASE ---
+class Database:
+    def __init__(self, db_name="np_zero.db", profile=None):
+        self.db_name = db_name
+        # Stato per thread: connessione, cursore e livello di transazione. Il thread
+        # che crea il Database usa la connessione principale, gli altri quella di worker()
+        self._local = threading.local()
+        # Autocommit: le transazioni sono gestite esplicitamente da transaction()
+        self._local.conn = sqlite3.connect(db_name, isolation_level=None)
+        self._local.conn.row_factory = make_record_factory()
+        self._local.cursor = self._local.conn.cursor()
+        self._local.tx_depth = 0
+        # Riepiloghi NP calcolati e tabelle di riferimento (tabella -> (token, righe, righe
+        # per id)), per connessione: il change_token dipende dalla connessione
+        self._local.summaries = {}
+        self._local.references = {}
+        self.pool = ConnectionPool(db_name)
+        self.profiler = None
+        # Contatori di generazione per tabella, incrementati da ogni scrittura di questa connessione
+        self.generations = {}
+        self._generations_lock = threading.Lock()
+        # Statistiche della cache di riferimento, sommate su tutti i thread
+        self._cache_stats_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # File nuovo: vacuum incrementale fin dall'inizio (sui file esistenti serve un VACUUM)
+        if self._fetchone("PRAGMA page_count")[0] == 0:
+            self._execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.migrate()
+        self._execute("PRAGMA foreign_keys=ON")
+        self.has_fts = bool(self._fetchone("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name='voci_costo_fts')")[0])
+        # Priorità: profilo esplicito, scelta salvata nel file, rilevamento automatico
+        self.profile = profile or self.get_setting("profilo_connessione") or detect_connection_profile(db_name)
+        self.apply_connection_profile(self.profile)
+        if self.get_setting("registro_query") == "1":
+            self.enable_profiling(self.get_setting("soglia_query_lente_ms", SLOW_QUERY_MS), persist=False)
+
+    # --- CONNESSIONE DEL THREAD CORRENTE ---
+    def _bound(self, name):
+        try:
+            return getattr(self._local, name)
+        except AttributeError:
+            raise RuntimeError("Nessuna connessione per questo thread: usare 'with db.worker():'") from None
+
+    @property
+    def conn(self):
+        return self._bound("conn")
+
+    @property
+    def cursor(self):
+        return self._bound("cursor")
+
+    @property
+    def _tx_depth(self):
+        return self._bound("tx_depth")
+
+    @_tx_depth.setter
+    def _tx_depth(self, value):
+        self._local.tx_depth = value
+
+    @contextmanager
+    def worker(self, readonly=True):
+        """Lega al thread corrente una connessione del pool per la durata del blocco;
+        dentro il blocco tutti i metodi del Database si possono usare normalmente."""
+        if getattr(self._local, "conn", None) is not None:
+            # Thread principale o blocco annidato: connessione già disponibile
+            yield self
+            return
+        conn = self.pool.acquire(readonly)
+        self._local.conn, self._local.cursor, self._local.tx_depth = conn, conn.cursor(), 0
+        self._local.summaries, self._local.references = {}, {}
+        try:
+            yield self
+        finally:
+            del self._local.conn, self._local.cursor, self._local.tx_depth, self._local.summaries, self._local.references
+            self.pool.release(conn, readonly)
+
+    # --- ESECUZIONE (unico punto strumentato) ---
+    def _run(self, method, query, params):
+        """Esegue sul cursore; fuori da una transazione ritenta se il file resta bloccato
+        oltre il busy_timeout. Dentro una transazione l'errore risale: il blocco intero
+        si ritenta solo se è stato avviato con run_transaction"""
+        try:
+            return method(query, params)
+        except sqlite3.OperationalError as e:
+            if self._tx_depth or not is_busy_error(e): raise
+            for attempt in range(BUSY_RETRIES):
+                time.sleep(busy_delay(attempt))
+                try:
+                    return method(query, params)
+                except sqlite3.OperationalError as retry_error:
+                    if not is_busy_error(retry_error): raise
+            raise
+
+    def _execute(self, query, params=()):
+        if self.profiler is None:
+            return self._run(self.cursor.execute, query, params)
+        start = time.perf_counter()
+        self._run(self.cursor.execute, query, params)
+        self.profiler.record(self.conn, query, params, time.perf_counter() - start, max(self.cursor.rowcount, 0))
+        return self.cursor
+
+    def _executemany(self, query, seq_of_params):
+        if self.profiler is None:
+            return self._run(self.cursor.executemany, query, seq_of_params)
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        self._run(self.cursor.executemany, query, seq_of_params)
+        # Nel registro compare il primo gruppo di parametri
+        first = seq_of_params[0] if seq_of_params else ()
+        self.profiler.record(self.conn, query, first, time.perf_counter() - start, len(seq_of_params))
+        return self.cursor
+
+    def _fetchall(self, query, params=()):
+        if self.profiler is None:
+            return self._run(self.cursor.execute, query, params).fetchall()
+        start = time.perf_counter()
+        self._run(self.cursor.execute, query, params)
+        rows = self.cursor.fetchall()
+        self.profiler.record(self.conn, query, params, time.perf_counter() - start, len(rows))
+        return rows
+
+    def _fetchone(self, query, params=()):
+        if self.profiler is None:
+            return self._run(self.cursor.execute, query, params).fetchone()
+        start = time.perf_counter()
+        self._run(self.cursor.execute, query, params)
+        row = self.cursor.fetchone()
+        self.profiler.record(self.conn, query, params, time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    # --- STRUMENTAZIONE ---
+    def slow_log_path(self):
+        if self.db_name == ":memory:": return None
+        return os.path.splitext(os.path.abspath(self.db_name))[0] + "_query_lente.jsonl"
+
+    def enable_profiling(self, slow_ms=SLOW_QUERY_MS, persist=True):
+        """Attiva i tempi per query; persist salva la scelta nel file"""
+        try:
+            slow_ms = float(slow_ms)
+        except (TypeError, ValueError):
+            slow_ms = SLOW_QUERY_MS
+        if self.profiler: self.profiler.close()
+        self.profiler = QueryProfiler(slow_ms, self.slow_log_path())
+        if persist:
+            self.set_setting("registro_query", "1")
+            self.set_setting("soglia_query_lente_ms", f"{slow_ms:g}")
+
+    def disable_profiling(self, persist=True):
+        if self.profiler: self.profiler.close()
+        self.profiler = None
+        if persist: self.set_setting("registro_query", None)
+
+    def query_stats(self):
+        return self.profiler.summary() if self.profiler else []
+
+    def schema_version(self):
+        return self._fetchone("PRAGMA user_version")[0]
+
+    def migrate(self):
+        # Percorso rapido: schema già aggiornato, nessuna scrittura e nessun lock
+        if self.schema_version() >= SCHEMA_VERSION: return
+
+        # Le foreign key restano sospese durante le migrazioni (ricostruzione tabelle)
+        # e vengono verificate prima del commit
+        fk_enabled = self._fetchone("PRAGMA foreign_keys")[0]
+        self._execute("PRAGMA foreign_keys=OFF")
+        try:
+            with self.transaction():
+                # Rilettura sotto lock: un altro utente potrebbe aver appena migrato il file condiviso
+                current = self.schema_version()
+                for version, _, steps in SCHEMA_MIGRATIONS:
+                    if version <= current: continue
+                    for step in steps:
+                        if callable(step):
+                            step(self.cursor)
+                        else:
+                            self._execute(step)
+                    self._execute(f"PRAGMA user_version = {version}")
+                violations = self._fetchall("PRAGMA foreign_key_check")
+                if violations:
+                    raise sqlite3.IntegrityError(f"Migrazione annullata: {len(violations)} violazioni di foreign key")
+        finally:
+            if fk_enabled: self._execute("PRAGMA foreign_keys=ON")
+
+    # --- IMPOSTAZIONI E PROFILO DI CONNESSIONE ---
+    def get_setting(self, key, default=None):
+        row = self._fetchone("SELECT valore FROM impostazioni WHERE chiave=?", (key,))
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        if value is None:
+            self._execute("DELETE FROM impostazioni WHERE chiave=?", (key,))
+        else:
+            self._execute("INSERT OR REPLACE INTO impostazioni (chiave, valore) VALUES (?, ?)", (key, str(value)))
+        self.touch("impostazioni")
+
+    def apply_connection_profile(self, name):
+        if name not in CONNECTION_PROFILES:
+            raise ValueError(f"Profilo di connessione sconosciuto: {name}")
+        for pragma, value in CONNECTION_PROFILES[name].items():
+            self._fetchall(f"PRAGMA {pragma}={value}")
+        self.pool.configure(CONNECTION_PROFILES[name])
+        self.profile = name
+
+    def set_connection_profile(self, name):
+        """Salva il profilo per questo file (None = rilevamento automatico) e lo applica subito"""
+        self.set_setting("profilo_connessione", name)
+        self.apply_connection_profile(name or detect_connection_profile(self.db_name))
+
+    def connection_settings(self):
+        """Valori effettivamente attivi sulla connessione, riletti da SQLite"""
+        def pragma(name):
+            row = self._fetchone(f"PRAGMA {name}")
+            return row[0] if row else None
+        return {
+            "profilo": self.profile,
+            "journal_mode": pragma("journal_mode"),
+            "synchronous": SYNCHRONOUS_LEVELS.get(pragma("synchronous"), pragma("synchronous")),
+            "cache_size": pragma("cache_size"),
+            "mmap_size": pragma("mmap_size"),
+            "temp_store": TEMP_STORE_MODES.get(pragma("temp_store"), pragma("temp_store")),
+            "busy_timeout": pragma("busy_timeout"),
+            "page_size": pragma("page_size"),
+        }
+
+    # --- TRANSAZIONI ---
+    @contextmanager
+    def transaction(self):
+        """Raggruppa più scritture in un unico commit; i livelli annidati usano SAVEPOINT"""
+        depth = self._tx_depth
+        if depth == 0:
+            self._execute("BEGIN IMMEDIATE")
+        else:
+            self._execute(f"SAVEPOINT sp_{depth}")
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth = depth
+            if depth == 0:
+                # SQLite può aver già annullato da sé (disco pieno, I/O, interrupt):
+                # un ROLLBACK senza transazione coprirebbe l'errore originale
+                if self.conn.in_transaction:
+                    self._execute("ROLLBACK")
+            else:
+                self._execute(f"ROLLBACK TO sp_{depth}")
+                self._execute(f"RELEASE sp_{depth}")
+            raise
+        self._tx_depth = depth
+        if depth == 0:
+            try:
+                self._execute("COMMIT")
+            except Exception:
+                if self.conn.in_transaction:
+                    self._execute("ROLLBACK")
+                raise
+        else:
+            self._execute(f"RELEASE sp_{depth}")
+
+    def run_transaction(self, fn):
+        """Esegue fn() in una transazione e ne restituisce il risultato. Se il file resta
+        bloccato oltre il busy_timeout il blocco viene annullato e rieseguito da capo,
+        con le stesse attese di _run: fn deve poter essere ripetuta. Dentro una
+        transazione già aperta non ritenta (lo fa il blocco esterno)."""
+        if self._tx_depth:
+            with self.transaction():
+                return fn()
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                with self.transaction():
+                    return fn()
+            except sqlite3.OperationalError as e:
+                if attempt == BUSY_RETRIES or not is_busy_error(e): raise
+            time.sleep(busy_delay(attempt))
+
+    def in_transaction(self):
+        return self._tx_depth > 0
+
+    def select_specific(self, table, columns, where_clause="", params=()):
+        cols_str = ", ".join(columns)
+        query = f"SELECT id, {cols_str} FROM {table} {where_clause}"
+        return self._fetchall(query, params)
+
+    def select_page(self, table, columns, sort_column="id", descending=False,
+                    where_clause="", params=(), token=None, page_size=LISTING_PAGE_SIZE):
+        """Una pagina di (id, columns...) ordinata per (sort_column, id).
+        Restituisce (righe, token_precedente, token_successivo); None se non ci sono altre pagine."""
+        if sort_column not in TABLE_COLUMNS[table] or (sort_column != "id" and sort_column not in columns):
+            raise ValueError(f"Colonna di ordinamento non valida: {sort_column}")
+        direction, key = "next", None
+        if token:
+            direction, value, last_id = decode_page_token(token)
+            key = (value, last_id)
+        # La pagina precedente si legge percorrendo l'ordinamento al contrario
+        ascending = descending == (direction == "prev")
+        order = "ASC" if ascending else "DESC"
+        order_by = f"ORDER BY id {order}" if sort_column == "id" else f"ORDER BY {sort_column} {order}, id {order}"
+        cols_str = ", ".join(columns)
+
+        rows = []
+        for condition, condition_params in _keyset_segments(sort_column, ascending, key):
+            where = f"{where_clause} AND ({condition})" if where_clause else f"WHERE {condition}"
+            query = f"SELECT id, {cols_str} FROM {table} {where} {order_by} LIMIT ?"
+            # Una riga in più dice se esiste un'altra pagina in questa direzione
+            rows += self._fetchall(query, list(params) + condition_params + [page_size + 1 - len(rows)])
+            if len(rows) > page_size:
+                break
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if direction == "prev":
+            rows.reverse()
+        if not rows:
+            return rows, None, None
+
+        first, last = rows[0], rows[-1]
+        prev_token = encode_page_token("prev", getattr(first, sort_column), first.id)
+        next_token = encode_page_token("next", getattr(last, sort_column), last.id)
+        if direction == "next":
+            return rows, prev_token if key else None, next_token if more else None
+        return rows, prev_token if more else None, next_token
+
+    def fetch_all(self, table, where_clause="", params=(), columns=None):
+        """Righe come record: di default tutte le colonne note della tabella.
+        table può indicare lo schema (es. "archivio_3.voci_costo")."""
+        cols_str = ", ".join(columns or TABLE_COLUMNS[table.rsplit(".", 1)[-1]])
+        query = f"SELECT {cols_str} FROM {table} {where_clause}"
+        return self._fetchall(query, params)
+    
+    def fetch_one(self, table, where_clause="", params=(), columns=None):
+        cols_str = ", ".join(columns or TABLE_COLUMNS[table.rsplit(".", 1)[-1]])
+        query = f"SELECT {cols_str} FROM {table} {where_clause}"
+        return self._fetchone(query, params)
+
+    def get_max_order(self, np_id):
+        query = "SELECT MAX(ordine) FROM voci_costo WHERE np_id=?"
+        val = self._fetchone(query, (np_id,))[0]
+        return val if val is not None else 0
+
+    def insert(self, table, data):
+        columns = ', '.join(data.keys())
+        placeholders = ', '.join(['?'] * len(data))
+        values = list(data.values())
+        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+        cursor = self._execute(query, values)
+        self.touch(table)
+        return cursor.lastrowid 
+
+    def delete(self, table, record_id, version=None):
+        """Con version la cancellazione avviene solo se nessuno ha modificato il record nel frattempo"""
+        if version is None:
+            self._execute(f"DELETE FROM {table} WHERE id=?", (record_id,))
+        elif not self._execute(f"DELETE FROM {table} WHERE id=? AND row_version=?", (record_id, version)).rowcount:
+            self._raise_conflict(table, [record_id])
+        self.touch(table)
+
+    def update(self, table, record_id, data, version=None):
+        """Aggiorna e incrementa row_version. Con version (letta insieme ai dati) solleva
+        ConflictError se un altro utente ha salvato per primo, invece di sovrascriverlo."""
+        set_clause = ', '.join([f"{k}=?" for k in data.keys()])
+        values = list(data.values()) + [record_id]
+        if table in VERSIONED_TABLES:
+            set_clause += ", row_version = row_version + 1"
+        query = f"UPDATE {table} SET {set_clause} WHERE id=?"
+        if version is not None:
+            query += " AND row_version=?"
+            values.append(version)
+        if not self._execute(query, values).rowcount and version is not None:
+            self._raise_conflict(table, [record_id])
+        self.touch(table)
+
+    def _raise_conflict(self, table, record_ids):
+        placeholders = ', '.join(['?'] * len(record_ids))
+        existing = self._fetchone(f"SELECT COUNT(*) FROM {table} WHERE id IN ({placeholders})", list(record_ids))[0]
+        self.touch(table)
+        raise ConflictError(table, record_ids, deleted=existing < len(record_ids))
+
+    # --- SCRITTURE MULTIRIGA (un solo commit per l'intero blocco) ---
+    def insert_many(self, table, rows):
+        """rows: lista di dizionari con le stesse chiavi"""
+        if not rows: return 0
+        keys = list(rows[0].keys())
+        columns = ', '.join(keys)
+        placeholders = ', '.join(['?'] * len(keys))
+        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+        with self.transaction():
+            self._executemany(query, [[r[k] for k in keys] for r in rows])
+        self.touch(table)
+        return len(rows)
+
+    def update_many(self, table, rows, versions=None):
+        """rows: lista di coppie (record_id, dati) con le stesse chiavi nei dati.
+        versions: {record_id: row_version letta}; se un record è cambiato nel frattempo
+        l'intero blocco viene annullato con ConflictError."""
+        if not rows: return 0
+        keys = list(rows[0][1].keys())
+        set_clause = ', '.join([f"{k}=?" for k in keys])
+        if table in VERSIONED_TABLES:
+            set_clause += ", row_version = row_version + 1"
+        query = f"UPDATE {table} SET {set_clause} WHERE id=?"
+        with self.transaction():
+            if versions:
+                # Un'istruzione per riga: serve il rowcount di ciascuna
+                conflicts = [record_id for record_id, data in rows
+                             if record_id in versions and not self._execute(
+                                 query + " AND row_version=?",
+                                 [data[k] for k in keys] + [record_id, versions[record_id]]).rowcount]
+                if conflicts:
+                    self._raise_conflict(table, conflicts)
+                unversioned = [[data[k] for k in keys] + [record_id]
+                               for record_id, data in rows if record_id not in versions]
+                if unversioned:
+                    self._executemany(query, unversioned)
+            else:
+                self._executemany(query, [[data[k] for k in keys] + [record_id] for record_id, data in rows])
+        self.touch(table)
+        return len(rows)
+
+    def delete_many(self, table, record_ids):
+        if not record_ids: return 0
+        with self.transaction():
+            self._executemany(f"DELETE FROM {table} WHERE id=?", [(rid,) for rid in record_ids])
+        self.touch(table)
+        return len(record_ids)
+
+    # --- INTEGRITÀ REFERENZIALE ---
+    def find_orphans(self):
+        """Conta le righe orfane per tabella (sola lettura, nessun lock di scrittura)"""
+        report = {}
+        for table, condition in ORPHAN_CHECKS:
+            report[table] = self._fetchone(f"SELECT COUNT(*) FROM {table} WHERE {condition}")[0]
+        return report
+
+    def purge_orphans(self):
+        """Elimina gli orfani con un'unica DELETE insiemistica per tabella"""
+        report = self.find_orphans()
+        if not any(report.values()): return report
+        with self.transaction():
+            for table, condition in ORPHAN_CHECKS:
+                report[table] = self._execute(f"DELETE FROM {table} WHERE {condition}").rowcount
+                self.touch(table)
+        return report
+
+    # --- NP COMPOSTI ---
+    def np_dependency_graph(self, np_ids):
+        """NP che contengono, anche indirettamente, quelli indicati (compresi) e gli archi
+        (richiamato, contenitore) tra di essi. Una lettura per NP sull'indice di np_rif_id."""
+        nodes, edges = set(np_ids), set()
+        queue = list(nodes)
+        while queue:
+            child = queue.pop()
+            for row in self._fetchall("SELECT DISTINCT np_id FROM voci_costo WHERE np_rif_id=?", (child,)):
+                edges.add((child, row.np_id))
+                if row.np_id not in nodes:
+                    nodes.add(row.np_id)
+                    queue.append(row.np_id)
+        return nodes, edges
+
+    def check_np_reference(self, np_id, np_rif_id):
+        """Verifica che una voce dell'NP np_id possa richiamare np_rif_id e ne restituisce il record"""
+        np_rec = self.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,), columns=("id", "progetto_id"))
+        rif = self.fetch_one("nuovi_prezzi", "WHERE id=?", (np_rif_id,))
+        if np_rec is None or rif is None:
+            raise ValueError("L'NP richiamato non esiste più.")
+        if rif.progetto_id != np_rec.progetto_id:
+            raise ValueError("Si possono richiamare solo NP dello stesso progetto.")
+        # Ciclo se np_rif_id contiene già, anche indirettamente, np_id (o è np_id stesso)
+        if np_rif_id in self.np_dependency_graph([np_id])[0]:
+            raise ValueError(f"L'NP {rif.codice} contiene già questo NP: il richiamo creerebbe un ciclo.")
+        return rif
+
+    def propagate_np_prices(self, np_ids):
+        """Dopo una modifica al prezzo degli NP indicati riallinea, in ordine topologico, le voci
+        che li richiamano e quindi gli NP che li contengono. Restituisce gli NP ricalcolati."""
+        nodes, edges = self.np_dependency_graph(np_ids)
+        if not edges: return []
+        containers = {parent for _, parent in edges}
+        changed = []
+        with self.transaction():
+            # Ogni NP viene aggiornato dopo tutti quelli che richiama: i trigger ne
+            # ricalcolano totale e prezzo finale prima che lo legga il suo contenitore
+            for node in topological_order(nodes, edges):
+                if node in containers and self._execute(NP_REF_ITEMS_UPDATE, (node,)).rowcount:
+                    changed.append(node)
+        if changed: self.touch("voci_costo")
+        return changed
+
+    def np_reference_candidates(self, np_id):
+        """NP dello stesso progetto richiamabili da una voce di np_id senza creare cicli"""
+        np_rec = self.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,), columns=("progetto_id",))
+        if np_rec is None: return []
+        excluded = self.np_dependency_graph([np_id])[0]
+        return [row for row in self.fetch_all("nuovi_prezzi", "WHERE progetto_id=? ORDER BY codice", (np_rec.progetto_id,),
+                                              columns=("id", "codice", "descrizione", "unita_misura", "prezzo_finale_cent"))
+                if row.id not in excluded]
+
+    # --- RICALCOLO PROGETTO ---
+    def recompute_project(self, project_id):
+        """Ricalcola dalle voci A, B, sicurezza, C, D e manodopera di tutti gli NP del progetto
+        (una query raggruppata) e corregge con un solo executemany gli aggregati salvati che
+        non tornano. Restituisce l'elenco ProjectNPTotals ordinato per codice."""
+        with self.transaction():
+            # Prima le voci che richiamano altri NP, se rimaste indietro
+            referenced = self._fetchall("""
+                SELECT DISTINCT v.np_rif_id FROM nuovi_prezzi n JOIN voci_costo v ON v.np_id = n.id
+                WHERE n.progetto_id = ? AND v.np_rif_id IS NOT NULL""", (project_id,))
+            self.propagate_np_prices([row.np_rif_id for row in referenced])
+            totals, fixes = [], []
+            for row in self._fetchall(PROJECT_RECOMPUTE_QUERY, (project_id,)):
+                val_b, val_sic, val_c, val_d = np_price_components(
+                    row.calc_a_cent, row.perc_spese_generali_pb, row.perc_sicurezza_pb, row.perc_utili_pb)
+                drift = (row.totale_a_cent, row.totale_manodopera_cent, row.num_voci, row.prezzo_finale_cent) \
+                    != (row.calc_a_cent, row.calc_manodopera_cent, row.calc_num_voci, val_d)
+                totals.append(ProjectNPTotals(row.id, row.codice, row.calc_a_cent, val_b, val_sic, val_c, val_d,
+                                              row.calc_manodopera_cent, row.calc_num_voci, row.prezzo_finale_cent, drift))
+                if drift:
+                    fixes.append((row.calc_a_cent, row.calc_manodopera_cent, row.calc_num_voci, val_d, row.id))
+            if fixes:
+                self._executemany("""
+                    UPDATE nuovi_prezzi SET totale_a_cent=?, totale_manodopera_cent=?, num_voci=?, prezzo_finale_cent=?
+                    WHERE id=?""", fixes)
+                self.touch("nuovi_prezzi")
+                self.propagate_np_prices([fix[-1] for fix in fixes])
+        return totals
+
+    # --- RILEVAMENTO MODIFICHE ---
+    def touch(self, table):
+        """Segna come cambiata la tabella e quelle che ne dipendono"""
+        with self._generations_lock:
+            for name in (table,) + CHANGE_DEPENDENCIES.get(table, ()):
+                self.generations[name] = self.generations.get(name, 0) + 1
+
+    def data_version(self):
+        # Cambia solo per i commit di altre connessioni (altri utenti sul file condiviso)
+        return self._fetchone("PRAGMA data_version")[0]
+
+    def change_token(self, *tables):
+        """Valore confrontabile: se non cambia, i dati delle tabelle indicate sono invariati"""
+        return (self.data_version(),) + tuple(self.generations.get(t, 0) for t in tables)
+
+    # --- CACHE TABELLE DI RIFERIMENTO ---
+    def _reference_entry(self, table):
+        if table not in REFERENCE_TABLES:
+            raise ValueError(f"{table} non è una tabella di riferimento")
+        token = self.change_token(table)
+        cache = self._bound("references")
+        entry = cache.get(table)
+        hit = bool(entry and entry[0] == token)
+        with self._cache_stats_lock:
+            if hit: self.cache_hits += 1
+            else: self.cache_misses += 1
+        if hit:
+            return entry
+        rows = tuple(self.fetch_all(table, "ORDER BY id"))
+        entry = cache[table] = (token, rows, {r.id: r for r in rows})
+        return entry
+
+    def reference_rows(self, table):
+        """Tutte le righe (record completi) di una tabella di riferimento, dalla cache"""
+        return self._reference_entry(table)[1]
+
+    def reference_row(self, table, record_id):
+        return self._reference_entry(table)[2].get(int(record_id))
+
+    def cache_stats(self):
+        return {"hit": self.cache_hits, "miss": self.cache_misses,
+                "tabelle in memoria": len(self._bound("references"))}
+
+    # --- RIPRISTINO DA BACKUP ---
+    def restore_backup(self, path):
+        """Sostituisce il contenuto del file con una copia, pagina per pagina sulla
+        connessione aperta. Prima salva una copia dello stato attuale."""
+        if self.in_transaction():
+            raise sqlite3.OperationalError("Ripristino non possibile durante una transazione")
+        verify_backup(path)
+        # Nessuna connessione di lavoro deve restare aperta sui dati sostituiti
+        with self.pool.exclusive():
+            safety = backup_database(self.db_name, keep=len(list_backups(self.db_name)) + 1, label="_pre_ripristino")
+            src = sqlite3.connect(path)
+            try:
+                src.backup(self.conn, pages=BACKUP_PAGES)
+            finally:
+                src.close()
+        # La copia può avere uno schema precedente e tutti i dati sono cambiati
+        self.migrate()
+        self._execute("PRAGMA foreign_keys=ON")
+        self.has_fts = bool(self._fetchone("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name='voci_costo_fts')")[0])
+        for table in TABLE_COLUMNS:
+            self.touch(table)
+        self._bound("references").clear()
+        return safety
+
+    # --- MANUTENZIONE ---
+    def auto_vacuum_mode(self):
+        return AUTO_VACUUM_MODES.get(self._fetchone("PRAGMA auto_vacuum")[0])
+
+    def free_pages(self):
+        return self._fetchone("PRAGMA freelist_count")[0]
+
+    def page_size(self):
+        return self._fetchone("PRAGMA page_size")[0]
+
+    def optimize(self):
+        """Aggiorna le statistiche solo dove servono (in base alle query di questa connessione)"""
+        self._execute(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}")
+        self._fetchall("PRAGMA optimize")
+
+    def analyze(self):
+        """Statistiche complete per tutti gli indici, con campionamento limitato"""
+        self._execute(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}")
+        self._execute("ANALYZE")
+
+    def incremental_vacuum(self, pages=MAINTENANCE_VACUUM_PAGES):
+        """Restituisce al file system fino a pages pagine libere; 0 se il file non è INCREMENTAL"""
+        if self.auto_vacuum_mode() != "INCREMENTAL": return 0
+        if self.in_transaction():
+            raise sqlite3.OperationalError("Vacuum non possibile durante una transazione")
+        before = self.free_pages()
+        # Il pragma libera una pagina per passo e non restituisce colonne: execute() farebbe
+        # un solo passo, executescript() lo porta a termine
+        self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return max(before - self.free_pages(), 0)
+
+    def enable_incremental_vacuum(self):
+        """Converte un file esistente ad auto_vacuum=INCREMENTAL (ricostruzione completa
+        con VACUUM) sulla connessione principale. Restituisce i byte recuperati."""
+        if self.in_transaction():
+            raise sqlite3.OperationalError("VACUUM non possibile durante una transazione")
+        before = self._fetchone("PRAGMA page_count")[0] * self.page_size()
+        # In WAL auto_vacuum non cambia: si passa temporaneamente al journal classico,
+        # che richiede di essere l'unica connessione aperta sul file
+        with self.pool.exclusive():
+            journal_mode = self._fetchone("PRAGMA journal_mode")[0]
+            if journal_mode == "wal":
+                self._fetchall("PRAGMA journal_mode=DELETE")
+            try:
+                self._execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self._execute("VACUUM")
+            finally:
+                if journal_mode == "wal":
+                    self._fetchall("PRAGMA journal_mode=WAL")
+        reclaimed = before - self._fetchone("PRAGMA page_count")[0] * self.page_size()
+        self.record_maintenance("vacuum_completo", reclaimed // self.page_size())
+        return reclaimed
+
+    def maintenance_log(self):
+        """Ultime esecuzioni e spazio recuperato, salvati nel file (impostazione "manutenzione")"""
+        try:
+            return json.loads(self.get_setting("manutenzione") or "{}")
+        except ValueError:
+            return {}
+
+    def record_maintenance(self, task, pages=0):
+        log = self.maintenance_log()
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        log[task] = now
+        if pages:
+            size = pages * self.page_size()
+            log["pagine_recuperate"] = log.get("pagine_recuperate", 0) + pages
+            log["byte_recuperati"] = log.get("byte_recuperati", 0) + size
+            log["ultimo_recupero"] = {"quando": now, "attivita": task, "pagine": pages, "byte": size}
+        self.set_setting("manutenzione", json.dumps(log))
+
+    def run_maintenance(self, budget=MAINTENANCE_SHUTDOWN_BUDGET):
+        """optimize e poi passi di incremental_vacuum finché resta tempo; restituisce le
+        pagine liberate. Pensata per la chiusura: non attende i lock oltre il budget."""
+        deadline = time.monotonic() + budget
+        self._fetchall(f"PRAGMA busy_timeout={int(budget * 1000)}")
+        pages = 0
+        try:
+            self.optimize()
+            while time.monotonic() < deadline:
+                freed = self.incremental_vacuum()
+                if not freed: break
+                pages += freed
+            self.record_maintenance("chiusura", pages)
+        finally:
+            self._fetchall(f"PRAGMA busy_timeout={CONNECTION_PROFILES[self.profile]['busy_timeout']}")
+        return pages
+
+    # --- CALCOLO NP ---
+    def np_summary(self, np_rec, items=None):
+        """Riepilogo calcolato di un NP salvato, memorizzato finché NP e voci non cambiano:
+        le stampe e gli export in serie non ricalcolano due volte lo stesso NP.
+        items: voci già lette dal chiamante; se mancano vengono lette qui."""
+        key = (self.change_token("nuovi_prezzi", "voci_costo"),
+               np_rec.perc_spese_generali_pb, np_rec.perc_sicurezza_pb, np_rec.perc_utili_pb)
+        summaries = self._bound("summaries")
+        cached = summaries.get(np_rec.id)
+        if cached and cached[0] == key:
+            return cached[1]
+        if items is None:
+            items = self.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (np_rec.id,),
+                                   columns=("categoria", "importo_cent"))
+        summary = compute_np_summary(np_rec.perc_spese_generali_pb, np_rec.perc_sicurezza_pb, np_rec.perc_utili_pb, items)
+        summaries[np_rec.id] = (key, summary)
+        return summary
+
+    # --- ARCHIVIO PROGETTI ---
+    def _project(self, project_id):
+        project = self.fetch_one("progetti", "WHERE id=?", (project_id,))
+        if project is None:
+            raise ValueError(f"Progetto inesistente: {project_id}")
+        return project
+
+    def archive_path(self, project):
+        return os.path.join(archive_dir_for(self.db_name), project.archivio) if project.archivio else None
+
+    def _attach(self, path, schema):
+        # ATTACH e DETACH non sono ammessi dentro una transazione
+        if self.in_transaction():
+            raise sqlite3.OperationalError("Archivio non collegabile durante una transazione")
+        self._execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+
+    @contextmanager
+    def attached_archive(self, project_id):
+        """Schema da cui leggere NP e voci del progetto: "main" se è in linea, altrimenti
+        quello del suo file di archivio, collegato per la durata del blocco"""
+        project = self._project(project_id)
+        if not project.archivio:
+            yield "main"
+            return
+        path = self.archive_path(project)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File di archivio mancante: {path}")
+        schema = f"archivio_{project.id}"
+        self._attach(path, schema)
+        try:
+            yield schema
+        finally:
+            self._execute(f"DETACH DATABASE {schema}")
+
+    def _archive_signature(self, schema, project_id):
+        return tuple(self._fetchone(ARCHIVE_SIGNATURE_QUERY.format(schema=schema), {"progetto": project_id}))
+
+    def archive_project(self, project_id):
+        """Sposta NP e voci del progetto nel suo file di archivio; in progetti resta la
+        riga con il nome del file. Restituisce il percorso dell'archivio."""
+        project = self._project(project_id)
+        if project.archivio:
+            raise ValueError(f"Il progetto {project.codice} è già archiviato")
+        if self.db_name == ":memory:":
+            raise ValueError("Archiviazione non disponibile per un database in memoria")
+        folder = archive_dir_for(self.db_name)
+        os.makedirs(folder, exist_ok=True)
+        name = archive_file_name(project)
+        final = os.path.join(folder, name)
+        partial = final + BACKUP_PARTIAL_SUFFIX
+        if os.path.exists(partial): os.remove(partial)
+
+        # 1) Copia in un file nuovo, verificata e rinominata solo se completa.
+        # Il file principale non cambia: un'interruzione lascia al più un file parziale.
+        def copy():
+            self._execute("CREATE TABLE archivio_nuovo.progetti AS SELECT * FROM main.progetti WHERE id=?", (project.id,))
+            self._execute("CREATE TABLE archivio_nuovo.nuovi_prezzi AS SELECT * FROM main.nuovi_prezzi WHERE progetto_id=?", (project.id,))
+            self._execute("""
+                CREATE TABLE archivio_nuovo.voci_costo AS
+                SELECT v.* FROM main.voci_costo v JOIN main.nuovi_prezzi n ON n.id = v.np_id
+                WHERE n.progetto_id=? ORDER BY v.np_id, v.ordine
+            """, (project.id,))
+            for statement in ARCHIVE_INDEXES:
+                self._execute(statement.format(schema="archivio_nuovo"))
+            self._execute(f"PRAGMA archivio_nuovo.user_version = {SCHEMA_VERSION}")
+        self._attach(partial, "archivio_nuovo")
+        try:
+            self.run_transaction(copy)
+        except BaseException:
+            self._execute("DETACH DATABASE archivio_nuovo")
+            os.remove(partial)
+            raise
+        self._execute("DETACH DATABASE archivio_nuovo")
+        try:
+            verify_backup(partial)
+        except sqlite3.DatabaseError:
+            os.remove(partial)
+            raise
+        os.replace(partial, final)
+
+        # 2) Rimozione dal file principale in un'unica transazione, solo se il progetto
+        # è ancora identico alla copia (nessun altro utente lo ha modificato nel frattempo)
+        def remove():
+            if self._archive_signature("main", project.id) != self._archive_signature("archivio_nuovo", project.id):
+                self._raise_conflict("progetti", [project.id])
+            self._execute("DELETE FROM voci_costo WHERE np_id IN (SELECT id FROM nuovi_prezzi WHERE progetto_id=?)", (project.id,))
+            self._execute("DELETE FROM nuovi_prezzi WHERE progetto_id=?", (project.id,))
+            self._execute("UPDATE progetti SET archivio=?, row_version = row_version + 1 WHERE id=?", (name, project.id))
+        self._attach(final, "archivio_nuovo")
+        moved = False
+        try:
+            self.run_transaction(remove)
+            moved = True
+        finally:
+            self._execute("DETACH DATABASE archivio_nuovo")
+            if not moved: os.remove(final)
+        self.touch("progetti")
+        return final
+
+    def _archive_columns(self, table, schema):
+        """Colonne da riportare in linea: quelle scrivibili della tabella principale
+        (niente colonne generate né aggregati) presenti anche nel file di archivio"""
+        archived = {row[1] for row in self._fetchall(f"PRAGMA {schema}.table_info({table})")}
+        return [row[1] for row in self._fetchall(f"PRAGMA main.table_xinfo({table})")
+                if row[6] == 0 and row[1] in archived and row[1] not in NP_AGGREGATE_COLUMNS]
+
+    def unarchive_project(self, project_id):
+        """Riporta NP e voci dall'archivio nel file principale, con gli stessi id
+        (AUTOINCREMENT non li riassegna), e poi elimina il file di archivio"""
+        project = self._project(project_id)
+        if not project.archivio:
+            raise ValueError(f"Il progetto {project.codice} non è archiviato")
+        path = self.archive_path(project)
+        def restore(schema):
+            # Prima gli NP, poi le voci: i trigger ricalcolano i totali come per un inserimento
+            for table in ("nuovi_prezzi", "voci_costo"):
+                columns = ", ".join(self._archive_columns(table, schema))
+                self._execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM {schema}.{table} ORDER BY id")
+            self._execute("UPDATE progetti SET archivio=NULL, row_version = row_version + 1 WHERE id=?", (project.id,))
+        with self.attached_archive(project.id) as schema:
+            self.run_transaction(lambda: restore(schema))
+        os.remove(path)
+        self.touch("progetti")
+
+    def delete_project(self, project_id, version=None):
+        """Cancella il progetto (NP e voci in cascata) insieme al suo file di archivio,
+        che altrimenti resterebbe orfano in NP_ARCHIVIO. Il file viene prima spostato da
+        parte e rimesso al suo posto se la cancellazione non va a buon fine."""
+        project = self._project(project_id)
+        path = self.archive_path(project)
+        staged = path + ARCHIVE_DELETE_SUFFIX if path and os.path.exists(path) else None
+        if staged: os.replace(path, staged)
+        try:
+            self.run_transaction(lambda: self.delete("progetti", project.id, version=version))
+        except BaseException:
+            if staged: os.replace(staged, path)
+            raise
+        if staged: os.remove(staged)
+
+    # --- RICERCA VOCI DA STORICO ---
+    def search_cost_items(self, project_id, text="", limit=HISTORY_SEARCH_LIMIT, schema="main"):
+        """Voci distinte (categoria, descrizione, um, prezzo) usate nel progetto, filtrate per testo.
+        schema: file collegato da cui leggere (gli archivi non hanno l'indice full-text)."""
+        tokens = re.findall(r"\w+", text)
+        if schema == "main" and not tokens:
+            return self._fetchall(HISTORY_QUERY, (project_id, limit))
+        elif schema == "main" and self.has_fts:
+            return self._fetchall(HISTORY_FTS_QUERY, (fts_match_expression(text), project_id, limit))
+        else:
+            conditions = "".join([" AND (v.descrizione LIKE ? OR v.categoria LIKE ?)"] * len(tokens))
+            params = [project_id]
+            for token in tokens: params += [f"%{token}%", f"%{token}%"]
+            return self._fetchall(f"""
+                SELECT DISTINCT TRIM(v.categoria) AS categoria, TRIM(v.descrizione) AS descrizione,
+                       TRIM(v.um) AS um, v.prezzo_unitario_mil
+                FROM {schema}.voci_costo v
+                JOIN {schema}.nuovi_prezzi n ON v.np_id = n.id
+                WHERE n.progetto_id = ?{conditions}
+                ORDER BY 1, 2
+                LIMIT ?
+            """, params + [limit])
+
+    def search_archived_cost_items(self, text="", limit=HISTORY_SEARCH_LIMIT):
+        """Come search_cost_items sui progetti archiviati, collegando un file alla volta"""
+        rows, seen = [], set()
+        for project in self.reference_rows("progetti"):
+            if not project.archivio: continue
+            if len(rows) >= limit: break
+            try:
+                with self.attached_archive(project.id) as schema:
+                    found = self.search_cost_items(project.id, text, limit - len(rows), schema=schema)
+            except FileNotFoundError:
+                continue
+            for row in found:
+                if row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+        return rows
+
+# --- LAVORI IN BACKGROUND ---
+def run_in_background(widget, job, on_done, poll_ms=200):
+    """Esegue job() in un thread e poi on_done(risultato, errore) nel thread Tk.
+    job non deve toccare i widget; per il database usa 'with db.worker():'."""
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = job()
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    def poll():
+        if thread.is_alive():
+            widget.after(poll_ms, poll)
+        else:
+            on_done(outcome.get("result"), outcome.get("error"))
+    widget.after(poll_ms, poll)
+    return thread
+
+def show_db_error(error, title="Errore Database", parent=None):
+    """Errore di scrittura: un file bloccato da un altro utente è un'attesa, non un guasto"""
+    options = {"parent": parent} if parent else {}
+    if is_busy_error(error):
+        messagebox.showwarning("Database occupato", "Il database è occupato da un altro utente.\n"
+                               "Nulla è stato salvato: riprova tra qualche istante.", **options)
+    else:
+        messagebox.showerror(title, str(error), **options)
+
+# --- FINESTRA DI IMPORTAZIONE ---
+class ImportDialog(tk.Toplevel):
+    def __init__(self, parent, db, current_project_id, on_import_callback):
+        super().__init__(parent)
+        self.title("Importa NP da altro progetto")
+        self.geometry("600x400")
+        self.db = db
+        self.current_project_id = current_project_id
+        self.source_project_id = None
+        self.on_import_callback = on_import_callback
+        
+        ttk.Label(self, text="1. Seleziona Progetto di Origine:", font=("Arial", 10, "bold")).pack(pady=5)
+        
+        self.combo_proj = ttk.Combobox(self, state="readonly", width=50)
+        self.combo_proj.pack(pady=5)
+        self.combo_proj.bind("<<ComboboxSelected>>", self.load_nps)
+        
+        ttk.Label(self, text="2. Seleziona NP da Copiare:", font=("Arial", 10, "bold")).pack(pady=5)
+        
+        cols = ("codice", "desc")
+        self.tree = ttk.Treeview(self, columns=cols, show="headings", height=10)
+        self.tree.heading("codice", text="Codice")
+        self.tree.heading("desc", text="Descrizione")
+        self.tree.column("codice", width=100)
+        self.tree.column("desc", width=400)
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        btn_import = ttk.Button(self, text="IMPORTA SELEZIONATO", command=self.do_import)
+        btn_import.pack(pady=10, fill="x", padx=20)
+        
+        self.load_projects()
+
+    def load_projects(self):
+        projs = self.db.reference_rows("progetti")
+        self.proj_map = {}
+        values = []
+        for p in projs:
+            if p.id != self.current_project_id:
+                label = f"{p.codice} - {p.titolo}" + (" [archivio]" if p.archivio else "")
+                values.append(label)
+                self.proj_map[label] = p.id
+        self.combo_proj['values'] = values
+
+    def load_nps(self, event):
+        for row in self.tree.get_children(): self.tree.delete(row)
+        selected_label = self.combo_proj.get()
+        if not selected_label: return
+        
+        pid = self.proj_map[selected_label]
+        self.source_project_id = pid
+        # I progetti archiviati si leggono dal loro file, collegato solo per questa lettura
+        try:
+            with self.db.attached_archive(pid) as schema:
+                nps = self.db.fetch_all(f"{schema}.nuovi_prezzi", "WHERE progetto_id=?", (pid,), columns=("id", "codice", "descrizione"))
+        except (FileNotFoundError, sqlite3.Error) as e:
+            messagebox.showerror("Errore Archivio", str(e), parent=self)
+            return
+        for np in nps:
+            self.tree.insert("", "end", iid=np.id, values=(np.codice, np.descrizione))
+
+    def do_import(self):
+        sel = self.tree.selection()
+        if not sel:
+            messagebox.showwarning("Attenzione", "Seleziona un NP dalla lista")
+            return
+        
+        source_np_id = sel[0]
+        self.on_import_callback(source_np_id, self.source_project_id)
+        self.destroy()
+
+# --- CLASSE PER FILTRO STORICO ---
+class HistoryDialog(tk.Toplevel):
+    def __init__(self, parent, db, project_id, callback):
+        super().__init__(parent)
+        self.title("Cerca voce da storico progetto")
+        self.geometry("700x500")
+        self.db = db
+        self.project_id = project_id
+        self.callback = callback
+
+        ttk.Label(self, text="Seleziona una voce utilizzata in altri NP di questo progetto:", font=("Arial", 10, "bold")).pack(pady=10)
+        
+        # Search box
+        search_frame = ttk.Frame(self)
+        search_frame.pack(fill="x", padx=10, pady=5)
+        ttk.Label(search_frame, text="Filtra:").pack(side="left")
+        self.search_var = tk.StringVar()
+        self.search_var.trace("w", self.schedule_filter)
+        self._filter_job = None
+        ttk.Entry(search_frame, textvariable=self.search_var).pack(side="left", fill="x", expand=True, padx=5)
+        self.include_archived = tk.BooleanVar(value=False)
+        ttk.Checkbutton(search_frame, text="Anche progetti archiviati", variable=self.include_archived,
+                        command=self.load_data).pack(side="left")
+
+        # Treeview
+        cols = ("cat", "desc", "um", "pu")
+        self.tree = ttk.Treeview(self, columns=cols, show="headings")
+        self.tree.heading("cat", text="Categoria")
+        self.tree.heading("desc", text="Descrizione")
+        self.tree.heading("um", text="UM")
+        self.tree.heading("pu", text="Prezzo Unitario")
+        
+        self.tree.column("cat", width=100)
+        self.tree.column("desc", width=350)
+        self.tree.column("um", width=50)
+        self.tree.column("pu", width=80, anchor="e")
+        
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        self.tree.bind("<Double-1>", self.on_double_click)
+
+        self.lbl_info = ttk.Label(self, text="", font=("Arial", 8), foreground="#777")
+        self.lbl_info.pack()
+
+        btn_sel = ttk.Button(self, text="Usa Selezionato", command=self.use_selected)
+        btn_sel.pack(pady=10)
+
+        self.load_data()
+
+    def load_data(self):
+        # Voci DISTINCT con TRIM (niente duplicati "sporchi"), cercate nell'indice full-text
+        rows = self.db.search_cost_items(self.project_id, self.search_var.get(), HISTORY_SEARCH_LIMIT)
+        if self.include_archived.get() and len(rows) < HISTORY_SEARCH_LIMIT:
+            # Gli archivi si aprono solo su richiesta: uno ATTACH per progetto archiviato
+            seen = set(rows)
+            archived = self.db.search_archived_cost_items(self.search_var.get(), HISTORY_SEARCH_LIMIT)
+            rows += [row for row in archived if row not in seen][:HISTORY_SEARCH_LIMIT - len(rows)]
+        if len(rows) >= HISTORY_SEARCH_LIMIT:
+            self.lbl_info.config(text=f"Mostrate le prime {HISTORY_SEARCH_LIMIT} voci: affinare la ricerca per vedere le altre.")
+        else:
+            self.lbl_info.config(text="")
+        self.update_tree(rows)
+
+    def schedule_filter(self, *args):
+        # Attende una breve pausa nella digitazione prima di interrogare il database
+        if self._filter_job: self.after_cancel(self._filter_job)
+        self._filter_job = self.after(150, self.filter_list)
+
+    def filter_list(self, *args):
+        self._filter_job = None
+        self.load_data()
+
+    def update_tree(self, items):
+        for row in self.tree.get_children(): self.tree.delete(row)
+        self.items = items
+        for idx, item in enumerate(items):
+            pu_fmt = f"€ {from_mil(item.prezzo_unitario_mil):.3f}".replace(".", ",")
+            self.tree.insert("", "end", iid=idx, values=(item.categoria, item.descrizione, item.um, pu_fmt))
+
+    def use_selected(self):
+        sel = self.tree.selection()
+        if not sel: return
+        item = self.items[int(sel[0])]
+        self.callback(item.categoria, item.descrizione, item.um, item.prezzo_unitario_mil)
+        self.destroy()
+
+    def on_double_click(self, event):
+        self.use_selected()
+
+# --- SCELTA NP DA RICHIAMARE (SOTTOANALISI) ---
+class NPPickerDialog(tk.Toplevel):
+    """NP del progetto da usare come voce di costo; esclusi quelli che creerebbero un ciclo"""
+    def __init__(self, parent, db, np_id, callback):
+        super().__init__(parent)
+        self.title("Richiama NP come voce di costo")
+        self.geometry("700x450")
+        self.db = db
+        self.callback = callback
+        self.candidates = db.np_reference_candidates(np_id)
+
+        ttk.Label(self, text="Seleziona l'NP da richiamare (il prezzo resta allineato al suo prezzo finale):",
+                  font=("Arial", 10, "bold")).pack(pady=10)
+        search_frame = ttk.Frame(self)
+        search_frame.pack(fill="x", padx=10, pady=5)
+        ttk.Label(search_frame, text="Filtra:").pack(side="left")
+        self.search_var = tk.StringVar()
+        self.search_var.trace("w", self.filter_list)
+        ttk.Entry(search_frame, textvariable=self.search_var).pack(side="left", fill="x", expand=True, padx=5)
+
+        cols = ("codice", "desc", "um", "prezzo")
+        self.tree = ttk.Treeview(self, columns=cols, show="headings")
+        for col, text, width, anchor in (("codice", "Codice", 90, "w"), ("desc", "Descrizione", 380, "w"),
+                                         ("um", "UM", 60, "w"), ("prezzo", "Prezzo Finale", 110, "e")):
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor=anchor)
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        self.tree.bind("<Double-1>", lambda e: self.use_selected())
+
+        ttk.Button(self, text="Usa NP Selezionato", command=self.use_selected).pack(pady=10)
+        self.filter_list()
+
+    def filter_list(self, *args):
+        text = self.search_var.get().strip().lower()
+        for row in self.tree.get_children(): self.tree.delete(row)
+        for np in self.candidates:
+            if text and text not in (np.codice or "").lower() and text not in (np.descrizione or "").lower():
+                continue
+            self.tree.insert("", "end", iid=np.id, values=(np.codice, np.descrizione, np.unita_misura,
+                                                           format_currency(from_cent(np.prezzo_finale_cent))))
+
+    def use_selected(self):
+        sel = self.tree.selection()
+        if not sel: return
+        self.callback(next(np for np in self.candidates if np.id == int(sel[0])))
+        self.destroy()
+
+# --- PERCENTUALI IN BLOCCO ---
+class ReparameterizeDialog(tk.Toplevel):
+    """Nuove percentuali per tutti gli NP del progetto (o solo quelli filtrati),
+    con anteprima dei prezzi e salvataggio in un'unica transazione"""
+    PERC_FIELDS = (("perc_spese_generali_pb", "Spese Generali %"),
+                   ("perc_sicurezza_pb", "di cui Sicurezza %"),
+                   ("perc_utili_pb", "Utili %"))
+
+    def __init__(self, parent, db, project_id, on_applied):
+        super().__init__(parent)
+        self.title("Percentuali in blocco")
+        self.geometry("850x550")
+        self.db = db
+        self.project_id = project_id
+        self.on_applied = on_applied
+        self.preview = None
+
+        ttk.Label(self, text="1. Nuove percentuali (campo vuoto = invariata):", font=("Arial", 10, "bold")).pack(pady=5)
+        perc_frame = ttk.Frame(self)
+        perc_frame.pack(pady=5)
+        # Ogni modifica dei campi (tastiera, incolla, menu) invalida l'anteprima.
+        # Le StringVar restano referenziate: se raccolte, Tk ne cancella la variabile
+        self.entries, self.perc_vars = {}, {}
+        for field, label in self.PERC_FIELDS:
+            ttk.Label(perc_frame, text=label).pack(side="left", padx=(10, 2))
+            var = self.perc_vars[field] = tk.StringVar(self)
+            var.trace_add("write", self.invalidate_preview)
+            entry = ttk.Entry(perc_frame, width=8, textvariable=var)
+            entry.pack(side="left")
+            self.entries[field] = entry
+
+        ttk.Label(self, text="2. NP da aggiornare:", font=("Arial", 10, "bold")).pack(pady=5)
+        filter_frame = ttk.Frame(self)
+        filter_frame.pack(fill="x", padx=10, pady=5)
+        ttk.Label(filter_frame, text="Filtra (codice o descrizione):").pack(side="left")
+        self.filter_var = tk.StringVar(self)
+        self.filter_var.trace_add("write", self.invalidate_preview)
+        self.filter_entry = ttk.Entry(filter_frame, textvariable=self.filter_var)
+        self.filter_entry.pack(side="left", fill="x", expand=True, padx=5)
+        ttk.Button(filter_frame, text="Anteprima", command=self.update_preview).pack(side="left")
+
+        cols = ("codice", "desc", "perc", "old", "new")
+        self.tree = ttk.Treeview(self, columns=cols, show="headings")
+        for col, text, width, anchor in (("codice", "Codice", 90, "w"), ("desc", "Descrizione", 330, "w"),
+                                         ("perc", "SG / Sic. / Utili %", 170, "center"),
+                                         ("old", "Prezzo Attuale", 100, "e"), ("new", "Nuovo Prezzo", 100, "e")):
+            self.tree.heading(col, text=text)
+            self.tree.column(col, width=width, anchor=anchor)
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+
+        self.lbl_totals = ttk.Label(self, text="", font=("Arial", 9, "bold"))
+        self.lbl_totals.pack()
+        self.btn_apply = ttk.Button(self, text="3. APPLICA AGLI NP IN ANTEPRIMA", command=self.apply, state="disabled")
+        self.btn_apply.pack(pady=10, fill="x", padx=20)
+
+        self.load_nps()
+        self.update_preview()
+
+    def load_nps(self):
+        self.nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=? ORDER BY codice", (self.project_id,))
+
+    def new_values(self):
+        """Percentuali inserite (in punti base), solo quelle compilate"""
+        values = {}
+        for field, entry in self.entries.items():
+            text = entry.get().strip()
+            if not text: continue
+            values[field] = parse_perc(text)
+        return values
+
+    def invalidate_preview(self, *args):
+        # L'anteprima non corrisponde più ai campi: va rifatta prima di applicare
+        self.preview = None
+        self.btn_apply.config(state="disabled")
+        self.lbl_totals.config(text="Premi Anteprima per vedere i nuovi prezzi.")
+
+    def update_preview(self):
+        self.invalidate_preview()
+        try:
+            values = self.new_values()
+        except ValueError as e:
+            messagebox.showerror("Errore", str(e), parent=self)
+            return
+        text = self.filter_entry.get().strip().lower()
+        for row in self.tree.get_children(): self.tree.delete(row)
+        changes, total_old, total_new = [], 0, 0
+        for np in self.nps:
+            if text and text not in (np.codice or "").lower() and text not in (np.descrizione or "").lower():
+                continue
+            old_perc = tuple(getattr(np, field) for field, _ in self.PERC_FIELDS)
+            new_perc = tuple(values.get(field, getattr(np, field)) for field, _ in self.PERC_FIELDS)
+            new_price = np_price_components(np.totale_a_cent, *new_perc)[3]
+            total_old += np.prezzo_finale_cent
+            total_new += new_price
+            perc_text = " / ".join(map(format_perc, old_perc))
+            if new_perc != old_perc:
+                changes.append(np)
+                perc_text += "  ->  " + " / ".join(map(format_perc, new_perc))
+            self.tree.insert("", "end", iid=np.id, values=(np.codice, np.descrizione, perc_text,
+                                                           format_currency(from_cent(np.prezzo_finale_cent)),
+                                                           format_currency(from_cent(new_price))))
+        self.lbl_totals.config(text=f"{len(changes)} NP da aggiornare su {len(self.tree.get_children())} in elenco - "
+                                    f"Totale prezzi: {format_currency(from_cent(total_old))} -> {format_currency(from_cent(total_new))}")
+        if changes:
+            self.preview = (values, changes)
+            self.btn_apply.config(state="normal")
+
+    def apply(self):
+        if not self.preview: return
+        values, changes = self.preview
+        if not messagebox.askyesno("Conferma", f"Aggiornare le percentuali di {len(changes)} NP?", parent=self):
+            return
+        # Con le row_version lette per l'anteprima: se un altro utente ha modificato
+        # uno di questi NP nel frattempo, non si salva nulla
+        def write():
+            self.db.update_many("nuovi_prezzi", [(np.id, values) for np in changes],
+                                versions={np.id: np.row_version for np in changes})
+            self.db.propagate_np_prices([np.id for np in changes])
+        try:
+            self.db.run_transaction(write)
+        except ConflictError as e:
+            messagebox.showwarning("Modifica concorrente", f"Percentuali non salvate.\n{e}", parent=self)
+            self.load_nps()
+            self.update_preview()
+            return
+        except sqlite3.OperationalError as e:
+            show_db_error(e, "Errore Salvataggio", parent=self)
+            return
+        except (sqlite3.Error, ValueError) as e:
+            messagebox.showerror("Errore Salvataggio", f"Percentuali non salvate:\n{e}", parent=self)
+            return
+        self.on_applied([np.id for np in changes])
+        self.destroy()
+
+# --- PANNELLO CRUD (GESTIONE LAYOUT MULTIPLI) ---
+class CrudPanel(ttk.Frame):
+    def __init__(self, parent, db, table_name, fields, callbacks=None):
+        super().__init__(parent)
+        self.db = db
+        self.table_name = table_name
+        self.fields = fields 
+        self.callbacks = callbacks or {}
+        self.entries = {}
+        self.buttons = {}
+        # Stato dell'elenco paginato: filtro corrente, ordinamento lato database e
+        # token della prossima pagina (None quando l'elenco è completo)
+        self.condition, self.params = "", ()
+        self.sort_col, self.sort_desc = self.fields[0][0], False
+        self.next_token = None
+        self._page_job = None
+        self._loaded_state = None
+        self._um_token = None
+        self.row_versions = {}
+
+        self.frame_top = ttk.LabelFrame(self, text="Dati Inserimento", padding=10)
+        self.frame_top.pack(side="top", fill="x", padx=10, pady=5)
+        
+        if self.table_name == "nuovi_prezzi":
+            self.setup_custom_np_ui()
+        elif self.table_name == "progetti":
+            self.setup_custom_progetti_ui()
+        else:
+            self.setup_generic_ui()
+
+        self.frame_mid = ttk.Frame(self)
+        self.frame_mid.pack(side="top", fill="both", expand=True, padx=10, pady=5)
+
+        cols = [f[0] for f in self.fields]
+        self.tree = ttk.Treeview(self.frame_mid, columns=cols, show="headings")
+        
+        for field, label, width in self.fields:
+            align = "w"
+            if field == "prezzo_finale_cent": align = "e"
+            self.tree.heading(field, text=label, 
+                              command=lambda c=field: self.sort_column(c, False))
+            self.tree.column(field, width=width, anchor=align)
+        
+        self.tree.pack(side="left", fill="both", expand=True)
+        
+        self.sb = ttk.Scrollbar(self.frame_mid, orient="vertical", command=self.tree.yview)
+        self.sb.pack(side="left", fill="y")
+        self.tree.configure(yscroll=self.on_tree_scroll)
+
+        self.frame_btns = ttk.Frame(self.frame_mid)
+        self.frame_btns.pack(side="right", fill="y", padx=5)
+
+        self.buttons['add'] = ttk.Button(self.frame_btns, text="Nuovo", command=self.add_record)
+        self.buttons['add'].pack(fill="x", pady=2)
+        self.buttons['upd'] = ttk.Button(self.frame_btns, text="Modifica", command=self.update_record)
+        self.buttons['upd'].pack(fill="x", pady=2)
+        self.buttons['del'] = ttk.Button(self.frame_btns, text="Cancella", command=self.delete_record)
+        self.buttons['del'].pack(fill="x", pady=2)
+        self.buttons['dup'] = ttk.Button(self.frame_btns, text="Duplica", command=self.duplicate_record)
+        self.buttons['dup'].pack(fill="x", pady=2)
+        self.buttons['imp'] = ttk.Button(self.frame_btns, text="Importa da...", command=lambda: print("Implementare Wrapper")) 
+        self.buttons['imp'].pack(fill="x", pady=2)
+        
+        ttk.Separator(self.frame_btns, orient="horizontal").pack(fill="x", pady=5)
+        self.buttons['clr'] = ttk.Button(self.frame_btns, text="Pulisci", command=self.clear_fields)
+        self.buttons['clr'].pack(fill="x", pady=10)
+
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<Double-1>", self.on_double_click)
+        
+        self.refresh_data()
+
+    def setup_generic_ui(self):
+        for i, (field_name, label_text, width) in enumerate(self.fields):
+            if field_name == "prezzo_finale_cent": continue
+            container = ttk.Frame(self.frame_top)
+            container.pack(side="left", padx=5, fill="y")
+            ttk.Label(container, text=label_text, font=("Arial", 9, "bold")).pack(side="top", anchor="w")
+            entry = ttk.Entry(container, width=width // 8) 
+            entry.pack(side="top", fill="x")
+            self.entries[field_name] = entry
+
+    def setup_custom_progetti_ui(self):
+        row1 = ttk.Frame(self.frame_top)
+        row1.pack(side="top", fill="x", pady=2)
+
+        def add_field(parent, key, label, width_factor):
+            f = ttk.Frame(parent)
+            f.pack(side="left", padx=(0, 15), fill="x", expand=False)
+            ttk.Label(f, text=label, font=("Arial", 9, "bold")).pack(anchor="w")
+            e = ttk.Entry(f, width=width_factor)
+            e.pack(fill="x")
+            self.entries[key] = e
+
+        add_field(row1, 'codice', 'Codice', 15)
+        add_field(row1, 'cup', 'CUP', 15)
+        
+        f_comm = ttk.Frame(row1)
+        f_comm.pack(side="left", padx=0, fill="x", expand=True)
+        ttk.Label(f_comm, text="Committente", font=("Arial", 9, "bold")).pack(anchor="w")
+        self.entries['committente'] = ttk.Entry(f_comm)
+        self.entries['committente'].pack(fill="x")
+
+        row2 = ttk.Frame(self.frame_top)
+        row2.pack(side="top", fill="x", pady=5)
+        
+        ttk.Label(row2, text="Titolo Intervento", font=("Arial", 9, "bold")).pack(anchor="w")
+        self.entries['titolo'] = ttk.Entry(row2)
+        self.entries['titolo'].pack(fill="x")
+
+    def setup_custom_np_ui(self):
+        row1 = ttk.Frame(self.frame_top)
+        row1.pack(side="top", fill="x", pady=2)
+        
+        f_cod = ttk.Frame(row1)
+        f_cod.pack(side="left", padx=(0, 20))
+        ttk.Label(f_cod, text="Codice NP", font=("Arial", 9, "bold")).pack(anchor="w")
+        self.entries['codice'] = ttk.Entry(f_cod, width=15)
+        self.entries['codice'].pack(fill="x")
+
+        f_um = ttk.Frame(row1)
+        f_um.pack(side="left")
+        ttk.Label(f_um, text="Unità di Misura", font=("Arial", 9, "bold")).pack(anchor="w")
+        self.entries['unita_misura'] = ttk.Combobox(f_um, width=15, postcommand=self.populate_um_combo)
+        self.entries['unita_misura'].pack(fill="x")
+
+        row2 = ttk.Frame(self.frame_top)
+        row2.pack(side="top", fill="x", pady=5)
+        
+        ttk.Label(row2, text="Descrizione NP", font=("Arial", 9, "bold")).pack(anchor="w")
+        
+        txt_frame = ttk.Frame(row2)
+        txt_frame.pack(fill="x", expand=True)
+        
+        self.entries['descrizione'] = tk.Text(txt_frame, height=4, font=("Arial", 9))
+        self.entries['descrizione'].pack(side="left", fill="x", expand=True)
+        
+        sb = ttk.Scrollbar(txt_frame, orient="vertical", command=self.entries['descrizione'].yview)
+        sb.pack(side="right", fill="y")
+        self.entries['descrizione'].config(yscrollcommand=sb.set)
+
+    def populate_um_combo(self):
+        if 'unita_misura' in self.entries and isinstance(self.entries['unita_misura'], ttk.Combobox):
+            token = self.db.change_token("unita_misura")
+            if token == self._um_token: return
+            self._um_token = token
+            ums = self.db.reference_rows("unita_misura")
+            values = [u.codice for u in ums]
+            self.entries['unita_misura']['values'] = values
+
+    def sort_column(self, col, reverse):
+        # L'elenco è caricato a pagine: l'ordinamento lo fa il database
+        self.sort_col, self.sort_desc = col, reverse
+        self.refresh_data(self.condition, self.params)
+        self.tree.heading(col, command=lambda: self.sort_column(col, not reverse))
+
+    def get_data_from_ui(self):
+        data = {}
+        for field, _, _ in self.fields:
+            if field in self.entries:
+                widget = self.entries[field]
+                if isinstance(widget, tk.Text):
+                    val = widget.get("1.0", "end-1c").strip()
+                else:
+                    val = widget.get().strip()
+                data[field] = val
+        return data
+
+    def clear_fields(self):
+        for widget in self.entries.values():
+            if isinstance(widget, tk.Text):
+                widget.delete("1.0", tk.END)
+            else:
+                widget.delete(0, tk.END)
+
+    def refresh_data(self, condition="", params=()):
+        for row in self.tree.get_children(): self.tree.delete(row)
+        if self._page_job:
+            self.after_cancel(self._page_job)
+        self.condition, self.params = condition, params
+        self.next_token = None
+        self.row_versions = {}
+        self._loaded_state = (condition, params, self.db.change_token(self.table_name))
+        self.load_page()
+
+    def refresh_if_changed(self, condition="", params=()):
+        """Ricarica l'elenco solo se filtro o dati sono cambiati dall'ultimo caricamento"""
+        if (condition, params, self.db.change_token(self.table_name)) != self._loaded_state:
+            self.refresh_data(condition, params)
+
+    def load_page(self):
+        """Accoda all'elenco la pagina successiva"""
+        self._page_job = None
+        target_columns = [f[0] for f in self.fields]
+        versioned = self.table_name in VERSIONED_TABLES
+        query_columns = target_columns + ["row_version"] if versioned else target_columns
+        rows, _, self.next_token = self.db.select_page(
+            self.table_name, query_columns, self.sort_col, self.sort_desc,
+            self.condition, self.params, self.next_token)
+        for r in rows:
+            vals = list(r[1:len(target_columns) + 1])
+            if versioned: self.row_versions[str(r.id)] = r.row_version
+            for idx, f in enumerate(self.fields):
+                if f[0] == "prezzo_finale_cent" and idx < len(vals):
+                     vals[idx] = format_currency(from_cent(vals[idx]))
+            self.tree.insert("", "end", iid=r.id, values=vals)
+
+    def on_tree_scroll(self, first, last):
+        self.sb.set(first, last)
+        # Vicino al fondo: carica la pagina seguente quando la UI è libera
+        if self.next_token and not self._page_job and float(last) > 0.9:
+            self._page_job = self.after_idle(self.load_page)
+
+    def add_record(self):
+        try:
+            data = self.get_data_from_ui()
+            if not any(data.values()): return
+            self.db.insert(self.table_name, data)
+            self.refresh_data() 
+            self.clear_fields()
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+
+    def update_record(self):
+        selected = self.tree.selection()
+        if not selected: return
+        try:
+            data = self.get_data_from_ui()
+            self.db.update(self.table_name, selected[0], data, version=self.row_versions.get(selected[0]))
+            self.refresh_data() 
+        except ConflictError as e:
+            messagebox.showwarning("Modifica concorrente", str(e))
+            self.refresh_data(self.condition, self.params)
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+
+    def delete_record(self):
+        selected = self.tree.selection()
+        if not selected: return
+        question = "Cancellare record?"
+        if self.table_name == "progetti":
+            project = self.db.reference_row("progetti", selected[0])
+            if project and project.archivio:
+                question = f"Cancellare il progetto archiviato {project.codice} e il suo file {project.archivio}?"
+        if messagebox.askyesno("Conferma", question):
+            try:
+                if self.table_name == "progetti":
+                    # Un progetto archiviato porta con sé il file di archivio
+                    self.db.delete_project(selected[0], version=self.row_versions.get(selected[0]))
+                else:
+                    self.db.delete(self.table_name, selected[0], version=self.row_versions.get(selected[0]))
+            except ConflictError as e:
+                messagebox.showwarning("Modifica concorrente", str(e))
+                self.refresh_data(self.condition, self.params)
+                return
+            except sqlite3.OperationalError as e:
+                show_db_error(e)
+                return
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Errore", str(e))
+                return
+            self.refresh_data() 
+            self.clear_fields()
+
+    def duplicate_record(self):
+        selected = self.tree.selection()
+        if not selected: return
+        data = self.get_data_from_ui()
+        if 'codice' in data: data['codice'] += "_cp"
+        if 'titolo' in data: data['titolo'] += " (Copia)"
+        try:
+            self.db.insert(self.table_name, data)
+            self.refresh_data() 
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+
+    def on_select(self, event):
+        selected = self.tree.selection()
+        if not selected: return
+        item = self.tree.item(selected[0])
+        values = item['values']
+        self.clear_fields()
+        
+        col_idx = 0
+        for field, _, _ in self.fields:
+            if field in self.entries and col_idx < len(values):
+                widget = self.entries[field]
+                val = values[col_idx]
+                
+                if isinstance(widget, tk.Text):
+                    widget.insert("1.0", str(val))
+                elif isinstance(widget, ttk.Combobox):
+                     widget.set(str(val))
+                else:
+                    widget.insert(0, str(val))
+            col_idx += 1
+            
+        if 'on_select' in self.callbacks:
+            self.callbacks['on_select'](selected[0])
+            
+    def on_double_click(self, event):
+        selected = self.tree.selection()
+        if not selected: return
+        if 'on_double_click' in self.callbacks:
+            self.callbacks['on_double_click'](selected[0])
+
+# --- SCHEDA STAMPE (HTML) ---
+class PrintPanel(ttk.Frame):
+    # Colonne delle voci usate da stampa ed export
+    ITEM_COLUMNS = ("categoria", "descrizione", "um", "quantita_mil", "prezzo_unitario_mil", "importo_cent")
+
+    def __init__(self, parent, db):
+        super().__init__(parent)
+        self.db = db
+        self.current_np_id = None
+        self.print_proj_map = {}
+
+        self.lbl_title = ttk.Label(self, text="Stampa Singola NP (HTML)", font=("Arial", 14, "bold"))
+        self.lbl_title.pack(pady=(20, 5))
+        
+        self.info_lbl = ttk.Label(self, text="Seleziona un NP nella Scheda 2 per abilitare la stampa singola.", font=("Arial", 10))
+        self.info_lbl.pack(pady=5)
+        
+        self.btn_print = ttk.Button(self, text="GENERA STAMPA NP SELEZIONATO", command=self.generate_html, width=40)
+        self.btn_print.pack(pady=5, ipady=5)
+
+        ttk.Separator(self, orient="horizontal").pack(fill="x", padx=50, pady=20)
+
+        self.lbl_batch = ttk.Label(self, text="Esportazione Massiva per Intervento", font=("Arial", 14, "bold"))
+        self.lbl_batch.pack(pady=5)
+        
+        ttk.Label(self, text="Seleziona un progetto per generare stampe o esportare in Excel:").pack(pady=5)
+        
+        self.combo_stampa_progetti = ttk.Combobox(self, state="readonly", width=60, postcommand=self.load_projects_for_print)
+        self.combo_stampa_progetti.pack(pady=5)
+        
+        # Frame per affiancare i due pulsanti massivi (HTML e EXCEL)
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(pady=10)
+        
+        self.btn_print_all = ttk.Button(btn_frame, text="GENERA TUTTI GLI HTML", command=self.generate_batch_html, width=30)
+        self.btn_print_all.pack(side="left", padx=10, ipady=5)
+
+        self.btn_export_excel = ttk.Button(btn_frame, text="ESPORTA PROGETTO IN EXCEL", command=self.generate_excel_export, width=30)
+        self.btn_export_excel.pack(side="left", padx=10, ipady=5)
+
+        self.lbl_status = ttk.Label(self, text="", foreground="green", font=("Arial", 9, "italic"))
+        self.lbl_status.pack(pady=20)
+
+    def set_current_np(self, np_id):
+        self.current_np_id = np_id
+        if np_id:
+            np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,), columns=("codice", "descrizione"))
+            self.info_lbl.config(text=f"NP Selezionato: {np.codice} - {np.descrizione}")
+        else:
+            self.info_lbl.config(text="Nessun NP selezionato nella Scheda 2.")
+
+    def load_projects_for_print(self):
+        projs = self.db.reference_rows("progetti")
+        values = []
+        self.print_proj_map = {}
+        for p in projs:
+            label = f"{p.codice} - {p.titolo}"
+            values.append(label)
+            self.print_proj_map[label] = p.id
+        self.combo_stampa_progetti['values'] = values
+
+    def generate_batch_html(self):
+        selected_label = self.combo_stampa_progetti.get()
+        if not selected_label:
+            messagebox.showwarning("Attenzione", "Seleziona un progetto dal menu.")
+            return
+        
+        proj_id = self.print_proj_map[selected_label]
+        nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (proj_id,), columns=("id",))
+        
+        if not nps:
+            messagebox.showinfo("Info", "Nessun NP associato a questo progetto.")
+            return
+
+        if messagebox.askyesno("Conferma", f"Verranno generati {len(nps)} file HTML. Continuare?"):
+            original_np_id = self.current_np_id
+            count = 0
+            for np in nps:
+                self.current_np_id = np.id
+                self.generate_html()
+                count += 1
+            self.current_np_id = original_np_id
+            self.lbl_status.config(text=f"Operazione completata: {count} stampe generate.")
+            messagebox.showinfo("Successo", f"Generati {count} file nella cartella NP_STAMPE.")
+
+    def generate_html(self):
+        if not hasattr(self, 'current_np_id') or not self.current_np_id:
+            messagebox.showerror("Errore", "Nessun NP selezionato.")
+            return
+
+        np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (self.current_np_id,))
+        items = self.db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (self.current_np_id,), columns=self.ITEM_COLUMNS)
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"{timestamp}_NP_{np.codice}.html"
+        
+        if getattr(sys, 'frozen', False):
+            current_path = Path(sys.executable).parent
+        else:
+            current_path = Path(__file__).parent.resolve()
+        
+        target_dir_path = current_path.parent / "NP_STAMPE"
+        target_dir_path.mkdir(parents=True, exist_ok=True)
+        full_path = str(target_dir_path / filename)
+
+        css = """
+        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; padding: 10px; color: #333; max-width: 900px; margin: auto; }
+        h1 { color: #0055aa; border-bottom: 2px solid #0055aa; padding-bottom: 10px; font-size: 24px; }
+        h2 { background-color: #f2f2f2; padding: 5px; margin-top: 30px; border-left: 5px solid #0055aa; font-size: 18px; }
+        .header-box { background: #eef; padding: 10px; border-radius: 5px; margin-bottom: 20px; border: 1px solid #ccd; }
+        table { width: 100%; border-collapse: collapse; margin-bottom: 20px; font-size: 14px; }
+        th, td { border: 1px solid #ddd; padding: 3px; text-align: left; }
+        th { background-color: #0055aa; color: white; text-transform: uppercase; font-size: 12px; }
+        .num { text-align: right; }
+        .footer { font-size: 0.8em; color: #777; margin-top: 40px; text-align: center; border-top: 1px solid #ddd; padding-top: 10px; }
+        .small-note { font-size: 0.85em; color: #666; margin-top: 2px; display: block; }
+        """
+
+        html = f"""
+        <!DOCTYPE html>
+        <html lang="it">
+        <head>
+            <meta charset="UTF-8">
+            <title>Analisi Prezzo {np.codice}</title>
+            <style>{css}</style>
+        </head>
+        <body>
+            <h1>ANALISI NUOVO PREZZO: {np.codice}</h1>
+            <div class="header-box">
+                <table style="width: 100%; border-collapse: collapse; border: none;">
+                    <tr>
+                        <td colspan="2" style="border: none; padding: 2px 0;">
+                            <strong>Descrizione:</strong> {np.descrizione}
+                        </td>
+                    </tr>
+                    <tr><td colspan="2" style="border: none;"></td></tr>
+                    <tr style="font-size: 1.1em;">
+                        <td style="border: none; text-align: left; padding: 0; width: 50%;">
+                            <strong>Unità di Misura: {np.unita_misura}</strong>
+                        </td>
+                        <td style="border: none; text-align: right; padding: 0; width: 50%;">
+                            <strong>Prezzo d'applicazione: {format_currency(from_cent(np.prezzo_finale_cent))}</strong>
+                        </td>
+                    </tr>
+                </table>
+            </div>
+            <h2>Dettaglio Voci Costitutive</h2>
+            <table>
+                <thead>
+                    <tr>
+                        <th width="5%">N.</th>
+                        <th>Descrizione</th>
+                        <th width="5%">U.M.</th>
+                        <th width="10%">Quantità</th>
+                        <th width="15%">P. Unitario</th>
+                        <th width="15%">Totale</th>
+                    </tr>
+                </thead>
+                <tbody>
+        """
+        
+        summary = self.db.np_summary(np, items)
+
+        current_cat = None
+        for item in items:
+            cat, desc, um, q, pu = item.categoria, item.descrizione, item.um, from_mil(item.quantita_mil), from_mil(item.prezzo_unitario_mil)
+            tot = from_cent(item.importo_cent)
+
+            if cat != current_cat:
+                html += f"""<tr><td colspan="6" style="background-color:#e0e0e0; font-weight:bold; color:#333; padding-left: 10px;">{(cat or "").upper()}</td></tr>"""
+                current_cat = cat
+
+            html += f"""
+                <tr>
+                    <td></td>
+                    <td>{desc}</td>
+                    <td>{um}</td>
+                    <td class="num">{q:.3f}</td>
+                    <td class="num">€ {pu:.3f}</td>
+                    <td class="num">€ {tot:.2f}</td>
+                </tr>
+            """
+
+        perc_man, perc_sic = summary.incidenza_manodopera, summary.incidenza_sicurezza
+        tot_a, sg_val, sic_val, utili_val, tot_d, tot_manodopera = map(from_cent, summary[:6])
+
+        html += f"""
+                </tbody>
+            </table>
+
+            <h2>Riepilogo economico</h2>
+            <table style="width: 100%; border: 2px solid #ddd;">
+                <tr>
+                    <td>(A) Sommano</td>
+                    <td class="num">{format_currency(tot_a)}</td>
+                </tr>
+                <tr>
+                    <td style="white-space: nowrap;">
+                        (B) Spese Generali = {format_perc(np.perc_spese_generali_pb)}% di A <span class="small-note" style="display: inline !important;"> - compresi oneri di sicurezza afferenti all'impresa per euro {format_currency(sic_val)} = {format_perc(np.perc_sicurezza_pb)}% di B</span>
+                    </td>
+                    <td class="num">{format_currency(sg_val)}</td>
+                </tr>
+                <tr>
+                    <td>(C) Utile d'Impresa = {format_perc(np.perc_utili_pb)}% di (A + B)</td>
+                    <td class="num">{format_currency(utili_val)}</td>
+                </tr>
+                <tr style="background-color: #dbeeff;">
+                    <td style="font-weight: bold;">(D) TOTALE (A + B + C)</td>
+                    <td class="num" style="font-weight: bold;">{format_currency(tot_d)}</td>
+                </tr>
+            </table>
+
+            <h2>Riepilogo incidenze</h2>
+            <table style="width: 100%; border: 1px solid #ddd;">
+                <tr>
+                    <td>Incidenza Manodopera sul totale</td>
+                    <td class="num"> {perc_man:.2f}%</td>
+                    <td class="num">{format_currency(tot_manodopera)}</td>
+                </tr>
+                <tr>
+                    <td>Incidenza Oneri di Sicurezza sul totale</td>
+                    <td class="num">{perc_sic:.2f}%</td>
+                    <td class="num">{format_currency(sic_val)}</td>
+                </tr>
+            </table>
+
+            <div class="footer">Generato il {datetime.datetime.now().strftime("%d/%m/%Y")}</div>
+        </body>
+        </html>
+        """
+
+        with open(full_path, "w", encoding="utf-8") as f:
+            f.write(html)
+        
+        self.lbl_status.config(text=f"Stampa salvata in:\n{full_path}")
+        try:
+            if os.name == 'nt': os.startfile(full_path)
+            else: os.system(f"open '{full_path}'")
+        except:
+            pass
+
+# --- AGGIUNGI QUESTO NUOVO METODO ALLA FINE DELLA CLASSE PrintPanel ---
+    def generate_excel_export(self):
+        selected_label = self.combo_stampa_progetti.get()
+        if not selected_label:
+            messagebox.showwarning("Attenzione", "Seleziona un progetto dal menu.")
+            return
+        
+        proj_id = self.print_proj_map[selected_label]
+        proj = self.db.reference_row("progetti", proj_id)
+        nps = self.db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (proj_id,))
+        
+        if not nps:
+            messagebox.showinfo("Info", "Nessun NP associato a questo progetto.")
+            return
+
+        # Solo verifica della disponibilità: il foglio si costruisce in _build_excel_workbook
+        if importlib.util.find_spec("openpyxl") is None:
+            messagebox.showerror("Errore", "Libreria 'openpyxl' mancante.\nAssicurati di averla installata.")
+            return
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Puliamo il nome del progetto da caratteri non validi per il nome file
+        safe_proj_name = "".join([c for c in proj.titolo if c.isalnum() or c in (' ', '_')]).rstrip()
+        filename = f"{safe_proj_name}_{timestamp}.xlsx"
+        
+        if getattr(sys, 'frozen', False):
+            current_path = Path(sys.executable).parent
+        else:
+            current_path = Path(__file__).parent.resolve()
+        
+        target_dir_path = current_path.parent / "NP_EXPORT"
+        target_dir_path.mkdir(parents=True, exist_ok=True)
+        full_path = str(target_dir_path / filename)
+
+        # La costruzione del file (letture delle voci comprese) gira in un thread di lavoro
+        def job():
+            with self.db.worker(readonly=True):
+                self._build_excel_workbook(nps, full_path)
+
+        def done(result, error):
+            self.btn_export_excel.config(state="normal")
+            if error:
+                self.lbl_status.config(text="")
+                messagebox.showerror("Errore Export", str(error))
+                return
+            self.lbl_status.config(text=f"Export Excel completato:\n{full_path}")
+            messagebox.showinfo("Successo", f"File Excel generato con successo nella cartella:\nNP_EXPORT")
+
+            # Apri la cartella al termine dell'operazione
+            try:
+                if os.name == 'nt': os.startfile(target_dir_path)
+                else: os.system(f"open '{target_dir_path}'")
+            except:
+                pass
+
+        self.btn_export_excel.config(state="disabled")
+        self.lbl_status.config(text=f"Export Excel in corso ({len(nps)} NP)...")
+        run_in_background(self, job, done)
+
+    def _build_excel_workbook(self, nps, full_path):
+        import openpyxl
+        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active) # Rimuove il foglio di default vuoto
+
+        # Definizione Stili Excel
+        header_font = Font(bold=True, size=14, color="0055AA")
+        bold_font = Font(bold=True)
+        white_bold_font = Font(bold=True, color="FFFFFF")
+        fill_blue = PatternFill(start_color="0055AA", end_color="0055AA", fill_type="solid")
+        fill_light_grey = PatternFill(start_color="F2F2F2", end_color="F2F2F2", fill_type="solid")
+        fill_grey = PatternFill(start_color="E0E0E0", end_color="E0E0E0", fill_type="solid")
+        border_thin = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+        align_center = Alignment(horizontal="center", vertical="center")
+        align_right = Alignment(horizontal="right", vertical="center")
+
+        for np in nps:
+            # Crea un nome foglio valido per Excel (max 31 caratteri e senza simboli strani)
+            sheet_name = str(np.codice)[:31] 
+            for char in ['*', ':', '?', '/', '\\', '[', ']']:
+                sheet_name = sheet_name.replace(char, '')
+            ws = wb.create_sheet(title=sheet_name)
+
+            # Dimensioni colonne
+            ws.column_dimensions['A'].width = 5
+            ws.column_dimensions['B'].width = 50
+            ws.column_dimensions['C'].width = 8
+            ws.column_dimensions['D'].width = 12
+            ws.column_dimensions['E'].width = 15
+            ws.column_dimensions['F'].width = 15
+
+            # Intestazione NP
+            ws.merge_cells('A1:F1')
+            ws['A1'] = f"ANALISI NUOVO PREZZO: {np.codice}"
+            ws['A1'].font = header_font
+            
+            ws.merge_cells('A3:F3')
+            ws['A3'] = f"Descrizione: {np.descrizione}"
+            ws['A3'].font = bold_font
+            ws['A3'].alignment = Alignment(wrap_text=True, vertical="center")
+            ws.row_dimensions[3].height = 40
+
+            ws.merge_cells('A5:C5')
+            ws['A5'] = f"Unità di Misura: {np.unita_misura}"
+            ws['A5'].font = bold_font
+
+            ws.merge_cells('D5:F5')
+            ws['D5'] = f"Prezzo d'applicazione: {format_currency(from_cent(np.prezzo_finale_cent))}"
+            ws['D5'].font = bold_font
+            ws['D5'].alignment = align_right
+
+            # Intestazioni Tabella Voci di Costo
+            row_num = 7
+            headers = ["N.", "Descrizione", "U.M.", "Quantità", "P. Unitario", "Totale"]
+            for col_num, header in enumerate(headers, 1):
+                cell = ws.cell(row=row_num, column=col_num, value=header)
+                cell.font = white_bold_font
+                cell.fill = fill_blue
+                cell.alignment = align_center
+                cell.border = border_thin
+
+            row_num += 1
+            
+            items = self.db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (np.id,), columns=self.ITEM_COLUMNS)
+            summary = self.db.np_summary(np, items)
+
+            current_cat = None
+            for item in items:
+                cat, desc, um, q, pu = item.categoria, item.descrizione, item.um, from_mil(item.quantita_mil), from_mil(item.prezzo_unitario_mil)
+                tot = from_cent(item.importo_cent)
+
+                if cat != current_cat:
+                    ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
+                    cell = ws.cell(row=row_num, column=1, value=(cat or "").upper())
+                    cell.font = bold_font
+                    cell.fill = fill_grey
+                    cell.border = border_thin
+                    for c in range(2, 7):
+                        ws.cell(row=row_num, column=c).border = border_thin
+                    row_num += 1
+                    current_cat = cat
+
+                # Scrittura Riga Voce
+                ws.cell(row=row_num, column=1, value="").border = border_thin
+                ws.cell(row=row_num, column=2, value=desc).border = border_thin
+                
+                c_um = ws.cell(row=row_num, column=3, value=um)
+                c_um.alignment = align_center
+                c_um.border = border_thin
+                
+                c_q = ws.cell(row=row_num, column=4, value=q)
+                c_q.number_format = '#,##0.000'
+                c_q.border = border_thin
+                
+                c_pu = ws.cell(row=row_num, column=5, value=pu)
+                c_pu.number_format = '€ #,##0.000'
+                c_pu.border = border_thin
+                
+                c_tot = ws.cell(row=row_num, column=6, value=tot)
+                c_tot.number_format = '€ #,##0.00'
+                c_tot.border = border_thin
+                
+                row_num += 1
+
+            # Riepilogo Economico
+            row_num += 2
+            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
+            cell = ws.cell(row=row_num, column=1, value="Riepilogo economico")
+            cell.font = bold_font
+            cell.fill = fill_light_grey
+            row_num += 1
+
+            perc_man, perc_sic = summary.incidenza_manodopera, summary.incidenza_sicurezza
+            tot_a, sg_val, sic_val, utili_val, tot_d, tot_manodopera = map(from_cent, summary[:6])
+
+            def add_summary_row(r_idx, test_left, val_right, bold=False):
+                ws.merge_cells(start_row=r_idx, start_column=1, end_row=r_idx, end_column=5)
+                c_l = ws.cell(row=r_idx, column=1, value=test_left)
+                c_r = ws.cell(row=r_idx, column=6, value=val_right)
+                c_r.number_format = '€ #,##0.00'
+                if bold:
+                    c_l.font = bold_font
+                    c_r.font = bold_font
+                return r_idx + 1
+
+            row_num = add_summary_row(row_num, "(A) Sommano", tot_a)
+            row_num = add_summary_row(row_num, f"(B) Spese Generali = {format_perc(np.perc_spese_generali_pb)}% di A (compresi oneri sicurezza € {sic_val:.2f} = {format_perc(np.perc_sicurezza_pb)}% di B)", sg_val)
+            row_num = add_summary_row(row_num, f"(C) Utile d'Impresa = {format_perc(np.perc_utili_pb)}% di (A + B)", utili_val)
+            row_num = add_summary_row(row_num, "(D) TOTALE (A + B + C)", tot_d, bold=True)
+
+            row_num += 1
+            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=6)
+            cell = ws.cell(row=row_num, column=1, value="Riepilogo incidenze")
+            cell.font = bold_font
+            cell.fill = fill_light_grey
+            row_num += 1
+
+            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=4)
+            ws.cell(row=row_num, column=1, value="Incidenza Manodopera sul totale")
+            ws.cell(row=row_num, column=5, value=f"{perc_man:.2f}%").alignment = align_right
+            c_m = ws.cell(row=row_num, column=6, value=tot_manodopera)
+            c_m.number_format = '€ #,##0.00'
+            row_num += 1
+
+            ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=4)
+            ws.cell(row=row_num, column=1, value="Incidenza Oneri di Sicurezza sul totale")
+            ws.cell(row=row_num, column=5, value=f"{perc_sic:.2f}%").alignment = align_right
+            c_s = ws.cell(row=row_num, column=6, value=sic_val)
+            c_s.number_format = '€ #,##0.00'
+
+        wb.save(full_path)
+
+# --- SCHEDA DATABASE (CONNESSIONE E MANUTENZIONE) ---
+class DatabasePanel(ttk.Frame):
+    INTEGRITY_FIRST_RUN_MS = 60 * 1000
+    INTEGRITY_INTERVAL_MS = 30 * 60 * 1000
+    BACKUP_FIRST_RUN_MS = 5 * 60 * 1000
+    BACKUP_INTERVAL_MS = 2 * 60 * 60 * 1000
+    BACKUP_POLL_MS = 300
+    # Manutenzione: parte dopo MAINTENANCE_IDLE_MS senza tastiera/mouse e procede a
+    # passi separati da MAINTENANCE_SLICE_MS, ripetendo il ciclo ogni MAINTENANCE_INTERVAL_MS
+    MAINTENANCE_IDLE_MS = 2 * 60 * 1000
+    MAINTENANCE_CHECK_MS = 30 * 1000
+    MAINTENANCE_SLICE_MS = 200
+    MAINTENANCE_INTERVAL_MS = 60 * 60 * 1000
+    MAINTENANCE_ANALYZE_HOURS = 24
+
+    def __init__(self, parent, db, on_restore=None):
+        super().__init__(parent)
+        self.db = db
+        self.on_restore = on_restore
+        self._integrity_running = False
+        self._backup_thread = None
+        self._backup_progress = None
+        self._backup_result = None
+        self._last_activity = time.monotonic()
+        self._maintenance_queue = []
+        self._maintenance_pages = 0
+        self._maintenance_thread = None
+
+        main_frame = ttk.Frame(self, padding="10")
+        main_frame.pack(fill="both", expand=True)
+
+        ttk.Label(main_frame, text=f"File: {os.path.abspath(self.db.db_name)}", font=("Arial", 10, "bold")).pack(anchor="w", pady=(0, 10))
+
+        prof_frame = ttk.LabelFrame(main_frame, text="Profilo di connessione", padding="10")
+        prof_frame.pack(fill="x", pady=5)
+        ttk.Label(prof_frame, text="Profilo per questo file:").pack(side="left", padx=(0, 5))
+        self.combo_profile = ttk.Combobox(prof_frame, state="readonly", width=25,
+                                          values=["automatico"] + list(CONNECTION_PROFILES.keys()))
+        self.combo_profile.set(self.db.get_setting("profilo_connessione") or "automatico")
+        self.combo_profile.pack(side="left", padx=5)
+        ttk.Button(prof_frame, text="Applica", command=self.apply_profile).pack(side="left", padx=5)
+        ttk.Label(prof_frame, text="Usare \"rete\" se il file si trova su una cartella condivisa (SMB).",
+                  font=("Arial", 9, "italic"), foreground="#555").pack(side="left", padx=10)
+
+        sett_frame = ttk.LabelFrame(main_frame, text="Impostazioni attive", padding="5")
+        sett_frame.pack(fill="x", pady=5)
+        self.tree_settings = ttk.Treeview(sett_frame, columns=("voce", "valore"), show="headings", height=7)
+        self.tree_settings.heading("voce", text="PRAGMA")
+        self.tree_settings.heading("valore", text="Valore")
+        self.tree_settings.column("voce", width=200)
+        self.tree_settings.column("valore", width=300)
+        self.tree_settings.pack(fill="x")
+
+        integ_frame = ttk.LabelFrame(main_frame, text="Integrità dati", padding="10")
+        integ_frame.pack(fill="x", pady=5)
+        ttk.Button(integ_frame, text="Verifica e ripulisci ora", command=lambda: self.run_integrity_check(silent=False)).pack(side="left", padx=(0, 10))
+        self.lbl_integrity = ttk.Label(integ_frame, text="Controllo automatico non ancora eseguito.", font=("Arial", 9, "italic"))
+        self.lbl_integrity.pack(side="left", fill="x")
+
+        maint_frame = ttk.LabelFrame(main_frame, text="Manutenzione (nei momenti di inattività e alla chiusura)", padding="10")
+        maint_frame.pack(fill="x", pady=5)
+        self.btn_vacuum = ttk.Button(maint_frame, text="Attiva vacuum incrementale", command=self.convert_incremental_vacuum)
+        self.btn_vacuum.pack(side="left", padx=(0, 10))
+        self.lbl_maintenance = ttk.Label(maint_frame, text="", font=("Arial", 9, "italic"))
+        self.lbl_maintenance.pack(side="left", fill="x")
+
+        cache_frame = ttk.LabelFrame(main_frame, text="Cache tabelle di riferimento (unità di misura, progetti)", padding="10")
+        cache_frame.pack(fill="x", pady=5)
+        self.lbl_cache = ttk.Label(cache_frame, text="", font=("Arial", 9))
+        self.lbl_cache.pack(side="left", fill="x")
+
+        bak_frame = ttk.LabelFrame(main_frame, text=f"Backup automatico ({backup_dir_for(self.db.db_name)})", padding="5")
+        bak_frame.pack(fill="x", pady=5)
+        bak_btns = ttk.Frame(bak_frame)
+        bak_btns.pack(fill="x")
+        ttk.Button(bak_btns, text="Backup ora", command=self.start_backup).pack(side="left")
+        ttk.Button(bak_btns, text="Ripristina selezionato", command=self.restore_selected).pack(side="left", padx=5)
+        ttk.Label(bak_btns, text="Copie da conservare:").pack(side="left", padx=(15, 5))
+        self.spin_keep = ttk.Spinbox(bak_btns, from_=1, to=100, width=5, command=self.save_backup_keep)
+        self.spin_keep.set(self.backup_keep())
+        self.spin_keep.pack(side="left")
+        self.lbl_backup = ttk.Label(bak_btns, text="", font=("Arial", 9, "italic"))
+        self.lbl_backup.pack(side="left", padx=10)
+        self.tree_backups = ttk.Treeview(bak_frame, columns=("data", "dim", "file"), show="headings", height=4)
+        for col, label, width in [("data", "Data", 140), ("dim", "Dimensione", 90), ("file", "File", 400)]:
+            self.tree_backups.heading(col, text=label)
+            self.tree_backups.column(col, width=width)
+        self.tree_backups.pack(fill="x", pady=2)
+
+        prof_q_frame = ttk.LabelFrame(main_frame, text="Tempi delle query", padding="5")
+        prof_q_frame.pack(fill="both", expand=True, pady=5)
+        opts = ttk.Frame(prof_q_frame)
+        opts.pack(fill="x")
+        self.var_profiling = tk.BooleanVar(value=self.db.profiler is not None)
+        ttk.Checkbutton(opts, text="Registra tempi", variable=self.var_profiling, command=self.toggle_profiling).pack(side="left")
+        ttk.Label(opts, text="Soglia query lente (ms):").pack(side="left", padx=(15, 5))
+        self.entry_slow_ms = ttk.Entry(opts, width=8)
+        self.entry_slow_ms.insert(0, self.db.get_setting("soglia_query_lente_ms", str(SLOW_QUERY_MS)))
+        self.entry_slow_ms.pack(side="left")
+        ttk.Button(opts, text="Aggiorna", command=self.refresh).pack(side="left", padx=5)
+        ttk.Button(opts, text="Azzera", command=self.reset_profiling).pack(side="left")
+        self.lbl_slow_log = ttk.Label(prof_q_frame, text=f"Query lente: {self.db.slow_log_path() or '-'}",
+                                      font=("Arial", 9, "italic"), foreground="#555")
+        self.lbl_slow_log.pack(anchor="w", pady=2)
+
+        stat_cols = ("sql", "n", "p50", "p95", "max", "righe")
+        self.tree_stats = ttk.Treeview(prof_q_frame, columns=stat_cols, show="headings", height=8)
+        for col, label, width, anchor in [("sql", "Istruzione", 520, "w"), ("n", "N.", 60, "e"),
+                                          ("p50", "p50 ms", 70, "e"), ("p95", "p95 ms", 70, "e"),
+                                          ("max", "max ms", 70, "e"), ("righe", "Righe", 70, "e")]:
+            self.tree_stats.heading(col, text=label)
+            self.tree_stats.column(col, width=width, anchor=anchor)
+        self.tree_stats.pack(fill="both", expand=True)
+
+        self.refresh()
+        # Controllo periodico degli orfani (es. scritti da versioni precedenti sul file condiviso)
+        self.after(self.INTEGRITY_FIRST_RUN_MS, self._integrity_job)
+        if self.db.db_name != ":memory:":
+            self.after(self.BACKUP_FIRST_RUN_MS, self._backup_job)
+        # Qualsiasi tasto o clic nell'app rimanda la manutenzione
+        self.bind_all("<Any-KeyPress>", self.note_activity, add="+")
+        self.bind_all("<Any-ButtonPress>", self.note_activity, add="+")
+        self.after(self.MAINTENANCE_CHECK_MS, self._maintenance_tick)
+
+    def refresh(self):
+        for row in self.tree_settings.get_children(): self.tree_settings.delete(row)
+        for key, value in self.db.connection_settings().items():
+            self.tree_settings.insert("", "end", values=(key, value))
+        stats = self.db.cache_stats()
+        total = stats["hit"] + stats["miss"]
+        ratio = f" ({stats['hit'] / total * 100:.0f}% dalla memoria)" if total else ""
+        self.lbl_cache.config(text=f"Letture: {stats['hit']} hit, {stats['miss']} miss{ratio}")
+        self.refresh_maintenance()
+        for row in self.tree_stats.get_children(): self.tree_stats.delete(row)
+        for st in self.db.query_stats():
+            self.tree_stats.insert("", "end", values=(st["sql"], st["n"], f"{st['p50']:.2f}",
+                                                       f"{st['p95']:.2f}", f"{st['max']:.2f}", st["righe"]))
+        self.refresh_backups()
+
+    def refresh_maintenance(self):
+        mode = self.db.auto_vacuum_mode()
+        log = self.db.maintenance_log()
+        def when(key):
+            return datetime.datetime.fromisoformat(log[key]).strftime("%d/%m %H:%M") if key in log else "mai"
+        text = (f"auto_vacuum: {mode}, pagine libere: {self.db.free_pages()} - "
+                f"optimize: {when('optimize')}, analyze: {when('analyze')}, vacuum: {when('vacuum')}, "
+                f"chiusura: {when('chiusura')} - recuperati in totale {log.get('byte_recuperati', 0) / 1024:.0f} KB")
+        self.lbl_maintenance.config(text=text)
+        self.btn_vacuum.config(state="disabled" if mode == "INCREMENTAL" else "normal")
+
+    def refresh_backups(self):
+        for row in self.tree_backups.get_children(): self.tree_backups.delete(row)
+        for path, when, size in list_backups(self.db.db_name):
+            self.tree_backups.insert("", "end", iid=path, values=(when.strftime("%d/%m/%Y %H:%M:%S"),
+                                                                  f"{size / 1024:.0f} KB", os.path.basename(path)))
+
+    def backup_keep(self):
+        try:
+            return max(1, int(self.db.get_setting("backup_da_conservare", BACKUP_KEEP)))
+        except ValueError:
+            return BACKUP_KEEP
+
+    def save_backup_keep(self):
+        try:
+            self.db.set_setting("backup_da_conservare", max(1, int(self.spin_keep.get())))
+        except ValueError:
+            self.spin_keep.set(self.backup_keep())
+
+    # --- BACKUP IN BACKGROUND ---
+    def _backup_job(self):
+        self.start_backup(silent=True)
+        self.after(self.BACKUP_INTERVAL_MS, self._backup_job)
+
+    def start_backup(self, silent=False):
+        if self._backup_thread and self._backup_thread.is_alive(): return
+        keep = self.backup_keep()
+        self._backup_progress = None
+        self._backup_result = None
+
+        def progress(status, remaining, total):
+            self._backup_progress = (remaining, total)
+
+        def worker():
+            # Nessun accesso ai widget da qui: l'esito viene letto da _poll_backup
+            try:
+                self._backup_result = ("ok", backup_database(self.db.db_name, keep=keep, progress=progress))
+            except (sqlite3.Error, OSError) as e:
+                self._backup_result = ("errore", str(e))
+
+        self._backup_thread = threading.Thread(target=worker, daemon=True)
+        self._backup_thread.start()
+        self._poll_backup(silent)
+
+    def _poll_backup(self, silent):
+        if self._backup_thread.is_alive():
+            if self._backup_progress:
+                remaining, total = self._backup_progress
+                done = (total - remaining) / total * 100 if total else 0
+                self.lbl_backup.config(text=f"Backup in corso... {done:.0f}%")
+            else:
+                self.lbl_backup.config(text="Backup in corso...")
+            self.after(self.BACKUP_POLL_MS, lambda: self._poll_backup(silent))
+            return
+        outcome, detail = self._backup_result
+        now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
+        if outcome == "ok":
+            self.lbl_backup.config(text=f"{now} - Backup verificato: {os.path.basename(detail)}")
+        else:
+            self.lbl_backup.config(text=f"{now} - Backup non riuscito: {detail}")
+            if not silent: messagebox.showerror("Backup", detail)
+        self.refresh_backups()
+
+    def background_jobs_running(self):
+        """Backup (connessione propria) o lavori sulle connessioni del pool: manutenzione,
+        controllo integrità, archivio, export Excel"""
+        return bool((self._backup_thread and self._backup_thread.is_alive()) or self.db.pool.in_use())
+
+    def restore_selected(self):
+        sel = self.tree_backups.selection()
+        if not sel:
+            messagebox.showwarning("Attenzione", "Seleziona una copia dall'elenco.")
+            return
+        if self.background_jobs_running():
+            messagebox.showwarning("Attenzione", "Attendere la fine dei lavori in background (backup, manutenzione, archivio).")
+            return
+        path = sel[0]
+        if not messagebox.askyesno("Conferma ripristino",
+                                   f"Sostituire tutti i dati con la copia\n{os.path.basename(path)}?\n\n"
+                                   "Lo stato attuale viene salvato prima come copia \"_pre_ripristino\"."):
+            return
+        try:
+            self.db.restore_backup(path)
+        except (sqlite3.Error, OSError) as e:
+            messagebox.showerror("Errore Ripristino", str(e))
+            return
+        if self.on_restore: self.on_restore()
+        self.refresh()
+        messagebox.showinfo("Ripristino", "Ripristino completato.")
+
+    def toggle_profiling(self):
+        try:
+            if self.var_profiling.get():
+                self.db.enable_profiling(self.entry_slow_ms.get().replace(",", "."))
+            else:
+                self.db.disable_profiling()
+        except sqlite3.Error as e:
+            messagebox.showerror("Errore", str(e))
+        self.refresh()
+
+    def reset_profiling(self):
+        # Riattivare il profiler azzera le statistiche e applica la nuova soglia
+        if self.var_profiling.get():
+            self.toggle_profiling()
+
+    def _integrity_job(self):
+        self.after_idle(lambda: self.run_integrity_check(silent=True))
+        self.after(self.INTEGRITY_INTERVAL_MS, self._integrity_job)
+
+    # --- MANUTENZIONE NEI MOMENTI DI INATTIVITÀ ---
+    def note_activity(self, event=None):
+        self._last_activity = time.monotonic()
+
+    def _maintenance_plan(self):
+        log = self.db.maintenance_log()
+        plan = ["optimize"]
+        last = log.get("analyze")
+        if not last or datetime.datetime.now() - datetime.datetime.fromisoformat(last) > datetime.timedelta(hours=self.MAINTENANCE_ANALYZE_HOURS):
+            plan.append("analyze")
+        if self.db.auto_vacuum_mode() == "INCREMENTAL" and self.db.free_pages():
+            plan.append("vacuum")
+        return plan
+
+    def _maintenance_tick(self):
+        idle_ms = (time.monotonic() - self._last_activity) * 1000
+        busy = self._maintenance_thread and self._maintenance_thread.is_alive()
+        if idle_ms < self.MAINTENANCE_IDLE_MS or busy or self.db.in_transaction():
+            self.after(self.MAINTENANCE_CHECK_MS, self._maintenance_tick)
+            return
+        # Il passo parte solo quando Tk ha smaltito gli eventi in coda
+        self.after_idle(self._maintenance_step)
+
+    def _maintenance_step(self):
+        if not self._maintenance_queue:
+            self._maintenance_queue = self._maintenance_plan()
+            self._maintenance_pages = 0
+        task = self._maintenance_queue[0]
+        if task == "optimize":
+            # Sulla connessione principale: PRAGMA optimize usa le query viste da questa connessione
+            try:
+                self.db.optimize()
+                self._maintenance_done(task, 0, None)
+            except sqlite3.Error as e:
+                self._maintenance_done(task, 0, e)
+            return
+
+        def job():
+            with self.db.worker(readonly=False):
+                if task == "analyze":
+                    self.db.analyze()
+                    return 0
+                return self.db.incremental_vacuum()
+        self._maintenance_thread = run_in_background(self, job, lambda pages, error: self._maintenance_done(task, pages, error))
+
+    def _maintenance_done(self, task, pages, error):
+        if error:
+            # File occupato da altri utenti o errore: il ciclo riparte al prossimo periodo di inattività
+            self._maintenance_queue = []
+            self.lbl_maintenance.config(text=f"Manutenzione rimandata ({task}): {error}")
+            self.after(self.MAINTENANCE_CHECK_MS, self._maintenance_tick)
+            return
+        self._maintenance_pages += pages
+        # Il vacuum resta in coda finché libera pagine
+        if task != "vacuum" or not pages or not self.db.free_pages():
+            self._maintenance_queue.pop(0)
+            self.db.record_maintenance(task, self._maintenance_pages if task == "vacuum" else 0)
+        if self.winfo_ismapped(): self.refresh_maintenance()
+        if self._maintenance_queue:
+            self.after(self.MAINTENANCE_SLICE_MS, self._maintenance_tick)
+        else:
+            self.after(self.MAINTENANCE_INTERVAL_MS, self._maintenance_tick)
+
+    def run_shutdown_maintenance(self):
+        """Chiamata alla chiusura dell'app, entro MAINTENANCE_SHUTDOWN_BUDGET secondi"""
+        start = time.monotonic()
+        if self._maintenance_thread and self._maintenance_thread.is_alive():
+            self._maintenance_thread.join(MAINTENANCE_SHUTDOWN_BUDGET)
+        budget = MAINTENANCE_SHUTDOWN_BUDGET - (time.monotonic() - start)
+        if budget <= 0: return 0
+        try:
+            return self.db.run_maintenance(budget)
+        except sqlite3.Error:
+            return 0  # la chiusura non deve mai fallire per la manutenzione
+
+    def convert_incremental_vacuum(self):
+        size = os.path.getsize(self.db.db_name) if self.db.db_name != ":memory:" else 0
+        if not messagebox.askyesno("Vacuum incrementale",
+                                   f"Il file ({size / 1024 / 1024:.1f} MB) viene ricostruito con VACUUM.\n"
+                                   "Durante l'operazione gli altri utenti non possono scrivere. Procedere?"):
+            return
+        if self.background_jobs_running():
+            messagebox.showwarning("Attenzione", "Attendere la fine dei lavori in background (backup, manutenzione, archivio).")
+            return
+        # Sulla connessione principale (cambia il journal_mode): l'app resta in attesa
+        self.config(cursor="watch")
+        self.update_idletasks()
+        try:
+            reclaimed = self.db.enable_incremental_vacuum()
+        except sqlite3.Error as e:
+            messagebox.showerror("Errore VACUUM", f"{e}\n\nChiudere l'app sugli altri computer e riprovare.")
+            return
+        finally:
+            self.config(cursor="")
+            self.refresh_maintenance()
+        messagebox.showinfo("Vacuum incrementale", f"Conversione completata: recuperati {reclaimed / 1024:.0f} KB.")
+
+    def run_integrity_check(self, silent=True):
+        if self._integrity_running: return
+        self._integrity_running = True
+        self.lbl_integrity.config(text="Controllo integrità in corso...")
+
+        def job():
+            with self.db.worker(readonly=False):
+                return self.db.purge_orphans()
+
+        run_in_background(self, job, lambda report, error: self._integrity_done(report, error, silent))
+
+    def _integrity_done(self, report, error, silent):
+        self._integrity_running = False
+        if error:
+            self.lbl_integrity.config(text=f"Controllo integrità non riuscito: {error}")
+            if not silent: messagebox.showerror("Errore", str(error))
+            return
+        now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
+        removed = sum(report.values())
+        if removed:
+            detail = ", ".join(f"{table}: {n}" for table, n in report.items() if n)
+            text = f"{now} - Rimossi {removed} record orfani ({detail})"
+        else:
+            text = f"{now} - Nessun record orfano"
+        self.lbl_integrity.config(text=text)
+        if not silent: messagebox.showinfo("Integrità dati", text)
+
+    def apply_profile(self):
+        choice = self.combo_profile.get()
+        try:
+            self.db.set_connection_profile(None if choice == "automatico" else choice)
+        except sqlite3.Error as e:
+            messagebox.showerror("Errore", f"Impossibile applicare il profilo:\n{e}")
+        self.refresh()
+
+# --- VOCI DI COSTO DELL'NP (SCHEDA 3) ---
+class CostItemEditor:
+    """Voci dell'NP aperto nella scheda 3, senza dipendere da Tk: scritture con
+    propagazione agli NP che lo richiamano e aggiornamento per differenza di modello
+    ed elenco. tree è qualsiasi oggetto con l'interfaccia di ttk.Treeview usata qui
+    (get_children, exists, item, move, insert, delete)."""
+    ORDER_BY = "ORDER BY ordine, id"
+
+    def __init__(self, db, tree):
+        self.db = db
+        self.tree = tree
+        self.np_id = None
+        # row_version dell'NP letta con le voci: le percentuali si salvano contro questa
+        self.np_version = None
+        self.model = NPRunningTotals()
+        # row_version delle voci visualizzate, per modifiche e cancellazioni ottimistiche
+        self.versions = {}
+        # NP richiamato dalla voce in compilazione (None = voce normale)
+        self.np_rif = None
+
+    @staticmethod
+    def row_values(item):
+        q_fmt = f"{from_mil(item.quantita_mil):.3f}".replace('.', ',')
+        pu_fmt = f"{from_mil(item.prezzo_unitario_mil):.3f}".replace('.', ',')
+        tot_fmt = f"{from_cent(item.importo_cent):.2f}".replace('.', ',')
+        return (item.ordine, item.categoria, item.descrizione, item.um, q_fmt, pu_fmt, tot_fmt)
+
+    def load(self, np_id):
+        """Rilettura completa: da qui in poi le modifiche di una voce si applicano per differenza.
+        Restituisce la riga dell'NP (None se non c'è più)"""
+        for row in self.tree.get_children(): self.tree.delete(row)
+        self.np_id = np_id
+        np_rec = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,)) if np_id else None
+        self.np_version = np_rec.row_version if np_rec else None
+        items = self.db.fetch_all("voci_costo", f"WHERE np_id=? {self.ORDER_BY}", (np_id,)) if np_id else []
+        self.model = NPRunningTotals(items)
+        self.versions = {item.id: item.row_version for item in items}
+        for item in items:
+            self.tree.insert("", "end", iid=item.id, values=self.row_values(item))
+        return np_rec
+
+    def apply_change(self, item_id, deleted=False):
+        """Dopo la scrittura di una sola voce aggiorna modello e riga dell'elenco senza
+        rileggere tutte le voci. Restituisce False se serve la rilettura completa: la voce
+        non è più dell'NP o il totale salvato non torna (un altro utente ha cambiato altre voci)."""
+        iid = str(item_id)
+        if deleted:
+            if item_id in self.model.items: self.model.remove(item_id)
+            if self.tree.exists(iid): self.tree.delete(iid)
+            self.versions.pop(item_id, None)
+        else:
+            item = self.db.fetch_one("voci_costo", "WHERE id=?", (item_id,))
+            if item is None or item.np_id != self.np_id:
+                return False
+            old = self.model.items.get(item.id)
+            if old: self.model.remove(item.id)
+            position = self.model.position(item)
+            self.model.add(item)
+            if self.tree.exists(iid):
+                self.tree.item(iid, values=self.row_values(item))
+                if old is None or old.ordine != item.ordine: self.tree.move(iid, "", position)
+            else:
+                self.tree.insert("", position, iid=item.id, values=self.row_values(item))
+            self.versions[item_id] = item.row_version
+
+        np_rec = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (self.np_id,), columns=("totale_a_cent", "num_voci"))
+        return np_rec is not None and (np_rec.totale_a_cent, np_rec.num_voci) == (self.model.totale_a_cent(), len(self.model.items))
+
+    def link(self, np_rif_id):
+        """Collega (o scollega con None) la voce in compilazione a un NP, il cui prezzo
+        finale diventa il prezzo unitario. Restituisce l'NP richiamato o None"""
+        rif = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_rif_id,), columns=("codice", "prezzo_finale_cent")) if np_rif_id else None
+        self.np_rif = np_rif_id if rif else None
+        return rif
+
+    def _apply_np_link(self, data):
+        # Da chiamare nella transazione della scrittura: riferimento e prezzo letti insieme
+        data['np_rif_id'] = self.np_rif
+        if self.np_rif:
+            rif = self.db.check_np_reference(self.np_id, self.np_rif)
+            data['prezzo_unitario_mil'] = rif.prezzo_finale_cent * NP_REF_PRICE_MIL
+
+    # Scritture: ognuna restituisce gli NP il cui prezzo è cambiato per propagazione
+    def add_item(self, data):
+        """Restituisce (id della nuova voce, NP ricalcolati)"""
+        data = dict(data, np_id=self.np_id)
+        def write():
+            self._apply_np_link(data)
+            new_id = self.db.insert("voci_costo", data)
+            return new_id, self.db.propagate_np_prices([self.np_id])
+        return self.db.run_transaction(write)
+
+    def update_item(self, item_id, data):
+        data = dict(data)
+        def write():
+            self._apply_np_link(data)
+            self.db.update("voci_costo", item_id, data, version=self.versions.get(item_id))
+            return self.db.propagate_np_prices([self.np_id])
+        return self.db.run_transaction(write)
+
+    def delete_item(self, item_id):
+        def write():
+            self.db.delete("voci_costo", item_id, version=self.versions.get(item_id))
+            return self.db.propagate_np_prices([self.np_id])
+        return self.db.run_transaction(write)
+
+# --- APP PRINCIPALE ---
+class NPApp(tk.Tk):
+    # Le percentuali modificate vengono salvate poco dopo l'ultima modifica, tutte insieme
+    WRITE_BEHIND_DELAY_MS = 500
+
+    def __init__(self):
+        super().__init__()
+        self.title("Gestione Nuovi Prezzi (NP)")
+        self.geometry("1100x800")
+        
+        self.db = Database()
+        self._um_token = None
+        # Scritture differite: np_id -> percentuali da salvare (l'ultima vince)
+        self.pending_perc = {}
+        self.pending_versions = {}
+        self.saved_perc = None
+        self._flush_job = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        self.notebook = ttk.Notebook(self)
+        self.notebook.pack(fill="both", expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_change)
+
+        # TAB 1: PROGETTI
+        self.tab_progetti = CrudPanel(
+            self.notebook, self.db, "progetti", 
+            [("codice", "Codice", 100), ("titolo", "Titolo Intervento", 300), ("cup", "CUP", 100), ("committente", "Committente", 200)],
+            callbacks={'on_select': self.on_project_select, 'on_double_click': self.goto_tab_np}
+        )
+        self.notebook.add(self.tab_progetti, text="1. Progetti")
+
+        # --- ARCHIVIO PROGETTI (TAB 1) ---
+        def selected_project():
+            selected = self.tab_progetti.tree.selection()
+            if not selected:
+                messagebox.showwarning("Attenzione", "Seleziona un Progetto dalla lista")
+                return None
+            return self.db.reference_row("progetti", selected[0])
+
+        def run_archive_job(proj, job, done_text):
+            # Copia e rimozione possono durare: girano su una connessione di lavoro
+            self.flush_pending_writes()
+            btn_arch.config(state="disabled")
+            btn_unarch.config(state="disabled")
+
+            def work():
+                with self.db.worker(readonly=False):
+                    return job(proj.id)
+
+            def done(result, error):
+                btn_arch.config(state="normal")
+                btn_unarch.config(state="normal")
+                if isinstance(error, sqlite3.OperationalError):
+                    show_db_error(error, "Errore Archivio")
+                elif error:
+                    messagebox.showerror("Errore Archivio", str(error))
+                else:
+                    messagebox.showinfo("Archivio", done_text)
+                self.tab_progetti.refresh_data()
+                self.on_project_select(proj.id)
+            run_in_background(self, work, done)
+
+        def archive_project():
+            proj = selected_project()
+            if not proj: return
+            if proj.archivio:
+                messagebox.showinfo("Archivio", "Il progetto è già archiviato.")
+                return
+            if not messagebox.askyesno("Archivia Progetto",
+                                       f"Spostare NP e voci del progetto {proj.codice} nel file di archivio?\n"
+                                       "Resteranno consultabili da Importa e Cerca da Storico."):
+                return
+            run_archive_job(proj, self.db.archive_project, f"Progetto {proj.codice} archiviato in {ARCHIVE_DIR_NAME}.")
+
+        def unarchive_project():
+            proj = selected_project()
+            if not proj: return
+            if not proj.archivio:
+                messagebox.showinfo("Archivio", "Il progetto è già in linea.")
+                return
+            run_archive_job(proj, self.db.unarchive_project, f"Progetto {proj.codice} riportato in linea.")
+
+        def recompute_project():
+            # Prezzi di tutti gli NP del progetto ricalcolati dalle voci, senza aprirli uno a uno
+            proj = selected_project()
+            if not proj: return
+            if proj.archivio:
+                messagebox.showinfo("Ricalcolo", "Il progetto è archiviato: riportalo in linea per ricalcolarlo.")
+                return
+            self.flush_pending_writes()
+            try:
+                totals = self.db.recompute_project(proj.id)
+            except sqlite3.Error as e:
+                messagebox.showerror("Errore Ricalcolo", str(e))
+                return
+            drifted = [t for t in totals if t.deriva]
+            msg = f"Progetto {proj.codice}: {len(totals)} NP ricalcolati.\n"
+            if not drifted:
+                msg += "Tutti i prezzi salvati erano corretti."
+            else:
+                msg += f"{len(drifted)} NP avevano un prezzo salvato non allineato alle voci ed è stato corretto:\n\n"
+                msg += "\n".join(f"{t.codice}: {format_currency(from_cent(t.prezzo_salvato_cent))} -> {format_currency(from_cent(t.totale_cent))}"
+                                 for t in drifted[:15])
+                if len(drifted) > 15: msg += f"\n... e altri {len(drifted) - 15}"
+            messagebox.showinfo("Ricalcolo Progetto", msg)
+            if drifted and self.current_project_id == proj.id:
+                self.tab_np.refresh_data("WHERE progetto_id=?", (proj.id,))
+                if self.current_np_id: self.refresh_details_tree()
+
+        ttk.Separator(self.tab_progetti.frame_btns, orient="horizontal").pack(fill="x", pady=5)
+        ttk.Button(self.tab_progetti.frame_btns, text="Ricalcola Prezzi", command=recompute_project).pack(fill="x", pady=2)
+        btn_arch = ttk.Button(self.tab_progetti.frame_btns, text="Archivia", command=archive_project)
+        btn_arch.pack(fill="x", pady=2)
+        btn_unarch = ttk.Button(self.tab_progetti.frame_btns, text="Riporta in linea", command=unarchive_project)
+        btn_unarch.pack(fill="x", pady=2)
+
+        # TAB 2: ELENCO NP
+        self.frame_tab2 = ttk.Frame(self.notebook) 
+        self.notebook.add(self.frame_tab2, text="2. Elenco NP")
+        
+        self.lbl_project_title = ttk.Label(self.frame_tab2, text="Nessun Progetto Selezionato", font=("Arial", 12, "bold"), foreground="#444", padding=10)
+        self.lbl_project_title.pack(side="top", fill="x")
+
+        self.current_project_id = None
+        fields_np = [
+            ("codice", "Codice NP", 100), 
+            ("descrizione", "Descrizione NP", 400), 
+            ("unita_misura", "Unità di Misura", 100),
+            ("prezzo_finale_cent", "Prezzo Finale", 120)
+        ]
+        
+        self.tab_np = CrudPanel(
+            self.frame_tab2, self.db, "nuovi_prezzi",
+            fields_np,
+            callbacks={'on_select': self.on_np_select, 'on_double_click': self.goto_tab_details}
+        )
+        self.tab_np.pack(fill="both", expand=True)
+        
+        def add_np_wrapper():
+            if not self.current_project_id:
+                messagebox.showwarning("Attenzione", "Seleziona prima un Progetto dalla Scheda 1")
+                return
+            data = self.tab_np.get_data_from_ui()
+            data['progetto_id'] = self.current_project_id
+            data['perc_spese_generali_pb'] = 1700
+            data['perc_sicurezza_pb'] = 500
+            data['perc_utili_pb'] = 1000
+            try:
+                self.db.insert("nuovi_prezzi", data)
+                self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+                self.tab_np.clear_fields()
+            except Exception as e:
+                messagebox.showerror("Errore", str(e))
+        
+        def duplicate_np_deep_wrapper():
+            self._copy_np_logic(is_import=False)
+
+        def import_np_wrapper():
+            if not self.current_project_id:
+                messagebox.showwarning("Attenzione", "Seleziona prima un Progetto di destinazione")
+                return
+            ImportDialog(self, self.db, self.current_project_id, self._import_np_callback)
+
+        def update_np_wrapper():
+            selected = self.tab_np.tree.selection()
+            self.tab_np.__class__.update_record(self.tab_np)
+            if self.current_project_id: self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+            # La modifica alza la row_version: la scheda 3 rilegge l'NP aperto, altrimenti
+            # il prossimo salvataggio delle percentuali sembrerebbe una modifica concorrente
+            if self.current_np_id and str(self.current_np_id) in selected: self.refresh_details_tree()
+
+        def delete_np_wrapper():
+            self.tab_np.__class__.delete_record(self.tab_np)
+            if self.current_project_id: self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+
+        self.tab_np.buttons['add'].config(command=add_np_wrapper)
+        self.tab_np.buttons['upd'].config(command=update_np_wrapper)
+        self.tab_np.buttons['del'].config(command=delete_np_wrapper)
+        self.tab_np.buttons['dup'].config(command=duplicate_np_deep_wrapper)
+        self.tab_np.buttons['imp'].config(command=import_np_wrapper)
+
+        def reparameterize_wrapper():
+            if not self.current_project_id:
+                messagebox.showwarning("Attenzione", "Seleziona prima un Progetto dalla Scheda 1")
+                return
+            # Le percentuali in sospeso della scheda 3 vanno salvate prima di leggere gli NP
+            self.flush_pending_writes()
+            ReparameterizeDialog(self, self.db, self.current_project_id, on_reparameterized)
+
+        def on_reparameterized(np_ids):
+            self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+            if self.current_np_id in np_ids: self.refresh_details_tree()
+
+        ttk.Button(self.tab_np.frame_btns, text="Percentuali in blocco", command=reparameterize_wrapper).pack(fill="x", pady=2)
+
+        # TAB 3: MODIFICA NP
+        self.frame_det_np = ttk.Frame(self.notebook)
+        self.notebook.add(self.frame_det_np, text="3. Modifica NP")
+        self.setup_details_tab()
+
+        # TAB 4: AMMINISTRAZIONE
+        self.tab_admin = CrudPanel(
+            self.notebook, self.db, "unita_misura",
+            [("codice", "Codice", 80), ("nome", "Unità", 150), ("descrizione", "Utilizzo", 400)]
+        )
+        self.notebook.add(self.tab_admin, text="4. Unità di Misura")
+        
+        # --- FUNZIONI EXPORT/IMPORT CSV (TAB 4) ---
+        def export_um_csv():
+            path = filedialog.asksaveasfilename(
+                title="Esporta Unità di Misura",
+                defaultextension=".csv",
+                filetypes=[("File CSV", "*.csv")]
+            )
+            if not path: return
+            try:
+                rows = self.db.reference_rows("unita_misura")
+                with open(path, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f, delimiter=';')
+                    writer.writerow(["CODICE", "NOME", "DESCRIZIONE"])
+                    writer.writerows([r.codice, r.nome, r.descrizione] for r in rows)
+                messagebox.showinfo("Export", "Esportazione CSV completata con successo!")
+            except Exception as e:
+                messagebox.showerror("Errore Export", str(e))
+
+        def import_um_csv():
+            path = filedialog.askopenfilename(
+                title="Importa Unità di Misura",
+                filetypes=[("File CSV", "*.csv")]
+            )
+            if not path: return
+            try:
+                new_rows = []
+                with open(path, newline='', encoding='utf-8') as f:
+                    sample = f.read(1024)
+                    f.seek(0)
+                    sniffer = csv.Sniffer()
+                    try:
+                        dialect = sniffer.sniff(sample, delimiters=";,")
+                    except:
+                        dialect = 'excel' 
+
+                    reader = csv.reader(f, dialect)
+                    try:
+                        header = next(reader)
+                    except StopIteration:
+                        return 
+
+                    existing = {u.codice for u in self.db.reference_rows("unita_misura")}
+                    for row in reader:
+                        if len(row) < 2: continue 
+                        cod = row[0].strip()
+                        nom = row[1].strip()
+                        des = row[2].strip() if len(row) > 2 else ""
+                        if cod not in existing:
+                            new_rows.append({'codice': cod, 'nome': nom, 'descrizione': des})
+                            existing.add(cod)
+                
+                count = self.db.insert_many("unita_misura", new_rows)
+                self.tab_admin.refresh_data()
+                messagebox.showinfo("Import", f"Importazione completata.\nInseriti {count} nuovi record.")
+            except Exception as e:
+                messagebox.showerror("Errore Import", f"Errore lettura CSV:\n{str(e)}\n\nAssicurati che il formato sia: Codice;Nome;Descrizione")
+
+        ttk.Separator(self.tab_admin.frame_btns, orient="horizontal").pack(fill="x", pady=5)
+        btn_exp = ttk.Button(self.tab_admin.frame_btns, text="Esporta CSV", command=export_um_csv)
+        btn_exp.pack(fill="x", pady=2)
+        btn_imp = ttk.Button(self.tab_admin.frame_btns, text="Importa CSV", command=import_um_csv)
+        btn_imp.pack(fill="x", pady=2)
+
+        # TAB 5: STAMPE
+        self.tab_print = PrintPanel(self.notebook, self.db)
+        self.notebook.add(self.tab_print, text="5. Stampe")
+
+        # --- TAB 6: CONVERTITORE PDF ---
+        self.tab_converter = ConverterPanel(self.notebook)
+        self.notebook.add(self.tab_converter, text="6. Convertitore PDF")
+
+        # --- TAB 7: DATABASE ---
+        self.tab_database = DatabasePanel(self.notebook, self.db, on_restore=self.after_restore)
+        self.notebook.add(self.tab_database, text="7. Database")
+
+    # --- LOGICA DI COPIA ---
+    def _import_np_callback(self, source_np_id, source_project_id=None):
+        self._copy_np_logic(is_import=True, source_id_override=source_np_id, source_project_id=source_project_id)
+
+    def _copy_np_logic(self, is_import=False, source_id_override=None, source_project_id=None):
+        if not self.current_project_id: return
+        
+        if is_import:
+            source_id = source_id_override
+        else:
+            selected = self.tab_np.tree.selection()
+            if not selected: return
+            source_id = selected[0]
+
+        # Nello stesso progetto la copia richiama gli stessi NP dell'originale; un NP
+        # importato da un altro progetto ha voci con prezzo proprio
+        same_project = source_project_id in (None, self.current_project_id)
+        try:
+            # Un NP di un progetto archiviato si copia direttamente dal file di archivio
+            with self.db.attached_archive(source_project_id or self.current_project_id) as schema:
+                src_rec = self.db.fetch_one(f"{schema}.nuovi_prezzi", "WHERE id=?", (source_id,))
+                copy_columns = ("ordine", "categoria", "descrizione", "um", "quantita_mil", "prezzo_unitario_mil")
+                if same_project: copy_columns += ("np_rif_id",)
+                items = self.db.fetch_all(f"{schema}.voci_costo", "WHERE np_id=? ORDER BY ordine", (source_id,), columns=copy_columns)
+        except (FileNotFoundError, sqlite3.Error) as e:
+            messagebox.showerror("Errore Copia", str(e))
+            return
+
+        data = {
+            'progetto_id': self.current_project_id,
+            'codice': src_rec.codice + ("_imp" if is_import else "_cp"),
+            'descrizione': src_rec.descrizione + (" (Import)" if is_import else " (Copia)"),
+            'unita_misura': src_rec.unita_misura,
+            'perc_spese_generali_pb': src_rec.perc_spese_generali_pb,
+            'perc_sicurezza_pb': src_rec.perc_sicurezza_pb,
+            'perc_utili_pb': src_rec.perc_utili_pb
+        }
+
+        def write():
+            new_np_id = self.db.insert("nuovi_prezzi", data)
+            self.db.insert_many("voci_costo", [dict(item._asdict(), np_id=new_np_id) for item in items])
+            return new_np_id
+
+        try:
+            self.db.run_transaction(write)
+        except sqlite3.OperationalError as e:
+            show_db_error(e, "Errore Copia"); return
+        except (sqlite3.Error, ValueError) as e:
+            messagebox.showerror("Errore Copia", str(e)); return
+
+        if self.notebook.index("current") == 1:
+            self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+        messagebox.showinfo("Successo", "NP copiato con successo!")
+
+    # --- EVENT HANDLERS ---
+    def on_tab_change(self, event):
+        # Le altre schede leggono percentuali e prezzi dal database
+        self.flush_pending_writes()
+        idx = self.notebook.index("current")
+        if idx == 1 and self.current_project_id:
+            self.tab_np.refresh_if_changed("WHERE progetto_id=?", (self.current_project_id,))
+        elif idx == 4:
+            current_np = self.current_np_id if hasattr(self, 'current_np_id') else None
+            self.tab_print.set_current_np(current_np)
+        elif idx == 5: 
+            self.tab_converter.refresh_if_changed()
+        elif idx == 6:
+            self.tab_database.refresh()
+
+    def on_project_select(self, project_id):
+        self.current_project_id = project_id
+        proj = self.db.reference_row("progetti", project_id)
+        if proj and proj.archivio:
+            # Gli NP di un progetto archiviato non sono nel file principale: niente modifiche
+            self.current_project_id = None
+            self.lbl_project_title.config(text=f"Progetto Archiviato: {proj.titolo} (Cod: {proj.codice}) - riportalo in linea dalla Scheda 1")
+        elif proj:
+            self.lbl_project_title.config(text=f"Progetto Attivo: {proj.titolo} (Cod: {proj.codice})")
+        
+        self.tab_np.refresh_data("WHERE progetto_id=?", (project_id,))
+        self.current_np_id = None
+        self.clear_details_view()
+
+    def after_restore(self):
+        """Dopo un ripristino da backup tutte le schede ripartono dai nuovi dati"""
+        if self._flush_job:
+            self.after_cancel(self._flush_job)
+            self._flush_job = None
+        self.pending_perc.clear()
+        self.pending_versions.clear()
+        self.current_project_id = None
+        self.current_np_id = None
+        self.lbl_project_title.config(text="Nessun Progetto Selezionato")
+        self.tab_progetti.refresh_data()
+        self.tab_admin.refresh_data()
+        for row in self.tab_np.tree.get_children(): self.tab_np.tree.delete(row)
+        self.clear_details_view()
+
+    def goto_tab_np(self, project_id):
+        self.on_project_select(project_id)
+        self.notebook.select(self.frame_tab2)
+
+    def on_np_select(self, np_id):
+        self.current_np_id = np_id
+        self.refresh_details_tree()
+
+    def goto_tab_details(self, np_id):
+        self.on_np_select(np_id)
+        self.notebook.select(self.frame_det_np)
+
+    # --- LOGICA TAB 3 ---
+    def setup_details_tab(self):
+        self.lbl_np_details = ttk.Label(self.frame_det_np, text="Nessun NP Selezionato", font=("Arial", 12, "bold"), foreground="#0055aa", padding=10)
+        self.lbl_np_details.pack(side="top", fill="x")
+
+        # Input Frame
+        self.det_input_frame = ttk.LabelFrame(self.frame_det_np, text="Voce di Costo", padding=10)
+        self.det_input_frame.pack(side="top", fill="x", padx=10, pady=5)
+
+        # --- RIGA 1: Intestazioni ---
+        ttk.Label(self.det_input_frame, text="N. Ordine", font=("Arial", 9, "bold")).grid(row=0, column=0, sticky="w", padx=5)
+        ttk.Label(self.det_input_frame, text="Categoria", font=("Arial", 9, "bold")).grid(row=0, column=1, sticky="w", padx=5)
+        ttk.Label(self.det_input_frame, text="Descrizione", font=("Arial", 9, "bold")).grid(row=0, column=2, sticky="w", padx=5)
+
+        # --- RIGA 2: Input Parte Alta ---
+        # Ordine
+        self.entry_order = ttk.Entry(self.det_input_frame, width=8)
+        self.entry_order.grid(row=1, column=0, sticky="nw", padx=5, pady=(0, 10))
+
+        # Categoria (MODIFICATA: Solo Manodopera, Prodotti, Attrezzature)
+        self.combo_cat = ttk.Combobox(self.det_input_frame, values=["Manodopera", "Prodotti", "Attrezzature"], state="readonly", width=18)
+        self.combo_cat.grid(row=1, column=1, sticky="nw", padx=5, pady=(0, 10))
+        self.combo_cat.current(0)
+
+        # Descrizione (Frame Contenitore per Text + Scrollbar)
+        desc_frame = ttk.Frame(self.det_input_frame)
+        desc_frame.grid(row=1, column=2, sticky="ew", padx=5, pady=(0, 10))
+        
+        self.txt_desc = tk.Text(desc_frame, height=2, width=30, font=("Arial", 9))
+        self.txt_desc.pack(side="left", fill="both", expand=True)
+        
+        sb_desc = ttk.Scrollbar(desc_frame, orient="vertical", command=self.txt_desc.yview)
+        sb_desc.pack(side="right", fill="y")
+        self.txt_desc.config(yscrollcommand=sb_desc.set)
+        
+        self.det_input_frame.columnconfigure(2, weight=1)
+
+        # --- RIGA 3: Intestazioni Parte Bassa ---
+        ttk.Label(self.det_input_frame, text="UM", font=("Arial", 9, "bold")).grid(row=2, column=0, sticky="w", padx=5)
+        ttk.Label(self.det_input_frame, text="Quantità", font=("Arial", 9, "bold")).grid(row=2, column=1, sticky="w", padx=5)
+        ttk.Label(self.det_input_frame, text="Prezzo Unitario", font=("Arial", 9, "bold")).grid(row=2, column=2, sticky="w", padx=5)
+
+        # --- RIGA 4: Input Parte Bassa ---
+        self.combo_um = ttk.Combobox(self.det_input_frame, width=12, postcommand=self.populate_um_combo) 
+        self.combo_um.grid(row=3, column=0, sticky="w", padx=5, pady=(0, 5))
+
+        self.entry_q = ttk.Entry(self.det_input_frame, width=12)
+        self.entry_q.grid(row=3, column=1, sticky="w", padx=5, pady=(0, 5))
+
+        self.entry_pu = ttk.Entry(self.det_input_frame, width=12)
+        self.entry_pu.grid(row=3, column=2, sticky="w", padx=5, pady=(0, 5))
+        self.lbl_np_rif = ttk.Label(self.det_input_frame, text="", foreground="#0055aa")
+        self.lbl_np_rif.grid(row=3, column=2, sticky="e", padx=5, pady=(0, 5))
+
+        # Content Frame
+        content_frame = ttk.Frame(self.frame_det_np)
+        content_frame.pack(side="top", fill="both", expand=True, padx=10, pady=5)
+
+        cols = ("ordine", "cat", "desc", "um", "q", "pu", "totale")
+        self.tree_det = ttk.Treeview(content_frame, columns=cols, show="headings")
+        self.det = CostItemEditor(self.db, self.tree_det)
+        headers = ["N.", "Categoria", "Descrizione", "UM", "Q", "PU", "Totale"]
+        widths = [40, 100, 300, 50, 80, 80, 100]
+        
+        # Setup Ordinamento Tab 3
+        for c, h, w in zip(cols, headers, widths):
+            align = "w"
+            if c in ("ordine", "q", "pu", "totale"): align = "e"
+            self.tree_det.heading(c, text=h, command=lambda _c=c: self.sort_det_column(_c, False))
+            self.tree_det.column(c, width=w, anchor=align)
+        
+        self.tree_det.pack(side="left", fill="both", expand=True)
+        sb = ttk.Scrollbar(content_frame, orient="vertical", command=self.tree_det.yview)
+        sb.pack(side="left", fill="y")
+        self.tree_det.configure(yscroll=sb.set)
+
+        btn_frame = ttk.Frame(content_frame)
+        btn_frame.pack(side="right", fill="y", padx=5)
+        ttk.Button(btn_frame, text="Aggiungi", command=self.add_cost_item).pack(fill="x", pady=2)
+        ttk.Button(btn_frame, text="Aggiorna", command=self.update_cost_item).pack(fill="x", pady=2)
+        ttk.Button(btn_frame, text="Elimina", command=self.delete_cost_item).pack(fill="x", pady=2)
+        ttk.Button(btn_frame, text="Pulisci", command=self.clear_details_inputs).pack(fill="x", pady=10)
+        
+        # --- PULSANTE NUOVO: CERCA DA STORICO ---
+        ttk.Separator(btn_frame, orient="horizontal").pack(fill="x", pady=5)
+        ttk.Button(btn_frame, text="Cerca da Storico", command=self.open_history_dialog).pack(fill="x", pady=2)
+        ttk.Button(btn_frame, text="Richiama NP...", command=self.open_np_picker).pack(fill="x", pady=2)
+        ttk.Button(btn_frame, text="Scollega NP", command=lambda: self.set_det_np_rif(None)).pack(fill="x", pady=2)
+
+        self.tree_det.bind("<<TreeviewSelect>>", self.on_det_select)
+
+        # RIEPILOGO ECONOMICO
+        self.frame_summary = ttk.LabelFrame(self.frame_det_np, text="Riepilogo Economico", padding=15)
+        self.frame_summary.pack(side="bottom", fill="x", padx=10, pady=10)
+        
+        self.frame_summary.columnconfigure(0, weight=0)
+        self.frame_summary.columnconfigure(1, weight=0) 
+        self.frame_summary.columnconfigure(2, weight=0)
+        self.frame_summary.columnconfigure(3, weight=1)
+
+        ttk.Label(self.frame_summary, text="(A) Totale Voci Elementari:", font=("Arial", 10)).grid(row=0, column=0, columnspan=3, sticky="e", padx=5, pady=2)
+        self.lbl_sum_a = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 10))
+        self.lbl_sum_a.grid(row=0, column=3, sticky="e", padx=5, pady=2)
+
+        ttk.Label(self.frame_summary, text="Spese Generali:", font=("Arial", 10)).grid(row=1, column=0, sticky="e", padx=5, pady=2)
+        self.entry_perc_spese = ttk.Entry(self.frame_summary, width=6, justify="right")
+        self.entry_perc_spese.grid(row=1, column=1, sticky="w", pady=2)
+        self.entry_perc_spese.bind("<Return>", lambda e: self.recalculate_totals())
+        self.entry_perc_spese.bind("<FocusOut>", lambda e: self.recalculate_totals())
+        ttk.Label(self.frame_summary, text="%").grid(row=1, column=2, sticky="w")
+        self.lbl_sum_b = ttk.Label(self.frame_summary, text="€ 0.00 (B)", font=("Arial", 10))
+        self.lbl_sum_b.grid(row=1, column=3, sticky="e", padx=5, pady=2)
+
+        ttk.Label(self.frame_summary, text="↳ di cui Sicurezza (inclusa):", font=("Arial", 9), foreground="#555").grid(row=2, column=0, sticky="e", padx=5, pady=0)
+        self.entry_perc_sicurezza = ttk.Entry(self.frame_summary, width=6, justify="right")
+        self.entry_perc_sicurezza.grid(row=2, column=1, sticky="w", pady=0)
+        self.entry_perc_sicurezza.bind("<Return>", lambda e: self.recalculate_totals())
+        self.entry_perc_sicurezza.bind("<FocusOut>", lambda e: self.recalculate_totals())
+        ttk.Label(self.frame_summary, text="%", foreground="#555").grid(row=2, column=2, sticky="w")
+        self.lbl_val_sicurezza = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 9), foreground="#555")
+        self.lbl_val_sicurezza.grid(row=2, column=3, sticky="e", padx=5, pady=0)
+
+        ttk.Label(self.frame_summary, text="Utili d'Impresa:", font=("Arial", 10)).grid(row=3, column=0, sticky="e", padx=5, pady=2)
+        self.entry_perc_utili = ttk.Entry(self.frame_summary, width=6, justify="right")
+        self.entry_perc_utili.grid(row=3, column=1, sticky="w", pady=2)
+        self.entry_perc_utili.bind("<Return>", lambda e: self.recalculate_totals())
+        self.entry_perc_utili.bind("<FocusOut>", lambda e: self.recalculate_totals())
+        ttk.Label(self.frame_summary, text="%").grid(row=3, column=2, sticky="w")
+        self.lbl_sum_c = ttk.Label(self.frame_summary, text="€ 0.00 (C)", font=("Arial", 10))
+        self.lbl_sum_c.grid(row=3, column=3, sticky="e", padx=5, pady=2)
+
+        ttk.Separator(self.frame_summary, orient="horizontal").grid(row=4, column=0, columnspan=4, sticky="ew", pady=10)
+
+        ttk.Label(self.frame_summary, text="TOTALE COMPLESSIVO NP:", font=("Arial", 12, "bold")).grid(row=5, column=0, columnspan=3, sticky="e", padx=5)
+        self.lbl_total_final = ttk.Label(self.frame_summary, text="€ 0.00", font=("Arial", 13, "bold"), foreground="#0055aa")
+        self.lbl_total_final.grid(row=5, column=3, sticky="e", padx=5)
+
+        self.lbl_incidences = ttk.Label(self.frame_summary, text="", font=("Arial", 8), foreground="#777")
+        self.lbl_incidences.grid(row=6, column=0, columnspan=4, sticky="w", pady=(5,0))
+
+    def sort_det_column(self, col, reverse):
+        # Ordinamento Tab 3 con rilevamento tipo dato
+        l = [(self.tree_det.set(k, col), k) for k in self.tree_det.get_children('')]
+        
+        def det_sort_key(t):
+            val = t[0]
+            if not val: return ""
+            try:
+                # Gestione numeri formattati es. "1.000,00" o "100"
+                clean = str(val).replace('€', '').strip()
+                if '.' in clean and ',' in clean: clean = clean.replace('.', '').replace(',', '.')
+                elif ',' in clean: clean = clean.replace(',', '.')
+                return float(clean)
+            except ValueError:
+                return str(val).lower()
+
+        l.sort(key=det_sort_key, reverse=reverse)
+        for index, (val, k) in enumerate(l):
+            self.tree_det.move(k, '', index)
+        self.tree_det.heading(col, command=lambda: self.sort_det_column(col, not reverse))
+
+    def populate_um_combo(self):
+        token = self.db.change_token("unita_misura")
+        if token == self._um_token: return
+        self._um_token = token
+        ums = self.db.reference_rows("unita_misura")
+        values = [u.codice for u in ums]
+        self.combo_um['values'] = values
+
+    def clear_details_inputs(self):
+        self.set_det_np_rif(None)
+        self.entry_order.delete(0, tk.END)
+        # Svuota il widget Text
+        self.txt_desc.delete("1.0", tk.END)
+        self.entry_q.delete(0, tk.END)
+        self.entry_pu.delete(0, tk.END)
+        self.combo_cat.current(0)
+        self.combo_um.set('')
+        if self.current_np_id:
+            max_ord = self.db.get_max_order(self.current_np_id)
+            self.entry_order.insert(0, str(max_ord + 1))
+
+    def clear_details_view(self):
+        self.det.load(None)
+        self.lbl_sum_a.config(text="€ 0.00")
+        self.lbl_sum_b.config(text="€ 0.00")
+        self.lbl_sum_c.config(text="€ 0.00")
+        self.lbl_val_sicurezza.config(text="€ 0.00")
+        self.lbl_total_final.config(text="€ 0.00")
+        self.lbl_incidences.config(text="")
+        self.lbl_np_details.config(text="Nessun NP Selezionato")
+        self.clear_details_inputs()
+
+    def refresh_details_tree(self):
+        if not hasattr(self, 'current_np_id') or not self.current_np_id:
+            self.det.load(None)
+            return
+        
+        self.flush_pending_writes()
+        np_rec = self.det.load(self.current_np_id)
+        self.saved_perc = None
+        if np_rec:
+            self.saved_perc = {'perc_spese_generali_pb': np_rec.perc_spese_generali_pb,
+                               'perc_sicurezza_pb': np_rec.perc_sicurezza_pb,
+                               'perc_utili_pb': np_rec.perc_utili_pb}
+            self.lbl_np_details.config(text=f"NP Attivo: {np_rec.codice} - {np_rec.descrizione}")
+            self.entry_perc_spese.delete(0, tk.END); self.entry_perc_spese.insert(0, format_perc(np_rec.perc_spese_generali_pb))
+            self.entry_perc_sicurezza.delete(0, tk.END); self.entry_perc_sicurezza.insert(0, format_perc(np_rec.perc_sicurezza_pb))
+            self.entry_perc_utili.delete(0, tk.END); self.entry_perc_utili.insert(0, format_perc(np_rec.perc_utili_pb))
+
+        self.entry_order.delete(0, tk.END)
+        self.entry_order.insert(0, str(self.det.model.max_order() + 1))
+        self.recalculate_totals()
+
+    def apply_item_change(self, item_id, deleted=False):
+        """Aggiorna elenco e riepilogo dopo la scrittura di una sola voce; se il modello
+        non torna con i totali salvati rilegge tutto"""
+        if not self.det.apply_change(item_id, deleted):
+            self.refresh_details_tree()
+            return
+        self.entry_order.delete(0, tk.END)
+        self.entry_order.insert(0, str(self.det.model.max_order() + 1))
+        self.recalculate_totals()
+
+    def recalculate_totals(self):
+        if not self.current_np_id: return
+        entries = (('perc_spese_generali_pb', self.entry_perc_spese),
+                   ('perc_sicurezza_pb', self.entry_perc_sicurezza),
+                   ('perc_utili_pb', self.entry_perc_utili))
+        try:
+            p_spese, p_sicurezza, p_utili = [parse_perc(entry.get()) for _, entry in entries]
+        except ValueError as e:
+            # Nulla va in coda: i campi tornano ai valori salvati prima dell'avviso
+            if self.saved_perc is not None:
+                for field, entry in entries:
+                    entry.delete(0, tk.END); entry.insert(0, format_perc(self.saved_perc[field]))
+            messagebox.showwarning("Percentuale non valida", str(e))
+            return
+
+        summary = self.det.model.summary(p_spese, p_sicurezza, p_utili)
+
+        self.lbl_sum_a.config(text=format_currency(from_cent(summary.totale_a_cent)))
+        self.lbl_sum_b.config(text=format_currency(from_cent(summary.spese_generali_cent)))
+        self.lbl_val_sicurezza.config(text=f"({format_currency(from_cent(summary.sicurezza_cent))})")
+        self.lbl_sum_c.config(text=format_currency(from_cent(summary.utili_cent)))
+        self.lbl_total_final.config(text=format_currency(from_cent(summary.totale_cent)))
+        self.lbl_incidences.config(text=f"INFO: Incidenza Manodopera sul totale: {summary.incidenza_manodopera:.2f}% | Incidenza Sicurezza sul totale: {summary.incidenza_sicurezza:.2f}%")
+
+        # prezzo_finale_cent viene ricalcolato dal trigger sulle percentuali.
+        # Si salva solo se i valori sono cambiati, e non subito: vedi flush_pending_writes
+        data = {'perc_spese_generali_pb': p_spese, 'perc_sicurezza_pb': p_sicurezza, 'perc_utili_pb': p_utili}
+        if self.saved_perc is None or data == self.saved_perc: return
+        self.saved_perc = data
+        self.pending_perc[self.current_np_id] = data
+        # Si confronta con la versione letta, anche se le modifiche in coda sono più d'una
+        self.pending_versions.setdefault(self.current_np_id, self.det.np_version)
+        if self._flush_job:
+            self.after_cancel(self._flush_job)
+        self._flush_job = self.after(self.WRITE_BEHIND_DELAY_MS, lambda: self.after_idle(self.flush_pending_writes))
+
+    def flush_pending_writes(self):
+        """Salva le percentuali in sospeso con un'unica transazione"""
+        if self._flush_job:
+            self.after_cancel(self._flush_job)
+            self._flush_job = None
+        if not self.pending_perc: return
+        rows = list(self.pending_perc.items())
+        versions = {np_id: v for np_id, v in self.pending_versions.items() if v is not None}
+        self.pending_perc.clear()
+        self.pending_versions.clear()
+        def write():
+            self.db.update_many("nuovi_prezzi", rows, versions=versions)
+            return self.db.propagate_np_prices([np_id for np_id, _ in rows])
+        try:
+            propagated = self.db.run_transaction(write)
+        except ConflictError as e:
+            messagebox.showwarning("Modifica concorrente", f"Percentuali non salvate.\n{e}")
+            if self.current_np_id in e.record_ids: self.refresh_details_tree()
+            return
+        except sqlite3.OperationalError as e:
+            if is_busy_error(e):
+                # Restano in coda per il prossimo salvataggio, salvo modifiche più recenti
+                for np_id, data in rows:
+                    self.pending_perc.setdefault(np_id, data)
+                    if np_id in versions: self.pending_versions.setdefault(np_id, versions[np_id])
+            show_db_error(e, "Errore Salvataggio")
+            return
+        except (sqlite3.Error, ValueError) as e:
+            messagebox.showerror("Errore Salvataggio", f"Percentuali non salvate:\n{e}")
+            return
+        if self.current_np_id in versions:
+            self.det.np_version = versions[self.current_np_id] + 1
+        self._after_propagation(propagated)
+
+    def on_close(self):
+        # Con il database occupato le percentuali restano in coda: non si chiude perdendole
+        self.flush_pending_writes()
+        while self.pending_perc:
+            if not messagebox.askretrycancel("Percentuali non salvate",
+                                             "Alcune percentuali modificate non sono ancora salvate.\n"
+                                             "Riprovare il salvataggio? Annulla lascia aperto il programma."):
+                return
+            self.flush_pending_writes()
+        self.tab_database.run_shutdown_maintenance()
+        self.destroy()
+
+    def on_det_select(self, event):
+        selected = self.tree_det.selection()
+        if not selected: return
+        vals = self.tree_det.item(selected[0])['values']
+        self.entry_order.delete(0, tk.END); self.entry_order.insert(0, vals[0])
+        self.combo_cat.set(vals[1])
+        
+        # Gestione Text widget
+        self.txt_desc.delete("1.0", tk.END)
+        self.txt_desc.insert("1.0", vals[2])
+        
+        self.combo_um.set(vals[3])
+        self.set_det_np_rif(None)
+        q_val = parse_decimal(vals[4])
+        pu_val = parse_decimal(vals[5])
+        self.entry_q.delete(0, tk.END); 
+        self.entry_q.insert(0, f"{q_val:.3f}".replace('.', ','))
+        self.entry_pu.delete(0, tk.END); 
+        self.entry_pu.insert(0, f"{pu_val:.3f}".replace('.', ','))
+        item = self.det.model.items.get(int(selected[0]))
+        self.set_det_np_rif(item.np_rif_id if item else None)
+
+    # --- FUNZIONI PER POPOLAMENTO DA STORICO ---
+    def open_history_dialog(self):
+        if not self.current_project_id:
+            messagebox.showwarning("Attenzione", "Nessun progetto selezionato.")
+            return
+        HistoryDialog(self, self.db, self.current_project_id, self.import_from_history_wrapper)
+
+    def import_from_history_wrapper(self, cat, desc, um, pu_mil):
+        # Una voce presa dallo storico ha un prezzo proprio
+        self.set_det_np_rif(None)
+        # Popola i campi della UI
+        self.combo_cat.set(cat)
+        
+        self.txt_desc.delete("1.0", tk.END)
+        self.txt_desc.insert("1.0", desc)
+        
+        self.combo_um.set(um)
+        
+        self.entry_pu.delete(0, tk.END)
+        self.entry_pu.insert(0, f"{from_mil(pu_mil):.3f}".replace('.', ','))
+        
+        # Pulisci quantità perché è specifica del nuovo inserimento
+        self.entry_q.delete(0, tk.END)
+
+    # --- VOCI CHE RICHIAMANO UN NP ---
+    def open_np_picker(self):
+        if not self.current_np_id:
+            messagebox.showwarning("Attenzione", "Seleziona NP")
+            return
+        NPPickerDialog(self, self.db, self.current_np_id, self.link_np_wrapper)
+
+    def link_np_wrapper(self, rif):
+        self.set_det_np_rif(rif.id)
+        if not self.txt_desc.get("1.0", "end-1c").strip():
+            self.txt_desc.insert("1.0", f"{rif.codice} - {rif.descrizione}")
+        self.combo_um.set(rif.unita_misura or "")
+        if not self.entry_q.get().strip():
+            self.entry_q.insert(0, "1,000")
+
+    def set_det_np_rif(self, np_rif_id):
+        """Collega (o scollega con None) la voce in compilazione a un NP: il prezzo unitario
+        diventa il prezzo finale di quell'NP e non si modifica a mano"""
+        rif = self.det.link(np_rif_id)
+        self.entry_pu.config(state="normal")
+        if rif:
+            self.entry_pu.delete(0, tk.END)
+            self.entry_pu.insert(0, f"{from_cent(rif.prezzo_finale_cent):.3f}".replace('.', ','))
+            self.entry_pu.config(state="disabled")
+            self.lbl_np_rif.config(text=f"Prezzo da NP {rif.codice}")
+        else:
+            self.lbl_np_rif.config(text="")
+
+    def _after_propagation(self, np_ids):
+        # Gli NP che contengono quello modificato hanno cambiato prezzo
+        if np_ids and self.current_project_id:
+            self.tab_np.refresh_data("WHERE progetto_id=?", (self.current_project_id,))
+
+    def add_cost_item(self):
+        if not hasattr(self, 'current_np_id') or not self.current_np_id:
+            messagebox.showwarning("Attenzione", "Seleziona NP")
+            return
+        try:
+            q = to_mil(self.entry_q.get())
+            pu = to_mil(self.entry_pu.get())
+            ord_val = int(float(self.entry_order.get()))
+        except ValueError as e:
+            messagebox.showerror("Errore", str(e)); return
+        
+        # Recupero testo dal widget Text
+        desc_val = self.txt_desc.get("1.0", "end-1c")
+        
+        data = {'ordine': ord_val, 'categoria': self.combo_cat.get(), 'descrizione': desc_val, 'um': self.combo_um.get(), 'quantita_mil': q, 'prezzo_unitario_mil': pu}
+        try:
+            new_id, propagated = self.det.add_item(data)
+        except sqlite3.OperationalError as e:
+            show_db_error(e); return
+        except ValueError as e:
+            messagebox.showerror("Errore", str(e)); return
+        self.apply_item_change(new_id)
+        self._after_propagation(propagated)
+
+    def update_cost_item(self):
+        selected = self.tree_det.selection()
+        if not selected: return
+        try:
+            q = to_mil(self.entry_q.get())
+            pu = to_mil(self.entry_pu.get())
+            ord_val = int(float(self.entry_order.get()))
+            
+            # Recupero testo dal widget Text
+            desc_val = self.txt_desc.get("1.0", "end-1c")
+            
+            data = {'ordine': ord_val, 'categoria': self.combo_cat.get(), 'descrizione': desc_val, 'um': self.combo_um.get(), 'quantita_mil': q, 'prezzo_unitario_mil': pu}
+            propagated = self.det.update_item(int(selected[0]), data)
+            self.apply_item_change(int(selected[0]))
+            self._after_propagation(propagated)
+        except ConflictError as e:
+            messagebox.showwarning("Modifica concorrente", str(e))
+            self.refresh_details_tree()
+        except sqlite3.OperationalError as e:
+            show_db_error(e)
+        except ValueError as e:
+            messagebox.showerror("Errore", str(e))
+
+    def delete_cost_item(self):
+        selected = self.tree_det.selection()
+        if not selected: return
+        try:
+            propagated = self.det.delete_item(int(selected[0]))
+        except ConflictError as e:
+            messagebox.showwarning("Modifica concorrente", str(e))
+            self.refresh_details_tree()
+            return
+        except sqlite3.OperationalError as e:
+            show_db_error(e)
+            return
+        self.apply_item_change(int(selected[0]), deleted=True)
+        self._after_propagation(propagated)
+
+if __name__ == "__main__":
+    app = NPApp()
     app.mainloop()
\ No newline at end of file
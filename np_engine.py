@@ -0,0 +1,152 @@
+"""Motore di calcolo dei Nuovi Prezzi: importi in virgola fissa e riepilogo di un NP.
+
+Non usa Tk né il database, così si importa anche da script e verifiche senza interfaccia.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from collections import namedtuple
+
+# --- IMPORTI IN VIRGOLA FISSA ---
+# Quantità e prezzi unitari sono salvati come interi in millesimi (_mil), i totali
+# in centesimi di euro (_cent) e le percentuali in centesimi di punto (_pb, 17% = 1700).
+# Tutti i calcoli sono interi e arrotondati "half-up" allo stesso modo in Python e in SQL.
+MIL = 1000
+CENT = 100
+PB = 100
+
+def parse_decimal(value_str, strict=False):
+    """Legge un numero scritto all'italiana ("1.234,5", "€ 12,30") senza passare dai float.
+    Un testo non numerico vale 0, oppure con strict=True solleva ValueError."""
+    if value_str is None or value_str == "": return Decimal(0)
+    if isinstance(value_str, Decimal): return value_str
+    if isinstance(value_str, (int, float)): return Decimal(str(value_str))
+    clean = str(value_str).replace('€', '').replace('%', '').strip()
+    if '.' in clean and ',' in clean:
+        clean = clean.replace('.', '').replace(',', '.')
+    elif ',' in clean:
+        clean = clean.replace(',', '.')
+    try:
+        value = Decimal(clean)
+    except InvalidOperation:
+        if strict: raise ValueError(f"Valore non numerico: {value_str}") from None
+        return Decimal(0)
+    if strict and not value.is_finite():
+        raise ValueError(f"Valore non numerico: {value_str}")
+    return value
+
+def _to_scaled(value, scale):
+    return int((parse_decimal(value) * scale).to_integral_value(rounding=ROUND_HALF_UP))
+
+def to_mil(value): return _to_scaled(value, MIL)
+def to_cent(value): return _to_scaled(value, CENT)
+def to_pb(value): return _to_scaled(value, PB)
+
+def from_mil(value): return (value or 0) / MIL
+def from_cent(value): return (value or 0) / CENT
+def from_pb(value): return (value or 0) / PB
+
+def format_perc(value_pb):
+    return f"{from_pb(value_pb):g}"
+
+def parse_perc(value_str):
+    """Percentuale scritta dall'utente, in punti base. Un testo non numerico o fuori
+    da 0-100 solleva ValueError invece di valere 0."""
+    try:
+        value = parse_decimal(value_str, strict=True)
+    except ValueError:
+        raise ValueError(f"Percentuale non valida: {value_str}") from None
+    if not 0 <= value <= 100:
+        raise ValueError(f"Percentuale non valida: {value_str}")
+    return to_pb(value)
+
+def div_round(n, d):
+    """Divisione intera con arrotondamento half-up simmetrico (identica a sql_div_round)"""
+    q, r = divmod(abs(n), d)
+    if 2 * r >= d: q += 1
+    return q if n >= 0 else -q
+
+def sql_div_round(expr, divisor):
+    half = divisor // 2
+    return f"(CASE WHEN ({expr}) >= 0 THEN (({expr}) + {half}) / {divisor} ELSE -(({half} - ({expr})) / {divisor}) END)"
+
+def item_amount_cent(quantita_mil, prezzo_unitario_mil):
+    return div_round(quantita_mil * prezzo_unitario_mil, MIL * MIL // CENT)
+
+def np_price_components(totale_a_cent, perc_sg_pb, perc_sic_pb, perc_utili_pb):
+    """(B, sicurezza, C, D) in centesimi: B = SG% di A, sicurezza = S% di B, C = Utili% di (A + B)"""
+    val_b = div_round(totale_a_cent * perc_sg_pb, 100 * PB)
+    val_sic = div_round(val_b * perc_sic_pb, 100 * PB)
+    val_c = div_round((totale_a_cent + val_b) * perc_utili_pb, 100 * PB)
+    return val_b, val_sic, val_c, totale_a_cent + val_b + val_c
+
+# --- MOTORE DI CALCOLO NP ---
+# Unico calcolo del riepilogo per la scheda 3, le stampe HTML e l'export Excel:
+# riceve percentuali e voci, restituisce importi in centesimi.
+NPSummary = namedtuple("NPSummary", (
+    "totale_a_cent", "spese_generali_cent", "sicurezza_cent", "utili_cent", "totale_cent",
+    "manodopera_cent", "incidenza_manodopera", "incidenza_sicurezza", "categorie",
+))
+
+def is_labour_category(categoria):
+    # Stesso criterio dei trigger sugli aggregati: instr(categoria, 'Manodopera') > 0
+    return "Manodopera" in (categoria or "")
+
+def _item_importo_cent(item):
+    amount = getattr(item, "importo_cent", None)
+    return item_amount_cent(item.quantita_mil, item.prezzo_unitario_mil) if amount is None else amount
+
+def summary_from_subtotals(perc_sg_pb, perc_sic_pb, perc_utili_pb, subtotals):
+    """subtotals: {categoria: centesimi}. categorie del risultato in ordine alfabetico."""
+    totale_a = sum(subtotals.values())
+    manodopera = sum(amount for categoria, amount in subtotals.items() if is_labour_category(categoria))
+    val_b, val_sic, val_c, val_d = np_price_components(totale_a, perc_sg_pb, perc_sic_pb, perc_utili_pb)
+    return NPSummary(totale_a, val_b, val_sic, val_c, val_d, manodopera,
+                     manodopera / val_d * 100 if val_d > 0 else 0.0,
+                     val_sic / val_d * 100 if val_d > 0 else 0.0,
+                     tuple(sorted(subtotals.items(), key=lambda entry: entry[0] or "")))
+
+def compute_np_summary(perc_sg_pb, perc_sic_pb, perc_utili_pb, items):
+    """items: voci con categoria e importo_cent (oppure quantita_mil e prezzo_unitario_mil)"""
+    subtotals = {}
+    for item in items:
+        subtotals[item.categoria] = subtotals.get(item.categoria, 0) + _item_importo_cent(item)
+    return summary_from_subtotals(perc_sg_pb, perc_sic_pb, perc_utili_pb, subtotals)
+
+class NPRunningTotals:
+    """Voci e subtotali dell'NP aperto, aggiornati per differenza: aggiungere, modificare
+    o togliere una voce non richiede di rileggere e risommare tutte le altre"""
+    def __init__(self, items=()):
+        self.items = {}
+        self.subtotals = {}
+        self.counts = {}
+        for item in items: self.add(item)
+
+    def _account(self, item, sign):
+        categoria = item.categoria
+        self.subtotals[categoria] = self.subtotals.get(categoria, 0) + sign * _item_importo_cent(item)
+        self.counts[categoria] = self.counts.get(categoria, 0) + sign
+        # Una categoria senza voci sparisce, come nel ricalcolo completo
+        if not self.counts[categoria]:
+            del self.subtotals[categoria], self.counts[categoria]
+
+    def add(self, item):
+        self.items[item.id] = item
+        self._account(item, 1)
+
+    def remove(self, item_id):
+        item = self.items.pop(item_id)
+        self._account(item, -1)
+        return item
+
+    def totale_a_cent(self):
+        return sum(self.subtotals.values())
+
+    def max_order(self):
+        return max((item.ordine for item in self.items.values()), default=0)
+
+    def position(self, item):
+        """Posizione della voce nell'elenco per ordine (a parità, per id) senza contarla"""
+        key = (item.ordine, item.id)
+        return sum(1 for other in self.items.values() if other.id != item.id and (other.ordine, other.id) < key)
+
+    def summary(self, perc_sg_pb, perc_sic_pb, perc_utili_pb):
+        return summary_from_subtotals(perc_sg_pb, perc_sic_pb, perc_utili_pb, self.subtotals)
@@ -0,0 +1,683 @@
+"""Verifiche senza interfaccia per la CI: piani di esecuzione SQL, motore di calcolo,
+calcolo incrementale della scheda 3 e NP composti, su database sintetici temporanei.
+Uso: python -m unittest -v test_np_zero"""
+import importlib.util
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from decimal import Decimal
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+# Il nome del file dell'app contiene punti: si carica come modulo "np_zero"
+_spec = importlib.util.spec_from_file_location("np_zero", os.path.join(HERE, "Np_Zero_2.0.0.py"))
+np_zero = importlib.util.module_from_spec(_spec)
+sys.modules["np_zero"] = np_zero
+_spec.loader.exec_module(np_zero)
+
+from np_zero import (Database, QueryProfiler, PrintPanel, CostItemEditor, ConflictError, backup_database, DEFAULT_UNITA_MISURA, VERSIONED_TABLES,
+                     HISTORY_QUERY, HISTORY_SEARCH_LIMIT, LISTING_PAGE_SIZE, NP_REF_PRICE_MIL)
+from np_engine import compute_np_summary, parse_decimal, parse_perc
+
+# --- VERIFICA DEI PIANI DI ESECUZIONE ---
+# Esegue su un database sintetico i percorsi SQL dell'app (metodi di Database e letture
+# di dialoghi, copia ed export), raccoglie ogni forma di istruzione tramite il profiler
+# e segnala i piani che leggono per intero voci_costo o nuovi_prezzi, o che ordinano
+# con un B-tree temporaneo dove basterebbe un indice.
+PLAN_SCAN_TABLES = ("voci_costo", "nuovi_prezzi")
+# Tabelle con un indice per ogni ordinamento offerto (unita_misura resta in cache)
+PLAN_SORTED_TABLES = ("voci_costo", "nuovi_prezzi", "progetti")
+# Percorsi che per definizione leggono tutta la tabella
+PLAN_FULL_SCAN_ALLOWED = ("Database.find_orphans", "Database.purge_orphans")
+# Istruzioni senza piano: transazioni, pragma, DDL
+PLAN_SKIP_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "ATTACH",
+                      "DETACH", "CREATE", "ANALYZE", "VACUUM", "EXPLAIN")
+# Colonne ordinabili degli elenchi delle schede 1, 2 e 4
+PLAN_CHECK_LISTINGS = [
+    ("progetti", ("codice", "titolo", "cup", "committente"), ""),
+    ("nuovi_prezzi", ("codice", "descrizione", "unita_misura", "prezzo_finale_cent"), "WHERE progetto_id=?"),
+    ("unita_misura", ("codice", "nome", "descrizione"), ""),
+]
+SYNTHETIC_WORDS = ("calce", "malta", "cemento", "armatura", "scavo", "tubazione", "intonaco",
+                   "pavimento", "infisso", "rete", "posa", "fornitura", "trasporto", "getto")
+
+class PlanCollector(QueryProfiler):
+    """Profiler che alla prima esecuzione di ogni forma ne salva il piano, sulla stessa
+    connessione (gli archivi collegati in quel momento sono visibili)"""
+    def __init__(self):
+        super().__init__(slow_ms=float("inf"))
+        self.origin = ""
+        self.plans = {}
+
+    def record(self, conn, query, params, elapsed, rows):
+        shape = self.shape(query)
+        if shape not in self.plans and not shape.upper().startswith(PLAN_SKIP_PREFIXES):
+            try:
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+            except (sqlite3.Error, ValueError) as e:
+                plan = [f"ERRORE: {e}"]
+            self.plans[shape] = (self.origin, plan)
+        super().record(conn, query, params, elapsed, rows)
+
+def _plan_sources(sql):
+    """Nome o alias -> (schema, tabella) per le tabelle citate dopo FROM, JOIN, UPDATE, INTO"""
+    sources = {}
+    pattern = (r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(?:(\w+)\.)?(\w+)"
+               r"(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|ORDER|GROUP|LIMIT|SET|USING|LEFT|INNER|CROSS|VALUES|SELECT)\b)(\w+))?")
+    for schema, table, alias in re.findall(pattern, sql, re.IGNORECASE):
+        sources[table] = (schema or "main", table)
+        if alias: sources[alias] = (schema or "main", table)
+    return sources
+
+def _index_servable_order(sql):
+    """True se l'ORDER BY finale usa solo colonne (niente posizioni o espressioni)"""
+    found = re.findall(r"ORDER BY\s+(.+?)(?:\s+LIMIT\b|\)|$)", sql, re.IGNORECASE)
+    if not found: return False
+    terms = [t.strip() for t in found[-1].split(",")]
+    return all(re.fullmatch(r"(?:\w+\.)?[A-Za-z_]\w*(?:\s+(?:ASC|DESC))?", t, re.IGNORECASE) for t in terms)
+
+def plan_problems(sql, plan, origin=""):
+    sources = _plan_sources(sql)
+    problems = []
+    for step in plan:
+        if step.startswith("ERRORE"):
+            problems.append(step)
+            continue
+        scan = re.match(r"SCAN (?:(\w+)\.)?(\w+)", step)
+        if scan:
+            schema, table = sources.get(scan.group(2), ("main", scan.group(2)))
+            schema = scan.group(1) or schema
+            # Gli archivi collegati contengono un solo progetto: leggerli per intero è corretto
+            if table in PLAN_SCAN_TABLES and schema == "main" and origin not in PLAN_FULL_SCAN_ALLOWED:
+                problems.append(f"lettura completa di {table}: {step}")
+        if "TEMP B-TREE" in step and "ORDER BY" in step and _index_servable_order(sql):
+            if any(table in PLAN_SORTED_TABLES and schema == "main" for schema, table in sources.values()):
+                problems.append(f"ordinamento senza indice: {step}")
+    return problems
+
+def seed_synthetic_database(db, projects=20, nps_per_project=30, items_per_np=12, seed=1):
+    """Dati sintetici con proporzioni realistiche, poi ANALYZE come dopo la manutenzione"""
+    rnd = random.Random(seed)
+    categories = ("Manodopera", "Prodotti", "Attrezzature", "Trasporti")
+    def phrase(n):
+        return " ".join(rnd.choice(SYNTHETIC_WORDS) for _ in range(n))
+    with db.transaction():
+        for p in range(projects):
+            pid = db.insert("progetti", {"codice": f"P{p:03d}", "titolo": phrase(3).capitalize(),
+                                         "cup": f"CUP{rnd.randrange(10**8):08d}", "committente": phrase(2)})
+            for n in range(nps_per_project):
+                np_id = db.insert("nuovi_prezzi", {"progetto_id": pid, "codice": f"NP.{n:03d}", "descrizione": phrase(6),
+                                                   "unita_misura": rnd.choice(DEFAULT_UNITA_MISURA)[0]})
+                db.insert_many("voci_costo", [{
+                    "np_id": np_id, "ordine": i + 1, "categoria": rnd.choice(categories), "descrizione": phrase(5),
+                    "um": rnd.choice(DEFAULT_UNITA_MISURA)[0], "quantita_mil": rnd.randrange(1, 100000),
+                    "prezzo_unitario_mil": rnd.randrange(1, 10**7),
+                } for i in range(items_per_np)])
+    db.analyze()
+
+class FakeTree:
+    """Elenco in memoria con la parte dell'interfaccia di ttk.Treeview usata da CostItemEditor"""
+    def __init__(self):
+        self.rows = []
+
+    def _index(self, iid):
+        return [row[0] for row in self.rows].index(str(iid))
+
+    def get_children(self, item=""):
+        return tuple(row[0] for row in self.rows)
+
+    def exists(self, iid):
+        return str(iid) in self.get_children()
+
+    def item(self, iid, values):
+        self.rows[self._index(iid)][1] = tuple(values)
+
+    def move(self, iid, parent, index):
+        # Come Tk: index è la posizione tra gli altri elementi
+        self.rows.insert(index, self.rows.pop(self._index(iid)))
+
+    def insert(self, parent, index, iid, values):
+        index = len(self.rows) if index == "end" else index
+        self.rows.insert(index, [str(iid), tuple(values)])
+
+    def delete(self, *iids):
+        for iid in iids:
+            del self.rows[self._index(iid)]
+
+def exercise_application_queries(db, collector):
+    """Ripercorre le letture e scritture dell'app con gli stessi argomenti dei chiamanti"""
+    def at(origin):
+        collector.origin = origin
+
+    projects = db.fetch_all("progetti", "ORDER BY id", columns=("id",))
+    pid, other_pid, archived_pid = projects[0].id, projects[1].id, projects[2].id
+    np_id = db.fetch_one("nuovi_prezzi", "WHERE progetto_id=? ORDER BY codice", (pid,), columns=("id",)).id
+
+    at("CrudPanel.load_page")
+    for table, fields, condition in PLAN_CHECK_LISTINGS:
+        params = (pid,) if condition else ()
+        columns = list(fields) + (["row_version"] if table in VERSIONED_TABLES else [])
+        for sort_col in fields:
+            for descending in (False, True):
+                rows, _, token = db.select_page(table, columns, sort_col, descending, condition, params, page_size=5)
+                if token:
+                    _, back, _ = db.select_page(table, columns, sort_col, descending, condition, params, token, page_size=5)
+                    if back: db.select_page(table, columns, sort_col, descending, condition, params, back, page_size=5)
+        db.change_token(table)
+
+    at("Database.reference_rows")
+    db.reference_rows("progetti"); db.reference_rows("unita_misura"); db.reference_row("progetti", pid)
+
+    at("NPApp.refresh_details_tree")
+    np_rec = db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,))
+    editor = CostItemEditor(db, FakeTree())
+    editor.load(np_id)
+    items = sorted(editor.model.items.values(), key=lambda item: (item.ordine, item.id))
+    db.get_max_order(np_id)
+
+    at("NPApp.flush_pending_writes")
+    db.update_many("nuovi_prezzi", [(np_id, {"perc_spese_generali_pb": 1500, "perc_sicurezza_pb": 500, "perc_utili_pb": 1000})],
+                   versions={np_id: np_rec.row_version})
+    at("NPApp.update_cost_item")
+    editor.update_item(items[0].id, {"quantita_mil": 2000})
+    editor.apply_change(items[0].id)
+    at("NPApp.delete_cost_item")
+    editor.delete_item(items[-1].id)
+    editor.apply_change(items[-1].id, deleted=True)
+
+    at("NPPickerDialog")
+    sub_np = db.np_reference_candidates(np_id)[0]
+    at("NPApp.set_det_np_rif")
+    editor.link(sub_np.id)
+    at("NPApp.add_cost_item")
+    new_id, _ = editor.add_item({"ordine": 99, "categoria": "Prodotti", "descrizione": sub_np.codice, "um": "cad",
+                                 "quantita_mil": 2000, "prezzo_unitario_mil": 0})
+    editor.apply_change(new_id)
+    at("Database.propagate_np_prices")
+    db.update("nuovi_prezzi", sub_np.id, {"perc_utili_pb": 1200})
+    db.propagate_np_prices([sub_np.id])
+    at("Database._raise_conflict")
+    try:
+        db.update("voci_costo", items[0].id, {"quantita_mil": 3000}, version=items[0].row_version)
+    except ConflictError:
+        pass
+
+    at("PrintPanel.set_current_np")
+    db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,), columns=("codice", "descrizione"))
+    at("PrintPanel.generate_html_print")
+    for np in db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (pid,), columns=("id",)):
+        np_rec = db.fetch_one("nuovi_prezzi", "WHERE id=?", (np.id,))
+        db.np_summary(np_rec, db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (np.id,), columns=PrintPanel.ITEM_COLUMNS))
+    at("PrintPanel.generate_excel_export")
+    for np in db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (pid,)):
+        db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY categoria, ordine", (np.id,), columns=PrintPanel.ITEM_COLUMNS)
+    at("Database.np_summary")
+    db._bound("summaries").clear()
+    for np in db.fetch_all("nuovi_prezzi", "WHERE progetto_id=?", (pid,)):
+        db.np_summary(np)
+    at("Database.recompute_project")
+    db.recompute_project(pid)
+    at("ReparameterizeDialog.apply")
+    nps = db.fetch_all("nuovi_prezzi", "WHERE progetto_id=? ORDER BY codice", (pid,))
+    db.update_many("nuovi_prezzi", [(np.id, {"perc_spese_generali_pb": 1500}) for np in nps],
+                   versions={np.id: np.row_version for np in nps})
+
+    at("HistoryDialog.load_data")
+    db.search_cost_items(pid, "", HISTORY_SEARCH_LIMIT)
+    db.search_cost_items(pid, "calce ar", HISTORY_SEARCH_LIMIT)
+    has_fts, db.has_fts = db.has_fts, False
+    db.search_cost_items(pid, "calce ar", HISTORY_SEARCH_LIMIT)
+    db.has_fts = has_fts
+
+    at("Database.archive_project")
+    db.archive_project(archived_pid)
+    at("HistoryDialog.load_data")
+    db.search_archived_cost_items("", HISTORY_SEARCH_LIMIT)
+    db.search_archived_cost_items("calce", HISTORY_SEARCH_LIMIT)
+
+    for source_pid in (other_pid, archived_pid):
+        at("ImportDialog.load_nps")
+        with db.attached_archive(source_pid) as schema:
+            source = db.fetch_all(f"{schema}.nuovi_prezzi", "WHERE progetto_id=?", (source_pid,), columns=("id", "codice", "descrizione"))
+        at("NPApp._copy_np_logic")
+        with db.attached_archive(source_pid) as schema:
+            src_rec = db.fetch_one(f"{schema}.nuovi_prezzi", "WHERE id=?", (source[0].id,))
+            copy_columns = ("ordine", "categoria", "descrizione", "um", "quantita_mil", "prezzo_unitario_mil")
+            copied = db.fetch_all(f"{schema}.voci_costo", "WHERE np_id=? ORDER BY ordine", (source[0].id,), columns=copy_columns)
+        with db.transaction():
+            new_np_id = db.insert("nuovi_prezzi", {"progetto_id": pid, "codice": src_rec.codice + "_imp",
+                                                   "descrizione": src_rec.descrizione, "unita_misura": src_rec.unita_misura})
+            db.insert_many("voci_costo", [dict(item._asdict(), np_id=new_np_id) for item in copied])
+
+    at("Database.unarchive_project")
+    db.unarchive_project(archived_pid)
+
+    at("CrudPanel.delete_record")
+    db.delete("nuovi_prezzi", new_np_id)
+    at("Database.find_orphans")
+    db.find_orphans()
+    at("Database.purge_orphans")
+    db._execute("PRAGMA foreign_keys=OFF")
+    db._execute("DELETE FROM progetti WHERE id=?", (other_pid,))
+    db._execute("PRAGMA foreign_keys=ON")
+    db.purge_orphans()
+
+# Query "calde" dell'applicazione: nessuna deve ricadere in una SCAN completa della tabella
+HOT_QUERIES = [
+    ("Dettaglio NP", "SELECT id, ordine, categoria, descrizione, um, quantita_mil, prezzo_unitario_mil, importo_cent FROM voci_costo WHERE np_id=? ORDER BY ordine ASC", (1,)),
+    ("Stampa/Export voci", "SELECT categoria, descrizione, um, quantita_mil, prezzo_unitario_mil, importo_cent FROM voci_costo WHERE np_id=? ORDER BY categoria, ordine", (1,)),
+    ("Copia voci NP", "SELECT ordine, categoria, descrizione, um, quantita_mil, prezzo_unitario_mil FROM voci_costo WHERE np_id=?", (1,)),
+    ("Ordine massimo", "SELECT MAX(ordine) FROM voci_costo WHERE np_id=?", (1,)),
+    ("Elenco NP progetto", "SELECT id, codice, descrizione, unita_misura, prezzo_finale_cent FROM nuovi_prezzi WHERE progetto_id=? AND (1) ORDER BY codice ASC, id ASC LIMIT ?", (1, LISTING_PAGE_SIZE)),
+    ("Pagina NP per prezzo", "SELECT id, codice, descrizione, unita_misura, prezzo_finale_cent FROM nuovi_prezzi WHERE progetto_id=? AND ((prezzo_finale_cent, id) < (?, ?)) ORDER BY prezzo_finale_cent DESC, id DESC LIMIT ?", (1, 100000, 1, LISTING_PAGE_SIZE)),
+    ("Pagina progetti per titolo", "SELECT id, codice, titolo, cup, committente FROM progetti WHERE (titolo, id) > (?, ?) ORDER BY titolo ASC, id ASC LIMIT ?", ("", 0, LISTING_PAGE_SIZE)),
+    ("NP del progetto", "SELECT id, codice, descrizione FROM nuovi_prezzi WHERE progetto_id=?", (1,)),
+    ("Storico progetto", HISTORY_QUERY, (1, HISTORY_SEARCH_LIMIT)),
+]
+
+def explain_query_plan(db, query, params=()):
+    return [row[3] for row in db._fetchall("EXPLAIN QUERY PLAN " + query, params)]
+
+def check_query_plans(db, queries=HOT_QUERIES):
+    """Restituisce le query che leggono un'intera tabella invece di usare un indice"""
+    regressions = []
+    for label, query, params in queries:
+        scans = [step for step in explain_query_plan(db, query, params) if step.startswith("SCAN ")]
+        if scans:
+            regressions.append((label, scans))
+    return regressions
+
+class DatabaseTestCase(unittest.TestCase):
+    """Database "locale" in una cartella temporanea, chiuso e rimosso a fine prova"""
+    db_name = "verifica.db"
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="np_verifica_")
+        self.db = Database(os.path.join(self.workdir, self.db_name), profile="locale")
+
+    def tearDown(self):
+        self.db.pool.close()
+        self.db.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+class QueryPlanTest(DatabaseTestCase):
+    def test_application_queries_use_indexes(self):
+        seed_synthetic_database(self.db)
+        collector = PlanCollector()
+        self.db.profiler = collector
+        exercise_application_queries(self.db, collector)
+        collector.origin = "HOT_QUERIES"
+        for _, query, params in HOT_QUERIES:
+            self.db._fetchall(query, params)
+        report = []
+        for shape, (origin, plan) in sorted(collector.plans.items(), key=lambda item: item[1][0]):
+            problems = plan_problems(shape, plan, origin)
+            if problems:
+                report.append(f"[{origin}] {shape}\n" + "\n".join(f"    {step}" for step in plan)
+                              + "\n" + "\n".join(f"  -> {problem}" for problem in problems))
+        self.assertTrue(collector.plans)
+        self.assertFalse(report, "\n\n" + "\n\n".join(report))
+
+    def test_hot_queries_avoid_full_scans(self):
+        # Sul database vuoto (senza statistiche) e dopo ANALYZE su dati realistici
+        self.assertEqual(check_query_plans(self.db), [])
+        seed_synthetic_database(self.db)
+        self.assertEqual(check_query_plans(self.db), [])
+
+class TransactionRetryTest(DatabaseTestCase):
+    """run_transaction: un blocco interrotto da un lock si annulla e si riesegue da capo"""
+    def _flaky_insert(self, failures, error="database is locked"):
+        calls = []
+        def write():
+            calls.append(self.db.insert("progetti", {"codice": f"R{len(calls)}", "titolo": "Ritentativo"}))
+            if len(calls) <= failures:
+                raise sqlite3.OperationalError(error)
+            return calls[-1]
+        return calls, write
+
+    def test_busy_block_is_rerun(self):
+        calls, write = self._flaky_insert(failures=2)
+        project_id = self.db.run_transaction(write)
+        self.assertEqual(len(calls), 3)
+        # Degli inserimenti dei tentativi falliti non resta nulla
+        self.assertEqual([p.id for p in self.db.fetch_all("progetti")], [project_id])
+
+    def test_other_errors_are_not_retried(self):
+        calls, write = self._flaky_insert(failures=1, error="disk I/O error")
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.run_transaction(write)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.db.fetch_all("progetti"), [])
+
+    def test_error_after_automatic_rollback_is_kept(self):
+        # SQLite annulla da sé la transazione (es. disco pieno): l'errore originale resta visibile
+        def write():
+            self.db.insert("progetti", {"codice": "P1", "titolo": "Annullato"})
+            self.db.conn.execute("ROLLBACK")
+            raise sqlite3.OperationalError("database or disk is full")
+        with self.assertRaisesRegex(sqlite3.OperationalError, "disk is full"):
+            self.db.run_transaction(write)
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(self.db.fetch_all("progetti"), [])
+
+    def test_nested_block_leaves_retry_to_outer(self):
+        calls, write = self._flaky_insert(failures=1)
+        outer = []
+        def outer_block():
+            outer.append(1)
+            return self.db.run_transaction(write)
+        self.db.run_transaction(outer_block)
+        self.assertEqual((len(outer), len(calls)), (2, 2))
+        self.assertEqual(len(self.db.fetch_all("progetti")), 1)
+
+class ArchivedProjectDeleteTest(DatabaseTestCase):
+    """Cancellare un progetto archiviato elimina anche il suo file in NP_ARCHIVIO"""
+    def setUp(self):
+        super().setUp()
+        seed_synthetic_database(self.db, projects=2, nps_per_project=3, items_per_np=2)
+        self.project = self.db.fetch_all("progetti", "ORDER BY id")[0]
+        self.path = self.db.archive_project(self.project.id)
+        self.project = self.db.fetch_one("progetti", "WHERE id=?", (self.project.id,))
+
+    def test_delete_removes_archive_file(self):
+        self.db.delete_project(self.project.id, version=self.project.row_version)
+        self.assertIsNone(self.db.fetch_one("progetti", "WHERE id=?", (self.project.id,)))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_failed_delete_keeps_archive_file(self):
+        with self.assertRaises(ConflictError):
+            self.db.delete_project(self.project.id, version=self.project.row_version - 1)
+        self.assertIsNotNone(self.db.fetch_one("progetti", "WHERE id=?", (self.project.id,)))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [os.path.basename(self.path)])
+
+class ThreadedRecordsTest(DatabaseTestCase):
+    """Righe tipizzate e cache di riferimento con più thread di lavoro insieme"""
+    def test_concurrent_shapes(self, threads=4, rounds=200):
+        seed_synthetic_database(self.db, projects=3, nps_per_project=5, items_per_np=3)
+        shapes = [("progetti", ("codice",)), ("progetti", ("codice", "titolo")),
+                  ("nuovi_prezzi", ("codice", "prezzo_finale_cent")), ("voci_costo", ("np_id", "ordine", "categoria"))]
+        errors = []
+        before = self.db.cache_stats()
+        def job(offset):
+            try:
+                with self.db.worker(readonly=True):
+                    for i in range(rounds):
+                        table, columns = shapes[(i + offset) % len(shapes)]
+                        for row in self.db.fetch_all(table, columns=columns):
+                            if row._fields != columns: errors.append((columns, row._fields))
+                        self.db.reference_rows("unita_misura")
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=job, args=(n,)) for n in range(threads)]
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+        self.assertEqual(errors, [])
+        after = self.db.cache_stats()
+        # Ogni thread parte con la propria cache: un solo miss per thread
+        self.assertEqual((after["hit"] - before["hit"], after["miss"] - before["miss"]), (threads * (rounds - 1), threads))
+
+class ExclusiveMaintenanceTest(DatabaseTestCase):
+    """Ripristino e conversione a VACUUM incrementale non partono mentre un lavoro in
+    background usa una connessione del pool, e durante l'operazione non se ne concedono"""
+    def setUp(self):
+        super().setUp()
+        self.db.insert("progetti", {"codice": "P1", "titolo": "Prima del backup"})
+        self.backup = backup_database(self.db.db_name, keep=5)
+        self.db.insert("progetti", {"codice": "P2", "titolo": "Dopo il backup"})
+
+    def _hold_worker(self):
+        """Lavoro in background che tiene una connessione finché non si rilascia l'evento"""
+        started, finish = threading.Event(), threading.Event()
+        def job():
+            with self.db.worker(readonly=True):
+                self.db.fetch_all("progetti")
+                started.set()
+                finish.wait(10)
+        thread = threading.Thread(target=job)
+        thread.start()
+        self.assertTrue(started.wait(10))
+        return thread, finish
+
+    def test_refused_while_worker_busy(self):
+        thread, finish = self._hold_worker()
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.restore_backup(self.backup)
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.enable_incremental_vacuum()
+        finally:
+            finish.set()
+            thread.join()
+        self.assertEqual(len(self.db.fetch_all("progetti")), 2)
+
+    def test_runs_once_workers_are_done(self):
+        thread, finish = self._hold_worker()
+        finish.set()
+        thread.join()
+        self.assertEqual(self.db.pool.in_use(), 0)
+        self.db.restore_backup(self.backup)
+        self.assertEqual([p.codice for p in self.db.fetch_all("progetti")], ["P1"])
+        self.db.enable_incremental_vacuum()
+        self.assertEqual(self.db.auto_vacuum_mode(), "INCREMENTAL")
+        self.assertEqual(self.db._fetchone("PRAGMA journal_mode")[0], "wal")
+        # Dopo l'operazione il pool torna a concedere connessioni
+        with self.db.pool.exclusive():
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.pool.acquire()
+        conn = self.db.pool.acquire()
+        self.db.pool.release(conn)
+
+class ParseDecimalTest(unittest.TestCase):
+    def test_italian_formats(self):
+        for text, expected in (("12,5", "12.5"), ("1.234,5", "1234.5"), ("€ 3", "3"), ("17%", "17"), ("", "0")):
+            self.assertEqual(parse_decimal(text, strict=True), Decimal(expected), text)
+
+    def test_strict_rejects_non_numeric(self):
+        # Senza strict un testo non numerico vale 0: le percentuali in blocco non devono azzerarsi
+        for text in ("abc", "12,5x", "nan", "inf"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_decimal(text, strict=True)
+        self.assertEqual(parse_decimal("abc"), 0)
+
+    def test_percentages_are_checked(self):
+        # Le percentuali della scheda 3 e in blocco: "17x" non deve diventare 0%
+        self.assertEqual([parse_perc(text) for text in ("17", "2,5", "0", "100", "")], [1700, 250, 0, 10000, 0])
+        for text in ("17x", "-1", "100,01", "nan"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_perc(text)
+
+class PricingEngineTest(DatabaseTestCase):
+    db_name = "calcolo.db"
+
+    def setUp(self):
+        super().setUp()
+        seed_synthetic_database(self.db, projects=2, nps_per_project=40)
+
+    def test_engine_matches_trigger_aggregates(self):
+        for np in self.db.fetch_all("nuovi_prezzi"):
+            summary = self.db.np_summary(np)
+            for field, engine_value in (("totale_a_cent", summary.totale_a_cent),
+                                        ("totale_manodopera_cent", summary.manodopera_cent),
+                                        ("prezzo_finale_cent", summary.totale_cent)):
+                self.assertEqual(getattr(np, field), engine_value, f"{np.codice}: {field}")
+
+    def test_summary_memo_skips_item_reads(self):
+        class QueryLog(QueryProfiler):
+            def __init__(self):
+                super().__init__(slow_ms=float("inf"))
+                self.queries = []
+
+            def record(self, conn, query, params, elapsed, rows):
+                self.queries.append(query)
+                super().record(conn, query, params, elapsed, rows)
+
+        np = self.db.fetch_all("nuovi_prezzi", "ORDER BY id")[0]
+        log = self.db.profiler = QueryLog()
+        first = self.db.np_summary(np)
+        self.assertTrue(any("voci_costo" in query for query in log.queries))
+        # Finché NP e voci non cambiano il riepilogo viene dalla memoria, senza leggere le voci
+        log.queries.clear()
+        self.assertIs(self.db.np_summary(np), first)
+        self.assertFalse([query for query in log.queries if "voci_costo" in query])
+        item = self.db.fetch_one("voci_costo", "WHERE np_id=? ORDER BY ordine", (np.id,))
+        self.db.update("voci_costo", item.id, {"quantita_mil": item.quantita_mil + 1000})
+        np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np.id,))
+        log.queries.clear()
+        self.assertEqual(self.db.np_summary(np).totale_cent, np.prezzo_finale_cent)
+        self.assertTrue(any("voci_costo" in query for query in log.queries))
+
+    def test_recompute_project_fixes_only_drifted(self):
+        # Il ricalcolo di progetto deve trovare e correggere gli aggregati alterati, e solo quelli
+        nps = self.db.fetch_all("nuovi_prezzi")
+        tampered = [np for np in nps if np.progetto_id == nps[0].progetto_id][::7]
+        with self.db.transaction():
+            for np in tampered:
+                self.db._execute("UPDATE nuovi_prezzi SET totale_a_cent = totale_a_cent + 100 WHERE id=?", (np.id,))
+        totals = self.db.recompute_project(nps[0].progetto_id)
+        self.assertEqual({t.codice for t in totals if t.deriva}, {np.codice for np in tampered})
+        for total in totals:
+            np = self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (total.id,))
+            self.assertEqual((np.totale_a_cent, np.prezzo_finale_cent), (total.totale_a_cent, total.totale_cent), np.codice)
+
+class IncrementalTotalsTest(DatabaseTestCase):
+    """Prova di proprietà per la scheda 3: dopo ogni inserimento, modifica o cancellazione
+    casuale fatta con CostItemEditor e applicata per differenza, elenco, versioni e
+    riepilogo devono coincidere con una rilettura completa. Ogni tanto un altro utente
+    modifica una voce: l'editor deve accorgersene e rileggere."""
+    db_name = "delta.db"
+
+    def test_random_item_changes(self, operations=400, seed=1):
+        db = self.db
+        rnd = random.Random(seed)
+        categories = ("Manodopera", "Manodopera specializzata", "Prodotti", "Attrezzature", "Trasporti")
+        pid = db.insert("progetti", {"codice": "DELTA", "titolo": "Prova incrementale"})
+        np_id = db.insert("nuovi_prezzi", {"progetto_id": pid, "codice": "NP.DELTA", "descrizione": "Prova"})
+        editor = CostItemEditor(db, FakeTree())
+        editor.load(np_id)
+        external = False
+        for step in range(operations):
+            choice = rnd.random()
+            if editor.model.items and choice < 0.1:
+                # Scrittura di un altro utente, senza passare dall'editor
+                db.update("voci_costo", rnd.choice(list(editor.model.items)), {"quantita_mil": rnd.randint(0, 50000)})
+                external = True
+                continue
+            try:
+                if not editor.model.items or choice < 0.5:
+                    operation = "inserimento"
+                    item_id, _ = editor.add_item({
+                        "ordine": rnd.randint(1, 30), "categoria": rnd.choice(categories), "descrizione": "voce",
+                        "um": "cad", "quantita_mil": rnd.randint(0, 50000), "prezzo_unitario_mil": rnd.randint(0, 5000000)})
+                    deleted = False
+                else:
+                    item_id = rnd.choice(list(editor.model.items))
+                    deleted = choice >= 0.85
+                    if deleted:
+                        operation = "cancellazione"
+                        editor.delete_item(item_id)
+                    else:
+                        operation = "modifica"
+                        editor.update_item(item_id, {"ordine": rnd.randint(1, 30), "categoria": rnd.choice(categories),
+                                                     "quantita_mil": rnd.randint(0, 50000)})
+            except ConflictError:
+                self.assertTrue(external, f"passo {step}: conflitto senza scritture esterne")
+                editor.load(np_id)
+                external = False
+                continue
+            where = f"passo {step} ({operation})"
+            if not editor.apply_change(item_id, deleted):
+                self.assertTrue(external, f"{where}: rilettura completa senza scritture esterne")
+                editor.load(np_id)
+            external = False
+
+            fresh = CostItemEditor(db, FakeTree())
+            fresh.load(np_id)
+            self.assertEqual(editor.tree.rows, fresh.tree.rows, f"{where}: elenco diverso dalla rilettura")
+            self.assertEqual(editor.versions, fresh.versions, where)
+            perc = (rnd.choice((0, 1350, 1700, 2500)), rnd.choice((0, 500, 1000)), rnd.choice((0, 1000, 1234)))
+            items = db.fetch_all("voci_costo", "WHERE np_id=? ORDER BY ordine ASC", (np_id,))
+            self.assertEqual(editor.model.summary(*perc), compute_np_summary(*perc, items), where)
+            self.assertEqual(editor.model.max_order(), fresh.model.max_order(), where)
+
+class OpenNPVersionTest(DatabaseTestCase):
+    """La scheda 3 salva le percentuali contro la row_version letta con l'NP: dopo una
+    modifica dello stesso NP dalla scheda 2 la rilettura evita un falso conflitto"""
+    def test_update_then_percentage_edit(self):
+        pid = self.db.insert("progetti", {"codice": "VER", "titolo": "Versioni"})
+        np_id = self.db.insert("nuovi_prezzi", {"progetto_id": pid, "codice": "NP.1", "descrizione": "Prima"})
+        editor = CostItemEditor(self.db, FakeTree())
+        self.assertEqual(editor.load(np_id).id, np_id)
+        read_version = editor.np_version
+        # "Modifica" nella scheda 2, poi la scheda 3 rilegge l'NP (refresh_details_tree)
+        self.db.update("nuovi_prezzi", np_id, {"descrizione": "Dopo"}, version=read_version)
+        editor.load(np_id)
+        self.assertEqual(editor.np_version, read_version + 1)
+        perc = {"perc_spese_generali_pb": 1500, "perc_sicurezza_pb": 0, "perc_utili_pb": 1000}
+        self.db.update_many("nuovi_prezzi", [(np_id, perc)], versions={np_id: editor.np_version})
+        # Con la versione letta prima della modifica sarebbe stato un conflitto
+        with self.assertRaises(ConflictError):
+            self.db.update_many("nuovi_prezzi", [(np_id, perc)], versions={np_id: read_version})
+        self.assertEqual(self.db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,)).perc_spese_generali_pb, 1500)
+
+class NPCompositionTest(DatabaseTestCase):
+    """NP composti: dopo ogni modifica fatta con CostItemEditor (o delle percentuali, come
+    flush_pending_writes) ogni voce che richiama un NP deve avere come prezzo unitario il
+    suo prezzo finale; i richiami che chiudono un ciclo vanno rifiutati senza scrivere nulla"""
+    db_name = "composti.db"
+
+    def test_random_references_stay_in_sync(self, operations=150, seed=1):
+        db = self.db
+        rnd = random.Random(seed)
+        stale_query = f"""
+            SELECT v.id FROM voci_costo v JOIN nuovi_prezzi n ON n.id = v.np_rif_id
+            WHERE v.prezzo_unitario_mil != n.prezzo_finale_cent * {NP_REF_PRICE_MIL}"""
+        pid = db.insert("progetti", {"codice": "COMPOSTI", "titolo": "Prova NP composti"})
+        nps = [db.insert("nuovi_prezzi", {"progetto_id": pid, "codice": f"NP.{i:02d}", "descrizione": "Prova"}) for i in range(12)]
+        for np_id in nps:
+            db.insert("voci_costo", {"np_id": np_id, "ordine": 1, "categoria": "Manodopera", "descrizione": "voce", "um": "h",
+                                     "quantita_mil": rnd.randint(1000, 9000), "prezzo_unitario_mil": rnd.randint(10000, 90000)})
+        editor = CostItemEditor(db, FakeTree())
+        for step in range(operations):
+            np_id = rnd.choice(nps)
+            editor.load(np_id)
+            choice = rnd.random()
+            if choice < 0.4:
+                # Nuovo richiamo casuale: quelli che chiudono un ciclo devono fallire
+                rif_id = rnd.choice(nps)
+                would_cycle = rif_id in db.np_dependency_graph([np_id])[0]
+                self.assertIsNotNone(editor.link(rif_id))
+                data = {"ordine": 2, "categoria": "Prodotti", "descrizione": "sottoanalisi", "um": "cad",
+                        "quantita_mil": rnd.randint(500, 3000), "prezzo_unitario_mil": 0}
+                try:
+                    item_id, _ = editor.add_item(data)
+                except ValueError:
+                    self.assertTrue(would_cycle, f"passo {step}: richiamo {np_id}->{rif_id} rifiutato")
+                    np_rec = db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,), columns=("num_voci",))
+                    self.assertEqual(np_rec.num_voci, len(editor.model.items), f"passo {step}: richiamo rifiutato ma scritto")
+                    continue
+                self.assertFalse(would_cycle, f"passo {step}: ciclo {np_id}->{rif_id} accettato")
+                self.assertTrue(editor.apply_change(item_id), f"passo {step}")
+            elif choice < 0.8:
+                editor.link(None)
+                item = next(item for item in editor.model.items.values() if item.np_rif_id is None)
+                editor.update_item(item.id, {"quantita_mil": rnd.randint(1000, 9000)})
+                self.assertTrue(editor.apply_change(item.id), f"passo {step}")
+            else:
+                np_rec = db.fetch_one("nuovi_prezzi", "WHERE id=?", (np_id,))
+                with db.transaction():
+                    db.update_many("nuovi_prezzi", [(np_id, {"perc_spese_generali_pb": rnd.choice((1300, 1500, 1700)),
+                                                             "perc_utili_pb": rnd.choice((800, 1000))})],
+                                   versions={np_id: np_rec.row_version})
+                    db.propagate_np_prices([np_id])
+            self.assertEqual(db._fetchall(stale_query), [],
+                             f"passo {step}: voci con prezzo non allineato all'NP richiamato")
+
+if __name__ == "__main__":
+    unittest.main()